@@ -0,0 +1,219 @@
+"""
+Load test of the service: replays a mix of rating and balancing requests at a fixed rate and reports the latency.
+
+    python -m benchmarks.load                                    # the default mix at 50 requests/s for 10s
+    python -m benchmarks.load --rate 200 --duration 30 --save load.json
+    python -m benchmarks.load --mix "mmr_update[1v1]=3,team_balance[4v4]=1"
+    python -m benchmarks.load --url http://localhost:80          # a running service instead of main.app
+    python -m benchmarks.load --profile stacks.txt --slow 0.1    # collapsed stacks of the requests over 100ms
+
+Requests arrive as a Poisson process of the given rate, whatever the latency of the requests before them (an open
+loop, like independent players), drawn with a fixed seed so that runs replay the same requests. The latency of a
+request counts from the time it was due, so that a blocked event loop delays the requests due meanwhile instead of
+hiding them (coordinated omission). The report has, for each scenario of the mix and overall, the p50/p95/p99
+latency, the throughput of successful requests and the CPU time of this process per request.
+
+By default main.app runs in this process, warmed up first, through httpx.ASGITransport. Its worker pools run as
+configured by the environment (see WorkerPool.from_env): with process pools the CPU time and the profile miss the
+rating and balancing done in the pool processes, set RATING_POOL_KIND and BALANCE_POOL_KIND to "thread" or
+"inline" to measure them here. --profile samples every thread of this process during the run (see
+benchmarks.profiler) and writes the stacks sampled while the requests slower than --slow were in flight, ready
+for flamegraph.pl: the event loop blocked in a SciPy solver shows up as the stacks of the MainThread.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import namedtuple
+
+import httpx
+import numpy as np
+
+from benchmarks.profiler import SamplingProfiler, collapse, write_collapsed
+from teambalance.balance import Balance
+
+# scenario: weight, the scenarios are "mmr_update[<game mode>]" and "team_balance[<game mode>]"
+DEFAULT_MIX = {
+    "mmr_update[1v1]": 30,
+    "mmr_update[4v4]": 20,
+    "mmr_update[1v1v1v1]": 10,
+    "team_balance[2v2]": 10,
+    "team_balance[3v3]": 10,
+    "team_balance[4v4]": 10,
+    "team_balance[3v3v3v3]": 10,
+}
+
+PERCENTILES = (50, 95, 99)
+
+# parses the game modes, it builds no superset
+_balance = Balance()
+
+# scenario, status: HTTP status or None when the request failed, start: perf_counter() when the request was due,
+# stop: perf_counter() when it completed
+RequestResult = namedtuple("RequestResult", ["scenario", "status", "start", "stop"])
+
+
+def parse_mix(text):
+    """Parses a mix "scenario=weight,scenario=weight" into a dict."""
+    mix = {}
+    for item in text.split(","):
+        scenario, _, weight = item.strip().rpartition("=")
+        mix[scenario] = float(weight)
+    return mix
+
+
+def make_request(scenario, rng):
+    """(path, JSON body) of a random request of scenario, with random arranged teams for balancing."""
+    kind, _, game_mode = scenario.partition("[")
+    game_mode = game_mode.rstrip("]")
+    num_teams, num_players_per_team = _balance.parse_game_mode(game_mode)
+    num_players = num_teams * num_players_per_team
+    body = {"ratings_list": rng.normal(1500, 250, num_players).clip(100).tolist(),
+            "rds_list": rng.uniform(80, 350, num_players).tolist()}
+    if kind == "mmr_update":
+        body.update(winning_team=int(rng.integers(num_teams)), number_of_teams=num_teams)
+        return "/mmr/update", body
+    if kind == "team_balance":
+        # most players queue alone, the others with friends of their team
+        sizes = []
+        for _ in range(num_teams):
+            left = num_players_per_team
+            while left:
+                size = 1 if left == 1 or rng.random() < 0.6 else int(rng.integers(2, left + 1))
+                sizes.append(size)
+                left -= size
+        body.update(gamemode=game_mode, team_constraints="+".join(str(size) for size in sorted(sizes, reverse=True)))
+        return "/team/balance", body
+    raise ValueError("Unknown scenario '{}', expected mmr_update[<game mode>] or team_balance[<game mode>]".format(
+        scenario))
+
+
+def make_schedule(rate, duration, mix=None, seed=0):
+    """Requests of a run: (seconds from the start, scenario, path, body), arriving at rate per second."""
+    mix = mix or DEFAULT_MIX
+    rng = np.random.default_rng(seed)
+    scenarios = sorted(mix)
+    weights = np.array([mix[scenario] for scenario in scenarios], dtype=float)
+    schedule, offset = [], rng.exponential(1 / rate)
+    while offset < duration:
+        scenario = scenarios[rng.choice(len(scenarios), p=weights / weights.sum())]
+        schedule.append((offset, scenario) + make_request(scenario, rng))
+        offset += rng.exponential(1 / rate)
+    return schedule
+
+
+async def run_load(schedule, transport=None, base_url="http://localhost", max_connections=100, timeout=60.0):
+    """Sends the requests of schedule when they are due.
+
+    Returns:
+        The RequestResult of each request, the seconds the run took and the CPU seconds this process used.
+    """
+    results = []
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    async with httpx.AsyncClient(base_url=base_url, transport=transport, limits=limits, timeout=timeout) as http:
+
+        async def send(offset, scenario, path, body):
+            await asyncio.sleep(max(0.0, start + offset - time.perf_counter()))
+            try:
+                status = (await http.post(path, json=body)).status_code
+            except httpx.HTTPError:
+                status = None
+            results.append(RequestResult(scenario, status, start + offset, time.perf_counter()))
+
+        cpu = time.process_time()
+        start = time.perf_counter()
+        await asyncio.gather(*[send(*request) for request in schedule])
+        return results, time.perf_counter() - start, time.process_time() - cpu
+
+
+def report(results, elapsed, cpu):
+    """Latency percentiles (in seconds), throughput and errors of results, by scenario and overall ("all").
+
+    Only successful requests count in the latency and the throughput, cpu_per_request spreads cpu over every
+    request.
+    """
+    scenarios = {"all": results}
+    for result in results:
+        scenarios.setdefault(result.scenario, []).append(result)
+    summary = {}
+    for scenario, scenario_results in sorted(scenarios.items()):
+        latency = np.array([r.stop - r.start for r in scenario_results if r.status == 200])
+        entry = {"requests": len(scenario_results), "errors": len(scenario_results) - len(latency),
+                 "throughput": len(latency) / elapsed if elapsed > 0 else 0.0}
+        for percentile in PERCENTILES:
+            entry["p{}".format(percentile)] = float(np.percentile(latency, percentile)) if len(latency) else None
+        summary[scenario] = entry
+    summary["all"]["cpu_per_request"] = cpu / len(results) if results else None
+    return summary
+
+
+def slow_requests_profile(profiler, results, slow):
+    """Collapsed stacks (see benchmarks.profiler.collapse) sampled while the requests slower than slow seconds
+    were in flight, a sample counting once even when several slow requests overlapped.
+    """
+    samples = set()
+    for result in results:
+        if result.stop - result.start >= slow:
+            samples.update(profiler.samples_between(result.start, result.stop))
+    return collapse(samples)
+
+
+def _format_ms(seconds):
+    return "-" if seconds is None else "{:.1f}".format(seconds * 1e3)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load tests the service with a mix of requests.")
+    parser.add_argument("--rate", type=float, default=50.0, help="requests per second")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of requests")
+    parser.add_argument("--mix", type=parse_mix, help="scenario=weight,... (see DEFAULT_MIX)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--url", help="URL of a running service, main.app runs in this process if not set")
+    parser.add_argument("--save", help="write the report to this JSON file")
+    parser.add_argument("--profile", help="write the collapsed stacks of the slow requests to this file")
+    parser.add_argument("--slow", type=float, default=0.1, help="seconds from which a request is profiled")
+    parser.add_argument("--interval", type=float, default=0.005, help="seconds between profile samples")
+    args = parser.parse_args(argv)
+    if args.profile and args.url:
+        parser.error("--profile samples this process, it needs main.app to run in it (no --url)")
+
+    schedule = make_schedule(args.rate, args.duration, args.mix, args.seed)
+    transport = None
+    if not args.url:
+        import main as service
+
+        service.warm_up()
+        transport = httpx.ASGITransport(app=service.app)
+    profiler = SamplingProfiler(args.interval) if args.profile else None
+    if profiler:
+        profiler.start()
+    try:
+        results, elapsed, cpu = asyncio.run(run_load(schedule, transport, args.url or "http://localhost"))
+    finally:
+        if profiler:
+            profiler.stop()
+    summary = report(results, elapsed, cpu)
+
+    print("{:<25} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}".format("scenario", "requests", "errors", "req/s",
+                                                              "p50 ms", "p95 ms", "p99 ms"))
+    for scenario, entry in summary.items():
+        print("{:<25} {:>8} {:>7} {:>9.1f} {:>9} {:>9} {:>9}".format(
+            scenario, entry["requests"], entry["errors"], entry["throughput"], _format_ms(entry["p50"]),
+            _format_ms(entry["p95"]), _format_ms(entry["p99"])))
+    print("{:.1f}s for {} requests due in {:.1f}s, {} CPU per request".format(
+        elapsed, len(results), args.duration, _format_ms(summary["all"]["cpu_per_request"]) + " ms"))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"rate": args.rate, "duration": args.duration, "elapsed": elapsed, "cpu": cpu,
+                       "report": summary}, f, indent=2, sort_keys=True)
+    if profiler:
+        stacks = slow_requests_profile(profiler, results, args.slow)
+        write_collapsed(stacks, args.profile)
+        print("{} samples of the requests over {}s written to {}".format(sum(stacks.values()), args.slow,
+                                                                         args.profile))
+    return 0 if summary["all"]["errors"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
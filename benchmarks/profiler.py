@@ -0,0 +1,91 @@
+"""
+Sampling profiler of every thread of the process, whose samples are written as collapsed stacks for flame graphs.
+
+A background thread takes the stack of every other thread every interval seconds with sys._current_frames(), so
+the profiled code runs unchanged and the overhead only depends on the interval. Unlike cProfile it shows where the
+time goes while the event loop is blocked, in the worker threads of the pools and in the extensions called from
+Python (attributed to the Python frame calling them, e.g. a scipy.optimize call).
+
+Collapsed stacks are one line per distinct stack, "thread;outer frame;...;inner frame count", the input of
+flamegraph.pl (https://github.com/brendangregg/FlameGraph) and speedscope.
+
+Examples:
+    ```python
+    with SamplingProfiler(interval=0.005) as profiler:
+        run()
+    write_collapsed(collapse(profiler.samples), "stacks.txt")
+    ```
+"""
+import sys
+import threading
+import time
+from collections import Counter, namedtuple
+
+# time: perf_counter() of the sample, thread: name of the sampled thread, stack: frames from the outermost
+Sample = namedtuple("Sample", ["time", "thread", "stack"])
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of the threads of the process until stopped.
+
+    Args:
+        interval (float): Seconds between samples.
+        max_depth (int): Innermost frames kept of deeper stacks.
+    """
+
+    def __init__(self, interval=0.005, max_depth=128):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def samples_between(self, start, stop):
+        """Samples taken between the perf_counter() times start and stop."""
+        return [sample for sample in self.samples if start <= sample.time <= stop]
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.samples.append(Sample(now, names.get(ident, str(ident)), self._stack(frame)))
+
+    def _stack(self, frame):
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            stack.append("{} ({}:{})".format(code.co_name, code.co_filename.rsplit("/", 1)[-1], code.co_firstlineno))
+            frame = frame.f_back
+        return tuple(reversed(stack))
+
+
+def collapse(samples):
+    """Counts of each distinct stack of samples, keyed by its collapsed form "thread;outer;...;inner"."""
+    return Counter(";".join((sample.thread,) + sample.stack) for sample in samples)
+
+
+def write_collapsed(counts, path):
+    """Writes the counts of collapse() to path, one "stack count" line per stack, the most sampled first."""
+    with open(path, "w") as f:
+        for stack, count in counts.most_common():
+            f.write("{} {}\n".format(stack, count))
@@ -0,0 +1,357 @@
+"""
+Benchmarks of the rating and balancing hot paths, for every game mode we run.
+
+    python -m benchmarks.run                                      # every benchmark
+    python -m benchmarks.run -k balance                           # benchmarks whose name contains "balance"
+    python -m benchmarks.run --save baseline.json                 # save the timings as a baseline
+    python -m benchmarks.run --compare baseline.json --threshold 0.25
+
+With --compare, every benchmark is reported as faster, slower or ok against the baseline (its median time moved by
+more than threshold, relatively) and the run fails when any benchmark got slower. Inputs are drawn with fixed seeds
+so that runs time the same work, but timings only compare on the same machine: save the baseline of the target
+branch and compare against it on the same box. The end-to-end benchmarks go through the worker pools configured
+by the environment, like the service (see WorkerPool.from_env).
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from common import wire
+from common.odds import win_probabilities
+from common.constants import BETA
+from matchmaking.queue import match_queue
+from mmr import update_mmr as legacy
+from mmr.bayesian_rating_w3c import find_map, posterior_pdf, update_after_game, update_after_games
+from teambalance.balance import Balance
+
+MODES = ("1v1", "2v2", "3v3", "4v4", "1v1v1v1", "3v3v3v3")
+# the legacy Glicko-2 update only rates two teams
+TWO_TEAM_MODES = ("1v1", "2v2", "3v3", "4v4")
+
+# name: setup, a function returning the function to time
+BENCHMARKS = {}
+
+
+def benchmark(name, params=None):
+    """Registers setup(param) for every param of params as the benchmark "name[param]" (or setup() as "name")."""
+
+    def register(setup):
+        if params is None:
+            BENCHMARKS[name] = setup
+        for param in params or ():
+            BENCHMARKS["{}[{}]".format(name, param)] = lambda param=param: setup(param)
+        return setup
+
+    return register
+
+
+def random_game(game_mode, seed=0):
+    """(ratings, rds, num_teams) of a game of game_mode drawn with a fixed seed."""
+    num_teams, num_players_per_team = Balance().parse_game_mode(game_mode)
+    rng = np.random.default_rng(seed)
+    num_players = num_teams * num_players_per_team
+    return rng.normal(1500, 250, num_players).clip(100), rng.uniform(80, 250, num_players), num_teams
+
+
+def team_constraints(game_mode):
+    # an arranged team of two when the game mode has room for one, random teams otherwise
+    num_teams, num_players_per_team = Balance().parse_game_mode(game_mode)
+    num_players = num_teams * num_players_per_team
+    if num_players_per_team >= 2:
+        return "+".join(["2"] + ["1"] * (num_players - 2))
+    return "+".join(["1"] * num_players)
+
+
+@benchmark("rating.update_after_game", MODES)
+def bench_update_after_game(game_mode):
+    ratings, rds, num_teams = random_game(game_mode)
+    return lambda: update_after_game(ratings.tolist(), rds.tolist(), 0, num_teams)
+
+
+@benchmark("rating.update_after_games_64", ("1v1", "4v4"))
+def bench_update_after_games(game_mode):
+    games = []
+    for seed in range(64):
+        ratings, rds, num_teams = random_game(game_mode, seed)
+        games.append((ratings.tolist(), rds.tolist(), seed % num_teams, num_teams))
+    return lambda: update_after_games(games)
+
+
+@benchmark("rating.update_after_game_laplace", MODES)
+def bench_update_after_game_laplace(game_mode):
+    ratings, rds, num_teams = random_game(game_mode)
+    return lambda: update_after_game(ratings.tolist(), rds.tolist(), 0, num_teams, integrator="laplace", tol=1e-6)
+
+
+@benchmark("rating.update_after_games_64_laplace", ("1v1", "4v4"))
+def bench_update_after_games_laplace(game_mode):
+    games = []
+    for seed in range(64):
+        ratings, rds, num_teams = random_game(game_mode, seed)
+        games.append((ratings.tolist(), rds.tolist(), seed % num_teams, num_teams))
+    return lambda: update_after_games(games, integrator="laplace", tol=1e-6)
+
+
+@benchmark("rating.posterior_pdf", MODES)
+def bench_posterior_pdf(game_mode):
+    ratings, rds, num_teams = random_game(game_mode)
+    ratings_u = ratings * 1.01
+    return lambda: posterior_pdf(ratings_u, ratings, rds, BETA, 0, num_teams)
+
+
+@benchmark("rating.posterior_pdf_batch_256", MODES)
+def bench_posterior_pdf_batch(game_mode):
+    ratings, rds, num_teams = random_game(game_mode)
+    candidates = ratings * np.random.default_rng(1).uniform(0.9, 1.1, (256, len(ratings)))
+    return lambda: posterior_pdf(candidates, ratings, rds, BETA, 0, num_teams)
+
+
+@benchmark("rating.find_map_numeric", MODES)
+def bench_find_map_numeric(game_mode):
+    ratings, rds, num_teams = random_game(game_mode)
+    return lambda: find_map(ratings, rds, 0, num_teams, solver="numeric")
+
+
+@benchmark("rating.win_probabilities_4096", MODES)
+def bench_win_probabilities(game_mode):
+    num_teams, num_players_per_team = Balance().parse_game_mode(game_mode)
+    rng = np.random.default_rng(0)
+    shape = (4096, num_teams * num_players_per_team)
+    ratings, rds = rng.normal(1500, 250, shape).clip(100), rng.uniform(80, 250, shape)
+    return lambda: win_probabilities(ratings, rds, num_teams)
+
+
+@benchmark("legacy.update_after_game", TWO_TEAM_MODES)
+def bench_legacy_update_after_game(game_mode):
+    ratings, rds, _ = random_game(game_mode)
+    return lambda: legacy.update_after_game(ratings.tolist(), rds.tolist(), 1, solver="vectorized")
+
+
+@benchmark("legacy.update_after_game_scipy", TWO_TEAM_MODES)
+def bench_legacy_update_after_game_scipy(game_mode):
+    ratings, rds, _ = random_game(game_mode)
+    return lambda: legacy.update_after_game(ratings.tolist(), rds.tolist(), 1, solver="scipy")
+
+
+@benchmark("balance.generate_superset", MODES)
+def bench_generate_superset(game_mode):
+    balance = Balance()
+    num_teams, num_players_per_team = balance.parse_game_mode(game_mode)
+    return lambda: balance.generate_superset(num_teams, num_players_per_team)
+
+
+@benchmark("balance.filter_constraints", MODES)
+def bench_filter_constraints(game_mode):
+    balance = Balance()
+    superset = balance.get_superset(game_mode)
+    constraints = team_constraints(game_mode)
+    return lambda: balance._filter_constraints(superset, constraints)
+
+
+@benchmark("balance.find_best_game", MODES)
+def bench_find_best_game(game_mode):
+    # a worker keeps its supersets and constraint sets between requests, so they are built once here
+    balance = Balance()
+    ratings, rds, _ = random_game(game_mode)
+    constraints = team_constraints(game_mode)
+    balance.find_best_game(ratings, rds, game_mode, constraints)
+    return lambda: balance.find_best_game(ratings, rds, game_mode, constraints)
+
+
+@benchmark("balance.top_games_10", MODES)
+def bench_top_games(game_mode):
+    balance = Balance()
+    ratings, rds, _ = random_game(game_mode)
+    constraints = team_constraints(game_mode)
+    balance.top_games(ratings, rds, game_mode, constraints, k=10)
+    return lambda: balance.top_games(ratings, rds, game_mode, constraints, k=10)
+
+
+@benchmark("balance.find_best_lobbies_48", ("2v2", "4v4", "3v3"))
+def bench_find_best_lobbies(game_mode):
+    balance = Balance()
+    rng = np.random.default_rng(0)
+    ratings, rds = rng.normal(1500, 250, 48).clip(100), rng.uniform(80, 250, 48)
+    return lambda: balance.find_best_lobbies(ratings, rds, game_mode)
+
+
+@benchmark("queue.match_queue", (64, 1000, 5000))
+def bench_match_queue(num_players):
+    rng = np.random.default_rng(0)
+    ratings, rds = rng.normal(1500, 300, num_players), rng.uniform(40, 300, num_players)
+    wait_times = rng.uniform(0, 120, num_players)
+    return lambda: match_queue(ratings, rds, wait_times)
+
+
+_client = None
+
+
+def client():
+    global _client
+    if _client is None:
+        from fastapi.testclient import TestClient
+
+        from main import app
+        _client = TestClient(app)
+    return _client
+
+
+@benchmark("api.mmr_update", MODES)
+def bench_api_mmr_update(game_mode):
+    ratings, rds, num_teams = random_game(game_mode)
+    body = {"ratings_list": ratings.tolist(), "rds_list": rds.tolist(), "winning_team": 0,
+            "number_of_teams": num_teams}
+    return lambda: client().post("/mmr/update", json=body)
+
+
+@benchmark("api.team_balance", MODES)
+def bench_api_team_balance(game_mode):
+    ratings, rds, _ = random_game(game_mode)
+    body = {"ratings_list": ratings.tolist(), "rds_list": rds.tolist(), "gamemode": game_mode,
+            "team_constraints": team_constraints(game_mode)}
+    client().post("/team/balance", json=body)
+    return lambda: client().post("/team/balance", json=body)
+
+
+@benchmark("api.mmr_update_wire", MODES)
+def bench_api_mmr_update_wire(game_mode):
+    ratings, rds, num_teams = random_game(game_mode)
+    body = wire.encode_update_request(ratings, rds, 0, num_teams)
+    return lambda: client().post("/mmr/update", data=body, headers={"Content-Type": wire.WIRE_CONTENT_TYPE})
+
+
+@benchmark("api.team_balance_wire", MODES)
+def bench_api_team_balance_wire(game_mode):
+    ratings, rds, _ = random_game(game_mode)
+    body = wire.encode_balance_request(ratings, rds, game_mode, team_constraints(game_mode))
+    headers = {"Content-Type": wire.WIRE_CONTENT_TYPE}
+    client().post("/team/balance", data=body, headers=headers)
+    return lambda: client().post("/team/balance", data=body, headers=headers)
+
+
+@benchmark("api.predict_1000", ("1v1", "4v4"))
+def bench_api_predict(game_mode):
+    games = []
+    for seed in range(1000):
+        ratings, rds, num_teams = random_game(game_mode, seed)
+        games.append({"ratings_list": ratings.tolist(), "rds_list": rds.tolist(), "number_of_teams": num_teams})
+    return lambda: client().post("/mmr/predict", json={"games": games})
+
+
+@benchmark("api.predict_1000_wire", ("1v1", "4v4"))
+def bench_api_predict_wire(game_mode):
+    games = [random_game(game_mode, seed) for seed in range(1000)]
+    body = wire.encode_predict_request(games)
+    return lambda: client().post("/mmr/predict", data=body, headers={"Content-Type": wire.WIRE_CONTENT_TYPE})
+
+
+@benchmark("client.update_mmr_64", ("naive", "coalesced"))
+def bench_client_update_mmr(mode):
+    # 64 concurrent rating updates of 2v2 games through MmrClient, one request per game or coalesced in batches
+    import asyncio
+
+    import httpx
+
+    from client.mmr_client import MmrClient
+    from main import app
+
+    games = [random_game("2v2", seed) for seed in range(64)]
+
+    async def run():
+        async with MmrClient(transport=httpx.ASGITransport(app=app), batch_size=1 if mode == "naive" else 64) as c:
+            await asyncio.gather(*[c.update_mmr(ratings.tolist(), rds.tolist(), 0, num_teams)
+                                   for ratings, rds, num_teams in games])
+
+    return lambda: asyncio.run(run())
+
+
+def measure(fn, rounds=5, min_time=0.05):
+    """Times fn in rounds of as many calls as take about min_time.
+
+    Returns:
+        A dict with the median and min seconds per call, the number of rounds and calls per round.
+    """
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    number = max(1, int(min_time / max(elapsed, 1e-9)))
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    return {"median": statistics.median(times), "min": min(times), "rounds": rounds, "number": number}
+
+
+def compare(results, baseline, threshold):
+    """Status of each benchmark against the baseline: "faster", "slower", "ok" or "new"."""
+    status = {}
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            status[name] = "new"
+        elif result["median"] > base["median"] * (1 + threshold):
+            status[name] = "slower"
+        elif result["median"] * (1 + threshold) < base["median"]:
+            status[name] = "faster"
+        else:
+            status[name] = "ok"
+    return status
+
+
+def _format_time(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return "{:.3g} {}".format(seconds / scale, unit)
+    return "{:.3g} ns".format(seconds / 1e-9)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the rating and balancing hot paths.")
+    parser.add_argument("-k", dest="keyword", help="only run benchmarks whose name contains this")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.05, help="seconds per round")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of baseline results")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative change reported as slower/faster")
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if args.keyword and args.keyword not in name:
+            continue
+        results[name] = measure(setup(), args.rounds, args.min_time)
+        line = "{:<45} {:>10} (min {})".format(name, _format_time(results[name]["median"]),
+                                               _format_time(results[name]["min"]))
+        if name in baseline:
+            line += "  {:+.1%} vs baseline".format(results[name]["median"] / baseline[name]["median"] - 1)
+        print(line, flush=True)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"machine": {"python": platform.python_version(), "numpy": np.__version__,
+                                   "platform": platform.platform(), "processor": platform.processor()},
+                       "results": results}, f, indent=2, sort_keys=True)
+    if args.compare:
+        status = compare(results, baseline, args.threshold)
+        for kind in ("slower", "faster", "new"):
+            names = sorted(name for name in status if status[name] == kind)
+            if names:
+                print("{}: {}".format(kind, ", ".join(names)))
+        if any(s == "slower" for s in status.values()):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
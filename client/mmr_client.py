@@ -0,0 +1,184 @@
+"""
+Asyncio client of the MMR service, for the services rating games and balancing teams through it.
+
+One MmrClient keeps a pool of keep-alive connections to the service and bounds the requests it has in flight.
+Rating updates are coalesced: the games rated within batch_delay seconds of each other (up to batch_size of them)
+go to /mmr/update/batch in one request, which rates them together (see update_after_games) for a fraction of the
+time of as many calls to /mmr/update. Requests the service rejects because it is busy (429, and 503 when its pools
+time out or break) are retried with exponential backoff and jitter, so that the clients of a busy service do not
+all come back at once, and never before the Retry-After the service asked for.
+
+Examples:
+    ```python
+    async with MmrClient("http://mmr-service") as client:
+        result = await client.update_mmr([1400, 1600, 1340, 1700], [350, 350, 350, 350], 0, 2)
+        ratings, rds = result["ratings_list"], result["rds_list"]
+        teams = (await client.balance_teams(ratings, rds, "2v2"))["teams"]
+    ```
+"""
+import asyncio
+import random
+
+import httpx
+
+# status codes of requests which are retried, the service answers them when it is overloaded
+RETRY_STATUS_CODES = (429, 503)
+
+
+class MmrClient:
+    """
+    Client of the MMR service, to use from a single event loop.
+
+    Args:
+        base_url (str): URL of the service.
+        max_connections (int): Connections kept open to the service.
+        max_concurrency (int): Requests in flight at once, the others wait for one to finish.
+        batch_size (int): Most games rated by one request, 1 sends each game on its own.
+        batch_delay (float): Seconds a game waits for others to share its request.
+        retries (int): Retries of a request the service rejected, or which could not reach it.
+        backoff (float): Seconds waited before the first retry, doubled on each retry up to max_backoff.
+        max_backoff (float): Most seconds waited before a retry.
+        timeout (float): Seconds to wait for the service to answer a request.
+        transport: httpx transport of the requests, to reach the service another way than over HTTP (e.g.
+            httpx.ASGITransport(app) in tests).
+    """
+
+    def __init__(self, base_url="http://localhost", max_connections=16, max_concurrency=16, batch_size=64,
+                 batch_delay=0.002, retries=3, backoff=0.05, max_backoff=2.0, timeout=30.0, transport=None):
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_concurrency = max_concurrency
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self._http = httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout, transport=transport)
+        # created on first use, on the running event loop
+        self._semaphore = None
+        # games waiting for their batch, with the future of their result
+        self._pending = []
+        self._flush_handle = None
+        self._batches = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        """Sends the games still waiting for their batch, waits for their results and closes the connections."""
+        self._flush()
+        if self._batches:
+            await asyncio.wait(list(self._batches))
+        await self._http.aclose()
+
+    async def update_mmr(self, ratings_list, rds_list, winning_team, number_of_teams):
+        """Rates a game, like POST /mmr/update, in a batch with the games rated at about the same time.
+
+        Returns:
+            The response of the service: {"ratings_list": [...], "rds_list": [...]}.
+
+        Raises:
+            httpx.HTTPStatusError: The service refused the game, or was still overloaded after every retry.
+            httpx.TransportError: The service could not be reached.
+        """
+        game = {"ratings_list": list(ratings_list), "rds_list": list(rds_list), "winning_team": winning_team,
+                "number_of_teams": number_of_teams}
+        if self.batch_size <= 1:
+            return await self._post("/mmr/update", game)
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append((game, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self.batch_delay, self._flush)
+        return await future
+
+    async def update_mmr_batch(self, games):
+        """Rates games of (ratings_list, rds_list, winning_team, number_of_teams), like POST /mmr/update/batch.
+
+        Returns:
+            The response of update_mmr() for each game.
+        """
+        return await asyncio.gather(*[self.update_mmr(*game) for game in games])
+
+    async def balance_teams(self, ratings_list, rds_list, gamemode, team_constraints=None, search=None,
+                            time_budget=None):
+        """Balances the teams of a game, like POST /team/balance, the options left unset keep the defaults of the
+        service.
+
+        Returns:
+            The response of the service: {"teams": [...], "exact": bool}.
+        """
+        body = {"ratings_list": list(ratings_list), "rds_list": list(rds_list), "gamemode": gamemode}
+        for name, value in (("team_constraints", team_constraints), ("search", search),
+                            ("time_budget", time_budget)):
+            if value is not None:
+                body[name] = value
+        return await self._post("/team/balance", body)
+
+    def _flush(self):
+        # sends the games waiting in one batch request
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.ensure_future(self._send_batch(batch))
+        self._batches.add(task)
+        task.add_done_callback(self._batches.discard)
+
+    async def _send_batch(self, batch):
+        try:
+            if len(batch) == 1:
+                results = [await self._post("/mmr/update", batch[0][0])]
+            else:
+                results = (await self._post("/mmr/update/batch", {"games": [game for game, _ in batch]}))["games"]
+        except httpx.HTTPStatusError as e:
+            if len(batch) > 1 and e.response.status_code not in RETRY_STATUS_CODES:
+                # one invalid game fails its whole batch: each game is sent alone to fail only the invalid ones
+                await asyncio.gather(*[self._send_batch([item]) for item in batch])
+                return
+            self._set_exception(batch, e)
+        except Exception as e:
+            self._set_exception(batch, e)
+        else:
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    @staticmethod
+    def _set_exception(batch, exception):
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(exception)
+
+    async def _post(self, path, body):
+        # posts body as JSON with at most max_concurrency requests in flight, retrying as set in __init__
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        for attempt in range(self.retries + 1):
+            response = None
+            try:
+                async with self._semaphore:
+                    response = await self._http.post(path, json=body)
+            except httpx.TransportError:
+                if attempt == self.retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self.retries:
+                    response.raise_for_status()
+                    return response.json()
+            await asyncio.sleep(self.retry_delay(attempt, response))
+
+    def retry_delay(self, attempt, response=None):
+        """Seconds to wait before retrying after attempt (from 0) failed: half the backoff of the attempt plus a
+        random part of the other half, and never less than the Retry-After of response.
+        """
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            delay = max(delay, float(response.headers["Retry-After"]))
+        return delay
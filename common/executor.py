@@ -0,0 +1,157 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from fastapi import HTTPException
+
+from common import metrics
+
+POOL_KINDS = ("process", "thread", "inline")
+
+
+class WorkerPool:
+    """
+    Runs CPU bound work (rating optimization, team balancing) away from the asyncio event loop,
+    so one slow request does not stall every other request served by the same worker.
+
+    The pool only accepts max_pending jobs at a time (running or queued): further jobs are
+    rejected right away with a 429 so callers can back off, and jobs that do not finish within
+    timeout seconds are answered with a 503. A job is only released from the pool once it
+    actually completes, so timed out jobs still count against max_pending while they run.
+
+    kind is one of POOL_KINDS:
+        "process": a process pool, the default as most of the hot paths hold the GIL
+        "thread": a thread pool, for paths which mostly run in NumPy and release the GIL
+        "inline": runs jobs directly on the event loop, as before, for debugging and profiling
+
+    Examples:
+        ```python
+        pool = WorkerPool("process", max_workers=4, max_pending=32, timeout=10)
+        result = await pool.run(update_after_game, ratings_list, rds_list, winning_team, number_of_teams)
+        ```
+    """
+
+    def __init__(self, kind="process", max_workers=None, max_pending=64, timeout=30.0, name="pool",
+                 initializer=None):
+        if kind not in POOL_KINDS:
+            raise ValueError("Unknown pool kind '{}', expected one of {}".format(kind, POOL_KINDS))
+        self.name = name
+        self.kind = kind
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.timeout = timeout
+        # run by each process of a process pool when it starts, threads share the state of the service
+        self.initializer = initializer
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, prefix, initializer=None):
+        """Builds a pool configured by the environment variables {prefix}_KIND, {prefix}_WORKERS,
+        {prefix}_MAX_PENDING and {prefix}_TIMEOUT (in seconds), unset variables keep their default.
+        """
+        workers = os.environ.get(prefix + "_WORKERS")
+        return cls(kind=os.environ.get(prefix + "_KIND", "process"),
+                   max_workers=int(workers) if workers else None,
+                   max_pending=int(os.environ.get(prefix + "_MAX_PENDING", 64)),
+                   timeout=float(os.environ.get(prefix + "_TIMEOUT", 30)),
+                   name=prefix.lower(), initializer=initializer)
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def _get_executor(self):
+        # executors are created on first use (or by start()) so that importing the app does not start processes
+        with self._executor_lock:
+            if self._executor is None:
+                if self.kind == "process":
+                    self._executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=self.initializer)
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def start(self, timeout=60.0):
+        """Creates the executor and waits until its workers run jobs, their initializer done, so that the first
+        requests do not pay for starting them. Blocks, to call from a thread rather than the event loop.
+
+        Returns:
+            The number of workers seen running a job, 0 for an inline pool.
+        """
+        if self.kind == "inline":
+            return 0
+        executor = self._get_executor()
+        deadline = time.monotonic() + timeout
+        workers = set()
+        # each round keeps every worker busy for a moment, so that the jobs spread over the workers
+        while len(workers) < self.max_workers and time.monotonic() < deadline:
+            futures = [executor.submit(_worker_id, 0.01) for _ in range(self.max_workers)]
+            workers.update(future.result(timeout=max(deadline - time.monotonic(), 0)) for future in futures)
+        return len(workers)
+
+    def _release(self, _future=None):
+        with self._lock:
+            self._pending -= 1
+
+    async def run(self, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) in the pool and returns its result.
+
+        Raises:
+            HTTPException: 429 when max_pending jobs are already in the pool,
+                503 when the job times out or the pool is broken.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise HTTPException(status_code=429, detail="Too many pending requests, retry later",
+                                    headers={"Retry-After": "1"})
+            self._pending += 1
+        if self.kind == "inline":
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._release()
+        try:
+            future = self._get_executor().submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            self._release()
+            self._executor = None
+            raise HTTPException(status_code=503, detail="Worker pool unavailable")
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            # only cancels jobs which are still queued, running jobs keep their slot until they finish
+            future.cancel()
+            raise HTTPException(status_code=503, detail="Request timed out")
+        except BrokenProcessPool:
+            self._executor = None
+            raise HTTPException(status_code=503, detail="Worker pool unavailable")
+
+    async def run_with_stats(self, fn, *args, **kwargs):
+        """Like run(), collecting what fn reports to common.metrics while it runs.
+
+        Returns:
+            A tuple (result, stats) with the stats of metrics.call_collecting(), None when metrics are disabled.
+        """
+        if not metrics.enabled:
+            return await self.run(fn, *args, **kwargs), None
+        return await self.run(metrics.call_collecting, fn, time.time(), *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+def _worker_id(seconds):
+    # the process and thread running the job, after holding them for seconds
+    time.sleep(seconds)
+    return os.getpid(), threading.get_ident()
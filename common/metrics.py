@@ -0,0 +1,237 @@
+"""
+Low overhead instrumentation of the hot paths, exposed in the Prometheus text format (see render()).
+
+Work done in the worker pools runs in other processes, so it is not recorded directly: the function run in the
+pool goes through call_collecting(), which collects what the hot paths report with timer(), count() and gauge()
+into a stats dict returned along with the result. The service then records those stats with the labels of the
+request (game mode, number of teams), see record().
+
+Setting MMR_METRICS=0 disables everything: timer() returns a shared no-op context manager, count() and gauge()
+return right away and the service does not expose /metrics.
+
+Examples:
+    ```python
+    with metrics.timer("find_map"):
+        opt = find_map(...)
+    metrics.count("optimizer_iterations", opt.nit)
+    ```
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+enabled = os.environ.get("MMR_METRICS", "1") != "0"
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    "mmr_http_request_seconds": "Time to answer a request, including validation and serialization",
+    "mmr_stage_seconds": "Time spent in each stage of the hot paths",
+    "mmr_queue_wait_seconds": "Time jobs waited in a worker pool before running",
+    "mmr_pool_pending": "Jobs running or queued in a worker pool",
+    "mmr_optimizer_iterations_total": "Iterations of the rating optimizers",
+    "mmr_optimizer_evaluations_total": "Posterior evaluations of the rating optimizers",
+    "mmr_quad_evaluations_total": "Integrand evaluations of the quad integrator",
+    "mmr_grid_points_total": "Grid points evaluated by the grid integrator",
+    "mmr_laplace_fallbacks_total": "Games whose posterior was too skewed for the laplace integrator",
+    "mmr_games_total": "Games rated or balanced",
+    "mmr_predictions_total": "Games whose win probabilities were predicted",
+    "mmr_balance_superset_games": "Games in the superset of a game mode",
+    "mmr_balance_candidate_games": "Games satisfying the team constraints of the last request of a game mode",
+    "mmr_balance_constraints_cache_hits_total": "Constraint sets found in the cache of a worker",
+    "mmr_balance_constraints_cache_misses_total": "Constraint sets indexed by a worker",
+    "mmr_rating_cache_hits_total": "Rating results found in the rating cache",
+    "mmr_rating_cache_misses_total": "Rating results missing from the rating cache",
+    "mmr_rating_cache_size": "Rating results in the rating cache",
+}
+
+
+class Registry:
+    """Counters, gauges and histograms, keyed by name and labels."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def set_total(self, name, value, **labels):
+        """Sets a counter kept elsewhere (e.g. the hits of a cache)."""
+        with self._lock:
+            self._counters[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for b, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][b] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        """All the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for kind, values in (("counter", self._counters), ("gauge", self._gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.extend(_header(name, kind))
+                    for (metric, labels), value in sorted(values.items()):
+                        if metric == name:
+                            lines.append("{}{} {}".format(name, _labels(labels), _number(value)))
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.extend(_header(name, "histogram"))
+                for (metric, labels), (buckets, total, count) in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, bucket in zip(self.buckets, buckets):
+                        lines.append("{}_bucket{} {}".format(name, _labels(labels + (("le", _number(bound)),)),
+                                                             bucket))
+                    lines.append("{}_bucket{} {}".format(name, _labels(labels + (("le", "+Inf"),)), count))
+                    lines.append("{}_sum{} {}".format(name, _labels(labels), _number(total)))
+                    lines.append("{}_count{} {}".format(name, _labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+
+def _header(name, kind):
+    lines = ["# HELP {} {}".format(name, HELP[name])] if name in HELP else []
+    return lines + ["# TYPE {} {}".format(name, kind)]
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join('{}="{}"'.format(k, v) for (k, _), v in zip(labels, escaped)) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+
+# stats being collected by call_collecting() in the current thread
+_local = threading.local()
+
+
+class _Timer:
+    __slots__ = ("stage", "stats", "start")
+
+    def __init__(self, stage, stats):
+        self.stage = stage
+        self.stats = stats
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        stages = self.stats["stages"]
+        stages[self.stage] = stages.get(self.stage, 0.0) + time.perf_counter() - self.start
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+def timer(stage):
+    """Context manager adding the time spent in it to the stage, when stats are being collected."""
+    stats = getattr(_local, "stats", None)
+    if stats is None:
+        return _NO_TIMER
+    return _Timer(stage, stats)
+
+
+def count(name, value=1):
+    """Adds value to the counter name of the stats being collected, if any."""
+    stats = getattr(_local, "stats", None)
+    if stats is not None:
+        stats["counts"][name] = stats["counts"].get(name, 0) + value
+
+
+def gauge(name, value):
+    """Sets the gauge name of the stats being collected, if any."""
+    stats = getattr(_local, "stats", None)
+    if stats is not None:
+        stats["gauges"][name] = value
+
+
+@contextmanager
+def collecting():
+    """Collects what timer(), count() and gauge() report in this thread into the dict it yields."""
+    previous = getattr(_local, "stats", None)
+    _local.stats = {"stages": {}, "counts": {}, "gauges": {}}
+    try:
+        yield _local.stats
+    finally:
+        _local.stats = previous
+
+
+def call_collecting(fn, submitted_at, *args, **kwargs):
+    """Runs fn(*args, **kwargs) collecting its stats, for the worker pools.
+
+    Args:
+        submitted_at (float): time.time() when the job was submitted, to measure how long it waited.
+
+    Returns:
+        A tuple (result, stats), stats["queue_wait"] is the time waited in seconds.
+    """
+    queue_wait = max(time.time() - submitted_at, 0.0)
+    with collecting() as stats:
+        result = fn(*args, **kwargs)
+    stats["queue_wait"] = queue_wait
+    return result, stats
+
+
+def record(stats, pool=None, **labels):
+    """Records stats returned by call_collecting() with the given labels."""
+    if not enabled or not stats:
+        return
+    for stage, seconds in stats["stages"].items():
+        registry.observe("mmr_stage_seconds", seconds, stage=stage, **labels)
+    for name, value in stats["counts"].items():
+        registry.inc("mmr_{}_total".format(name), value, **labels)
+    for name, value in stats["gauges"].items():
+        registry.set("mmr_{}".format(name), value, **labels)
+    if "queue_wait" in stats:
+        registry.observe("mmr_queue_wait_seconds", stats["queue_wait"], pool=pool or "")
+
+
+def game_mode(num_players, num_teams):
+    """Game mode label of a game, e.g. "4v4" for 8 players in 2 teams."""
+    if num_teams <= 0 or num_players % num_teams:
+        return "{}p{}t".format(num_players, num_teams)
+    return "v".join([str(num_players // num_teams)] * num_teams)
+
+
+def render():
+    return registry.render()
@@ -0,0 +1,72 @@
+"""
+Bradley-Terry win probabilities of the teams of a game, shared by the balancer, the rating posterior and /mmr/predict.
+
+Every function works on stacked games: ratings and rds of shape (..., N) with one game of N players per row,
+players ordered by team (N / T consecutive players per team), and returns arrays over the same leading axes.
+A team's rating is the geometric mean of its players' ratings, computed through the mean of their logs. The
+game's scale is C_SD times the collective deviation of the game, where each player's deviation is inflated by
+BETA, the performance uncertainty. The strength of team t is then u_t = P * R_t / scale, and its win probability
+is the softmax of the strengths.
+
+Examples:
+    ```python
+    odds = win_probabilities(np.array([[1500, 1400, 1300, 1200]]), np.array([[90] * 4]), 2)
+    fairness(odds)  # max(odds) - min(odds) of each game
+    ```
+"""
+import numpy as np
+
+from common.constants import C_SD, BETA
+
+
+def game_scale(rds, beta=BETA):
+    """C_SD * sqrt(sum(rds ** 2) + N * beta ** 2) of each game, of shape (...)."""
+    rds = np.asarray(rds, dtype=float)
+    return C_SD * np.sqrt(np.sum(np.square(rds), axis=-1) + rds.shape[-1] * beta ** 2)
+
+
+def team_ratings(log_ratings, num_teams):
+    """Geometric mean of the ratings of each team from the log ratings of the players, of shape (..., T)."""
+    num_players_per_team = log_ratings.shape[-1] // num_teams
+    return np.exp(np.sum(log_ratings.reshape(log_ratings.shape[:-1] + (num_teams, num_players_per_team)),
+                         axis=-1) / num_players_per_team)
+
+
+def team_strengths(log_ratings, scale, num_teams):
+    """Bradley-Terry strength u_t = P * R_t / scale of each team, of shape (..., T).
+
+    Args:
+        log_ratings: log ratings of the players, of shape (..., N), -inf for a rating of 0.
+        scale: game_scale() of each game, broadcast against the leading axes of log_ratings.
+        num_teams (int): Number of teams T of the games.
+    """
+    num_players_per_team = log_ratings.shape[-1] // num_teams
+    return num_players_per_team * team_ratings(log_ratings, num_teams) / np.asarray(scale)[..., None]
+
+
+def softmax(strengths):
+    """Win probabilities from the team strengths, shifted by the strongest team so that they never overflow."""
+    odds = np.exp(strengths - np.max(strengths, axis=-1, keepdims=True))
+    return odds / np.sum(odds, axis=-1, keepdims=True)
+
+
+def win_probabilities(ratings, rds, num_teams, beta=BETA):
+    """Win probability of each team of each game, of shape (..., T).
+
+    Args:
+        ratings: ratings of the players, of shape (..., N), clamped at 0.
+        rds: rating deviations of the players, of shape (..., N).
+        num_teams (int): Number of teams T of the games, which must divide N.
+        beta (float): Performance uncertainty.
+    """
+    ratings = np.asarray(ratings, dtype=float)
+    if ratings.shape[-1] % num_teams:
+        raise ValueError("{} players do not split in {} teams".format(ratings.shape[-1], num_teams))
+    with np.errstate(divide="ignore"):
+        log_ratings = np.log(np.maximum(ratings, 0))
+    return softmax(team_strengths(log_ratings, game_scale(rds, beta), num_teams))
+
+
+def fairness(odds):
+    """max(odds) - min(odds) of each game, the balancer's measure of how unfair a game is."""
+    return np.max(odds, axis=-1) - np.min(odds, axis=-1)
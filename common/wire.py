@@ -0,0 +1,272 @@
+"""
+Binary wire format of the rating and balancing endpoints, for clients which already hold ratings in arrays.
+
+Requests sent with the content type WIRE_CONTENT_TYPE skip JSON parsing and pydantic validation: their body decodes
+straight into NumPy arrays (views of the body, without intermediate lists) and the answer is encoded in the same
+format. Any other content type goes through the usual JSON endpoint, which stays the default.
+
+All numbers are little-endian, strings are a uint16 byte length followed by UTF-8 bytes.
+    /mmr/update
+        request:  uint32 N, int32 winning_team, int32 number_of_teams, float64[N] ratings, float64[N] rds
+        response: uint32 N, float64[N] ratings, float64[N] rds
+    /mmr/update/batch
+        request:  uint32 number of games, followed by that many /mmr/update requests
+        response: uint32 number of games, followed by that many /mmr/update responses
+    /mmr/predict
+        request:  uint32 number of games, followed by for each game:
+                  uint32 N, int32 number_of_teams, float64[N] ratings, float64[N] rds
+        response: uint32 number of games, followed by for each game: uint32 T, float64[T] odds
+    /team/balance
+        request:  uint32 N, float64[N] ratings, float64[N] rds, float64 time_budget,
+                  string gamemode, string team_constraints (empty for none), string search (empty for the default)
+        response: uint32 N, uint8 exact, int32[N] teams
+
+Examples:
+    ```python
+    body = wire.encode_update_request(ratings, rds, winning_team=0, number_of_teams=2)
+    response = requests.post(url + "/mmr/update", data=body, headers={"Content-Type": wire.WIRE_CONTENT_TYPE})
+    ratings, rds = wire.decode_update_response(response.content)
+    ```
+"""
+import struct
+
+import numpy as np
+from fastapi import HTTPException
+from fastapi.routing import APIRoute
+from starlette.requests import Request
+from starlette.responses import Response
+
+WIRE_CONTENT_TYPE = "application/x-mmr-f64"
+
+_GAME = struct.Struct("<Iii")
+_PREDICTION = struct.Struct("<Ii")
+_COUNT = struct.Struct("<I")
+_STRING = struct.Struct("<H")
+_FLOAT = struct.Struct("<d")
+_EXACT = struct.Struct("<B")
+
+
+def _floats(body, offset, count):
+    if offset + 8 * count > len(body):
+        raise ValueError("Body too short")
+    return np.frombuffer(body, dtype="<f8", count=count, offset=offset), offset + 8 * count
+
+
+def _string(body, offset):
+    (length,) = _STRING.unpack_from(body, offset)
+    offset += _STRING.size
+    if offset + length > len(body):
+        raise ValueError("Body too short")
+    return bytes(body[offset:offset + length]).decode("utf-8"), offset + length
+
+
+def _decode_game(body, offset):
+    num_players, winning_team, number_of_teams = _GAME.unpack_from(body, offset)
+    ratings, offset = _floats(body, offset + _GAME.size, num_players)
+    rds, offset = _floats(body, offset, num_players)
+    return (ratings, rds, winning_team, number_of_teams), offset
+
+
+def _encode_ratings(ratings, rds):
+    ratings = np.asarray(ratings, dtype="<f8")
+    return _COUNT.pack(len(ratings)) + ratings.tobytes() + np.asarray(rds, dtype="<f8").tobytes()
+
+
+def _decode_ratings(body, offset):
+    (num_players,) = _COUNT.unpack_from(body, offset)
+    ratings, offset = _floats(body, offset + _COUNT.size, num_players)
+    rds, offset = _floats(body, offset, num_players)
+    return (ratings, rds), offset
+
+
+def _check_end(body, offset):
+    if offset != len(body):
+        raise ValueError("{} unexpected bytes after the body".format(len(body) - offset))
+
+
+def encode_update_request(ratings, rds, winning_team, number_of_teams):
+    ratings = np.asarray(ratings, dtype="<f8")
+    return _GAME.pack(len(ratings), winning_team, number_of_teams) + ratings.tobytes() + np.asarray(
+        rds, dtype="<f8").tobytes()
+
+
+def decode_update_request(body):
+    """Returns (ratings, rds, winning_team, number_of_teams)."""
+    game, offset = _decode_game(body, 0)
+    _check_end(body, offset)
+    return game
+
+
+def encode_update_response(result):
+    """Encodes an UpdateMmrResponseBody (or a (ratings, rds) tuple)."""
+    if isinstance(result, tuple):
+        return _encode_ratings(*result)
+    return _encode_ratings(result.ratings_list, result.rds_list)
+
+
+def decode_update_response(body):
+    """Returns (ratings, rds)."""
+    result, offset = _decode_ratings(body, 0)
+    _check_end(body, offset)
+    return result
+
+
+def encode_batch_request(games):
+    return _COUNT.pack(len(games)) + b"".join(encode_update_request(*game) for game in games)
+
+
+def decode_batch_request(body):
+    """Returns a list of (ratings, rds, winning_team, number_of_teams)."""
+    (num_games,) = _COUNT.unpack_from(body, 0)
+    offset = _COUNT.size
+    games = []
+    for _ in range(num_games):
+        game, offset = _decode_game(body, offset)
+        games.append(game)
+    _check_end(body, offset)
+    return games
+
+
+def encode_batch_response(results):
+    """Encodes a list of UpdateMmrResponseBody."""
+    return _COUNT.pack(len(results)) + b"".join(encode_update_response(result) for result in results)
+
+
+def decode_batch_response(body):
+    """Returns a list of (ratings, rds)."""
+    (num_games,) = _COUNT.unpack_from(body, 0)
+    offset = _COUNT.size
+    results = []
+    for _ in range(num_games):
+        result, offset = _decode_ratings(body, offset)
+        results.append(result)
+    _check_end(body, offset)
+    return results
+
+
+def encode_predict_request(games):
+    """Encodes a list of (ratings, rds, number_of_teams)."""
+    parts = [_COUNT.pack(len(games))]
+    for ratings, rds, number_of_teams in games:
+        ratings = np.asarray(ratings, dtype="<f8")
+        parts += [_PREDICTION.pack(len(ratings), number_of_teams), ratings.tobytes(),
+                  np.asarray(rds, dtype="<f8").tobytes()]
+    return b"".join(parts)
+
+
+def decode_predict_request(body):
+    """Returns a list of (ratings, rds, number_of_teams)."""
+    (num_games,) = _COUNT.unpack_from(body, 0)
+    offset = _COUNT.size
+    games = []
+    for _ in range(num_games):
+        num_players, number_of_teams = _PREDICTION.unpack_from(body, offset)
+        ratings, offset = _floats(body, offset + _PREDICTION.size, num_players)
+        rds, offset = _floats(body, offset, num_players)
+        games.append((ratings, rds, number_of_teams))
+    _check_end(body, offset)
+    return games
+
+
+def encode_predict_response(odds):
+    """Encodes the win probabilities of the teams of each game."""
+    parts = [_COUNT.pack(len(odds))]
+    for game_odds in odds:
+        game_odds = np.asarray(game_odds, dtype="<f8")
+        parts += [_COUNT.pack(len(game_odds)), game_odds.tobytes()]
+    return b"".join(parts)
+
+
+def decode_predict_response(body):
+    """Returns a list with the array of win probabilities of the teams of each game."""
+    (num_games,) = _COUNT.unpack_from(body, 0)
+    offset = _COUNT.size
+    odds = []
+    for _ in range(num_games):
+        (num_teams,) = _COUNT.unpack_from(body, offset)
+        game_odds, offset = _floats(body, offset + _COUNT.size, num_teams)
+        odds.append(game_odds)
+    _check_end(body, offset)
+    return odds
+
+
+def encode_balance_request(ratings, rds, gamemode, team_constraints=None, search="", time_budget=1.0):
+    ratings = np.asarray(ratings, dtype="<f8")
+    strings = b"".join(_STRING.pack(len(s)) + s for s in (
+        gamemode.encode("utf-8"), (team_constraints or "").encode("utf-8"), (search or "").encode("utf-8")))
+    return _COUNT.pack(len(ratings)) + ratings.tobytes() + np.asarray(rds, dtype="<f8").tobytes() + _FLOAT.pack(
+        time_budget) + strings
+
+
+def decode_balance_request(body):
+    """Returns (ratings, rds, gamemode, team_constraints, search, time_budget), with None for empty strings."""
+    (ratings, rds), offset = _decode_ratings(body, 0)
+    (time_budget,) = _FLOAT.unpack_from(body, offset)
+    gamemode, offset = _string(body, offset + _FLOAT.size)
+    team_constraints, offset = _string(body, offset)
+    search, offset = _string(body, offset)
+    _check_end(body, offset)
+    return ratings, rds, gamemode, team_constraints or None, search or None, time_budget
+
+
+def encode_balance_response(result):
+    """Encodes a BalanceTeamResponseBody."""
+    teams = np.asarray(result.teams, dtype="<i4")
+    return _COUNT.pack(len(teams)) + _EXACT.pack(bool(result.exact)) + teams.tobytes()
+
+
+def decode_balance_response(body):
+    """Returns (teams, exact)."""
+    (num_players,) = _COUNT.unpack_from(body, 0)
+    (exact,) = _EXACT.unpack_from(body, _COUNT.size)
+    offset = _COUNT.size + _EXACT.size
+    if offset + 4 * num_players != len(body):
+        raise ValueError("Body does not hold {} teams".format(num_players))
+    return np.frombuffer(body, dtype="<i4", count=num_players, offset=offset), bool(exact)
+
+
+def accepts_wire(decode, handler, encode):
+    """Marks an endpoint of a WireRoute as also answering WIRE_CONTENT_TYPE requests:
+    the body goes through decode, the resulting arguments to the coroutine handler and its result through encode.
+    """
+
+    def mark(endpoint):
+        endpoint.wire = (decode, handler, encode)
+        return endpoint
+
+    return mark
+
+
+class WireRoute(APIRoute):
+    """
+    Route answering WIRE_CONTENT_TYPE requests of endpoints marked by accepts_wire() without going through JSON.
+
+    Examples:
+        ```python
+        app.router.route_class = WireRoute
+
+        @app.post("/mmr/update")
+        @accepts_wire(decode_update_request, rate_game, encode_update_response)
+        async def update_mmr(body: UpdateMmrRequestBody) -> UpdateMmrResponseBody:
+            ...
+        ```
+    """
+
+    def get_route_handler(self):
+        json_handler = super().get_route_handler()
+        wire = getattr(self.endpoint, "wire", None)
+        if wire is None:
+            return json_handler
+        decode, handler, encode = wire
+
+        async def route_handler(request: Request) -> Response:
+            if request.headers.get("content-type", "").split(";")[0].strip() != WIRE_CONTENT_TYPE:
+                return await json_handler(request)
+            body = await request.body()
+            try:
+                args = decode(body)
+            except (ValueError, struct.error, UnicodeDecodeError) as e:
+                raise HTTPException(status_code=400, detail="Invalid {} body: {}".format(WIRE_CONTENT_TYPE, e))
+            return Response(encode(await handler(*args)), media_type=WIRE_CONTENT_TYPE)
+
+        return route_handler
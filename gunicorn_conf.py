@@ -0,0 +1,49 @@
+"""
+Gunicorn settings which build the balancing state once in the master and share it with every worker.
+
+The master publishes the state of WARMUP_GAME_MODES in shared memory before forking the workers (see
+teambalance.shared), which attach it read-only: the memory of the balancer and its warm-up do not grow with the
+number of workers. The master removes the state on exit, and the files left by masters which crashed when it
+starts.
+
+Examples:
+    ```
+    gunicorn -c gunicorn_conf.py main:app
+    ```
+"""
+import logging
+import os
+
+from teambalance.balance import Balance
+from teambalance import shared
+
+logger = logging.getLogger(__name__)
+
+bind = os.environ.get("BIND", "0.0.0.0:80")
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+# the asyncio loop and h11 of uvicorn, UvicornWorker needs uvloop and httptools which are not installed
+worker_class = "uvicorn.workers.UvicornH11Worker"
+# the workers import main themselves, after the master published the state
+preload_app = False
+
+_state = None
+
+
+def on_starting(server):
+    global _state
+    for path in shared.remove_stale():
+        server.log.info("Removed the stale balancing state %s", path)
+    try:
+        _state = shared.publish(Balance(superset_dir=os.environ.get("BALANCE_SUPERSET_DIR")),
+                                shared.warmup_game_modes())
+    except Exception:
+        logger.exception("Could not publish the balancing state, every worker builds its own")
+        return
+    os.environ["BALANCE_SHARED_STATE"] = _state.path
+    server.log.info("Published the balancing state of %s in %s (%d bytes)", _state.game_modes(), _state.path,
+                    _state.nbytes)
+
+
+def on_exit(server):
+    if _state is not None:
+        _state.unlink()
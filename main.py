@@ -1,39 +1,362 @@
+import logging
+import os
+import threading
+import time
+
 import numpy as np
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 
-from mmr.bayesian_rating_w3c import UpdateMmrRequestBody, update_after_game, UpdateMmrResponseBody
-from teambalance.balance import BalanceTeamResponseBody, BalanceTeamRequestBody, Balance
+from common import metrics, wire
+from common.executor import WorkerPool
+from mmr.cache import RatingCache
+from mmr.bayesian_rating_w3c import UpdateMmrRequestBody, update_after_game, UpdateMmrResponseBody, \
+    UpdateMmrBatchRequestBody, UpdateMmrBatchResponseBody, update_after_games, clamp_inputs, PredictRequestBody, \
+    PredictResponseBody, predict_games, check_games, INTEGRATORS
+from teambalance.balance import BalanceTeamResponseBody, BalanceTeamRequestBody, Balance, BalanceTopRequestBody, \
+    BalanceTopResponseBody, RankedGameBody, AUTO_EXHAUSTIVE_MAX_GAMES, BalancePoolRequestBody, BalancePoolResponseBody, \
+    LobbyBody, POOL_OBJECTIVES
+from teambalance import shared
 
 app = FastAPI()
+app.router.route_class = wire.WireRoute
+logger = logging.getLogger(__name__)
+
+# supersets are memory-mapped from BALANCE_SUPERSET_DIR when it is set, so workers share them
+balance = Balance(superset_dir=os.environ.get("BALANCE_SUPERSET_DIR"),
+                  constraints_cache_size=int(os.environ.get("BALANCE_CONSTRAINTS_CACHE_SIZE", 256)))
+
+# balancing state published by the gunicorn master (see gunicorn_conf.py), shared read-only by every worker and
+# process of the pools instead of being built in each of them
+shared_balance_state = None
+if os.environ.get("BALANCE_SHARED_STATE"):
+    try:
+        shared_balance_state = shared.attach(os.environ["BALANCE_SHARED_STATE"])
+        logger.info("Attached the balancing state of %s", shared_balance_state.load_into(balance))
+    except Exception:
+        logger.exception("Could not attach the balancing state %s, building it in this process",
+                         os.environ["BALANCE_SHARED_STATE"])
+
+# game modes prepared before the service reports ready on /ready, comma separated, empty to skip the warm-up
+WARMUP_GAME_MODES = shared.warmup_game_modes()
+
+# options of every rating update: RATING_INTEGRATOR="laplace" integrates the rating deviations on a small grid
+# around each updated rating (several times faster on batches, see rds_laplace) and RATING_TOL sets the
+# convergence tolerance of the solvers (their own defaults when unset)
+RATING_OPTIONS = dict(integrator=os.environ.get("RATING_INTEGRATOR", "grid"),
+                      tol=float(os.environ["RATING_TOL"]) if os.environ.get("RATING_TOL") else None)
+if RATING_OPTIONS["integrator"] not in INTEGRATORS:
+    raise ValueError("Unknown RATING_INTEGRATOR '{}', expected one of {}".format(RATING_OPTIONS["integrator"],
+                                                                              INTEGRATORS))
+
+# warm-up state reported by /ready, game_modes has the seconds each game mode took
+readiness = {"ready": False, "game_modes": {}}
+
+
+def warm_up_balance():
+    # builds the supersets and constraint sets of the game modes in this process
+    for game_mode in WARMUP_GAME_MODES:
+        start = time.perf_counter()
+        try:
+            constraint_sets = balance.warm_up(game_mode)
+        except Exception:
+            logger.exception("Could not warm up game mode %s", game_mode)
+            continue
+        elapsed = time.perf_counter() - start
+        readiness["game_modes"][game_mode] = readiness["game_modes"].get(game_mode, 0.0) + elapsed
+        logger.info("Warmed up balancing %s in %.3fs (%d constraint sets)", game_mode, elapsed, constraint_sets)
+
+
+def warm_up_rating():
+    # rates a game of each shape once, which loads scipy and fills the caches of numpy on the rating path
+    shapes = set()
+    for game_mode in WARMUP_GAME_MODES:
+        try:
+            shapes.add(balance.parse_game_mode(game_mode))
+        except Exception:
+            continue
+    for num_teams, num_players_per_team in sorted(shapes):
+        start = time.perf_counter()
+        num_players = num_teams * num_players_per_team
+        update_after_game([1500.0] * num_players, [350.0] * num_players, 0, num_teams, **RATING_OPTIONS)
+        update_after_games([([1500.0] * num_players, [350.0] * num_players, t, num_teams) for t in range(num_teams)],
+                           **RATING_OPTIONS)
+        game_mode = "v".join([str(num_players_per_team)] * num_teams)
+        elapsed = time.perf_counter() - start
+        readiness["game_modes"][game_mode] = readiness["game_modes"].get(game_mode, 0.0) + elapsed
+        logger.info("Warmed up rating %s in %.3fs", game_mode, elapsed)
+
+
+# rating and balancing run in separate pools so that cheap rating updates
+# never queue behind heavy balancing requests (see WorkerPool.from_env for the settings),
+# processes of the pools warm up when they start
+rating_pool = WorkerPool.from_env("RATING_POOL", initializer=warm_up_rating)
+balance_pool = WorkerPool.from_env("BALANCE_POOL", initializer=warm_up_balance)
+
+# optional cache of rating results, see RatingCache.from_env for the settings
+rating_cache = RatingCache.from_env(RATING_OPTIONS)
+
+
+def warm_up():
+    start = time.perf_counter()
+    warm_up_balance()
+    warm_up_rating()
+    # the pool workers start (and warm up) now rather than on the first requests, /ready waits for them
+    for pool in (rating_pool, balance_pool):
+        try:
+            workers = pool.start()
+        except Exception:
+            logger.exception("Could not start the workers of %s", pool.name)
+            return
+        logger.info("Started %d workers of %s", workers, pool.name)
+    readiness["ready"] = True
+    logger.info("Warmed up in %.3fs", time.perf_counter() - start)
+
+
+@app.on_event("startup")
+def start_warm_up():
+    # the warm-up runs in the background so that the service answers /ready (with a 503) meanwhile
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+
+@app.get("/ready")
+def ready():
+    return JSONResponse(readiness, status_code=200 if readiness["ready"] else 503)
+
+
+@app.on_event("shutdown")
+def shutdown_pools():
+    rating_pool.shutdown()
+    balance_pool.shutdown()
+
+
+def search_best_game(ratings_list, rds_list, game_mode, team_constraints, search, time_budget):
+    # uses the Balance of the worker it runs in, which keeps its own supersets between requests
+    before = balance.constraints_cache_info()
+    result = balance.search_best_game(np.array(ratings_list), np.array(rds_list), game_mode, team_constraints,
+                                      search, time_budget)
+    after = balance.constraints_cache_info()
+    metrics.count("balance_constraints_cache_hits", after["hits"] - before["hits"])
+    metrics.count("balance_constraints_cache_misses", after["misses"] - before["misses"])
+    return result
+
+
+def top_games(ratings_list, rds_list, game_mode, team_constraints, k, threshold):
+    return balance.top_games(np.array(ratings_list), np.array(rds_list), game_mode, team_constraints, k, threshold)
+
+
+def find_best_lobbies(ratings_list, rds_list, game_mode, objective, time_budget):
+    return balance.find_best_lobbies(np.array(ratings_list), np.array(rds_list), game_mode, objective, time_budget)
+
 
-balance = Balance()
+# paths of the routes of the app, set on the first request once every route is registered
+_route_paths = None
 
+if metrics.enabled:
+    @app.middleware("http")
+    async def time_requests(request: Request, call_next):
+        start = time.perf_counter()
+        response = await call_next(request)
+        # unknown paths share one label so that they cannot blow up the number of series
+        global _route_paths
+        if _route_paths is None:
+            _route_paths = frozenset(route.path for route in app.routes)
+        path = request.url.path if request.url.path in _route_paths else "other"
+        metrics.registry.observe("mmr_http_request_seconds", time.perf_counter() - start, path=path,
+                                 method=request.method, status=response.status_code)
+        return response
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    def get_metrics():
+        for pool in (rating_pool, balance_pool):
+            metrics.registry.set("mmr_pool_pending", pool.pending, pool=pool.name)
+        if rating_cache is not None:
+            info = rating_cache.info()
+            metrics.registry.set_total("mmr_rating_cache_hits_total", info["hits"])
+            metrics.registry.set_total("mmr_rating_cache_misses_total", info["misses"])
+            metrics.registry.set("mmr_rating_cache_size", info["size"])
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+async def rate_game(ratings_list, rds_list, winning_team, number_of_teams):
+    ratings_list, rds_list = clamp_inputs(ratings_list, rds_list)
+    labels = dict(game_mode=metrics.game_mode(len(ratings_list), number_of_teams), teams=number_of_teams)
+    if rating_cache is None:
+        result, stats = await rating_pool.run_with_stats(update_after_game, ratings_list, rds_list, winning_team,
+                                                         number_of_teams, **RATING_OPTIONS)
+        metrics.record(stats, pool=rating_pool.name, **labels)
+        return result
+    key, ratings_list, rds_list = rating_cache.quantize(ratings_list, rds_list, winning_team, number_of_teams)
+    result = rating_cache.get(key)
+    if result is None:
+        result, stats = await rating_pool.run_with_stats(update_after_game, ratings_list, rds_list, winning_team,
+                                                         number_of_teams, **RATING_OPTIONS)
+        metrics.record(stats, pool=rating_pool.name, **labels)
+        rating_cache.put(key, result)
+    return result
+
+
+def batch_labels(shapes):
+    # metric labels of a batch of games of (number of players, number of teams) shapes
+    game_modes, teams = set(shapes), {number_of_teams for _, number_of_teams in shapes}
+    return dict(game_mode=metrics.game_mode(*game_modes.pop()) if len(game_modes) == 1 else "mixed",
+                teams=teams.pop() if len(teams) == 1 else "mixed")
+
+
+async def rate_games(games):
+    # games which cannot be rated are answered with a 400 naming the first of them, before any game is rated
+    try:
+        check_games(games)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    labels = batch_labels([(len(game[0]), game[3]) for game in games])
+    if rating_cache is None:
+        results, stats = await rating_pool.run_with_stats(update_after_games, games, **RATING_OPTIONS)
+        metrics.record(stats, pool=rating_pool.name, **labels)
+        return results
+    # only the games missing from the cache are rated, with their clamped and quantized inputs
+    results = [None] * len(games)
+    keys, missing = {}, []
+    for g, (ratings_list, rds_list, winning_team, number_of_teams) in enumerate(games):
+        ratings_list, rds_list = clamp_inputs(ratings_list, rds_list)
+        key, ratings_list, rds_list = rating_cache.quantize(ratings_list, rds_list, winning_team, number_of_teams)
+        results[g] = rating_cache.get(key)
+        if results[g] is None:
+            keys[g] = key
+            missing.append((ratings_list, rds_list, winning_team, number_of_teams))
+    if missing:
+        rated, stats = await rating_pool.run_with_stats(update_after_games, missing, clamp=False, **RATING_OPTIONS)
+        metrics.record(stats, pool=rating_pool.name, **labels)
+        for g, result in zip(keys, rated):
+            results[g] = result
+            rating_cache.put(keys[g], result)
+    return results
+
+
+async def predict(games):
+    # the odds are cheap to compute, so they are computed here rather than in a worker pool
+    try:
+        with metrics.collecting() as stats:
+            odds = predict_games(games)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if games:
+        metrics.record(stats, **batch_labels([(len(game[0]), game[2]) for game in games]))
+    return odds
+
+
+def check_team_constraints(game_mode, num_players, team_constraints):
+    # games which cannot be played are answered with a 400 rather than failing in the pool
+    try:
+        balance.check_team_constraints(game_mode, num_players, team_constraints)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def check_search(game_mode, search):
+    # unknown search modes, and exhaustive searches of game modes too large to enumerate, are answered with a 400
+    try:
+        balance.check_search(game_mode, search)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def balance_labels(game_mode):
+    # metric labels of a balanced game mode, from the parsed mode so that its spellings share their series
+    num_teams, num_players_per_team = balance.parse_game_mode(game_mode)
+    return dict(game_mode=metrics.game_mode(num_teams * num_players_per_team, num_teams), teams=num_teams)
+
+
+async def balance_game(ratings_list, rds_list, gamemode, team_constraints=None, search=None, time_budget=1.0):
+    ratings = np.maximum(np.asarray(ratings_list, dtype=float), 0)
+    rds = np.maximum(np.asarray(rds_list, dtype=float), 60.25)
+    team_constraints = team_constraints or "+".join(["1"] * len(ratings))
+    search = search or "auto"
+    check_team_constraints(gamemode, len(ratings), team_constraints)
+    check_search(gamemode, search)
+    result, stats = await balance_pool.run_with_stats(search_best_game, ratings, rds, gamemode, team_constraints,
+                                                      search, time_budget)
+    metrics.record(stats, pool=balance_pool.name, **balance_labels(gamemode))
+    return BalanceTeamResponseBody(teams=result.teams, exact=result.exact)
+
+
+# the endpoints below also answer requests in the binary format of common.wire
 @app.post("/mmr/update")
+@wire.accepts_wire(wire.decode_update_request, rate_game, wire.encode_update_response)
 async def update_mmr(body: UpdateMmrRequestBody) -> UpdateMmrResponseBody:
-    for i, rd in enumerate(body.rds_list):
-        if rd < 80:
-            body.rds_list[i] *= 80/60.25
-    
-    for i, rating in enumerate(body.ratings_list):
-        if rating < 0:
-            body.ratings_list[i] = 0
+    return await rate_game(body.ratings_list, body.rds_list, body.winning_team, body.number_of_teams)
+
+
+async def _rate_games(*games):
+    return await rate_games(list(games))
 
-    return update_after_game(body.ratings_list, body.rds_list, body.winning_team, body.number_of_teams)
+
+@app.post("/mmr/update/batch")
+@wire.accepts_wire(wire.decode_batch_request, _rate_games, wire.encode_batch_response)
+async def update_mmr_batch(body: UpdateMmrBatchRequestBody) -> UpdateMmrBatchResponseBody:
+    games = [(game.ratings_list, game.rds_list, game.winning_team, game.number_of_teams) for game in body.games]
+    return UpdateMmrBatchResponseBody(games=await rate_games(games))
+
+
+async def _predict(*games):
+    return await predict(list(games))
+
+
+@app.post("/mmr/predict")
+@wire.accepts_wire(wire.decode_predict_request, _predict, wire.encode_predict_response)
+async def predict_odds(body: PredictRequestBody) -> PredictResponseBody:
+    odds = await predict([(game.ratings_list, game.rds_list, game.number_of_teams) for game in body.games])
+    return PredictResponseBody(odds=[game_odds.tolist() for game_odds in odds])
 
 
 @app.post("/team/balance")
+@wire.accepts_wire(wire.decode_balance_request, balance_game, wire.encode_balance_response)
 async def balance_teams(body: BalanceTeamRequestBody) -> BalanceTeamResponseBody:
-    for i, rd in enumerate(body.rds_list):
-        if rd < 60.25:
-            body.rds_list[i] = 60.25
+    return await balance_game(body.ratings_list, body.rds_list, body.gamemode, body.team_constraints, body.search,
+                              body.time_budget)
+
+
+@app.post("/team/balance/top")
+async def balance_teams_top(body: BalanceTopRequestBody) -> BalanceTopResponseBody:
+    if body.k < 1:
+        raise HTTPException(status_code=400, detail="k must be at least 1")
+    if balance.num_games(body.gamemode) > AUTO_EXHAUSTIVE_MAX_GAMES:
+        raise HTTPException(status_code=400, detail="Game mode '{}' has too many games to rank them".format(
+            body.gamemode))
+    ratings = np.maximum(np.asarray(body.ratings_list, dtype=float), 0)
+    rds = np.maximum(np.asarray(body.rds_list, dtype=float), 60.25)
+    team_constraints = body.team_constraints or "+".join(["1"] * len(ratings))
+    check_team_constraints(body.gamemode, len(ratings), team_constraints)
+    (games, exact), stats = await balance_pool.run_with_stats(top_games, ratings, rds, body.gamemode,
+                                                              team_constraints, body.k, body.threshold)
+    metrics.record(stats, pool=balance_pool.name, **balance_labels(body.gamemode))
+    return BalanceTopResponseBody(games=[RankedGameBody(**game._asdict()) for game in games], exact=exact)
 
-    for i, rating in enumerate(body.ratings_list):
-        if rating < 0:
-            body.ratings_list[i] = 0
 
-    return balance.find_best_game(np.array(body.ratings_list), np.array(body.rds_list), body.gamemode)
+@app.post("/team/balance/pool")
+async def balance_teams_pool(body: BalancePoolRequestBody) -> BalancePoolResponseBody:
+    num_teams, num_players_per_team = balance.parse_game_mode(body.gamemode)
+    num_players = num_teams * num_players_per_team
+    if not body.ratings_list or len(body.ratings_list) % num_players or len(body.rds_list) != len(body.ratings_list):
+        raise HTTPException(status_code=400, detail="The pool does not split in lobbies of {} players".format(
+            num_players))
+    if body.objective not in POOL_OBJECTIVES:
+        raise HTTPException(status_code=400, detail="Unknown objective '{}', expected one of {}".format(
+            body.objective, POOL_OBJECTIVES))
+    if balance.num_games(body.gamemode) > AUTO_EXHAUSTIVE_MAX_GAMES:
+        raise HTTPException(status_code=400, detail="Game mode '{}' has too many games to balance lobbies".format(
+            body.gamemode))
+    ratings = np.maximum(np.asarray(body.ratings_list, dtype=float), 0)
+    rds = np.maximum(np.asarray(body.rds_list, dtype=float), 60.25)
+    lobbies, stats = await balance_pool.run_with_stats(find_best_lobbies, ratings, rds, body.gamemode, body.objective,
+                                                       body.time_budget)
+    metrics.record(stats, pool=balance_pool.name, **balance_labels(body.gamemode))
+    fairness = [lobby.fairness for lobby in lobbies]
+    return BalancePoolResponseBody(lobbies=[LobbyBody(**lobby._asdict()) for lobby in lobbies],
+                                   max_fairness=max(fairness), total_fairness=sum(fairness))
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     uvicorn.run(app, host="0.0.0.0", port=80)
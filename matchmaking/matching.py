@@ -0,0 +1,390 @@
+"""
+Maximum weight matching of a general graph, by Edmonds' blossom algorithm with dual variables in O(n^3).
+
+Pairing players is a matching in a graph which is not bipartite (anyone can play anyone), so the assignment
+solvers of SciPy do not apply: the odd cycles of the graph are shrunk into blossoms and expanded again as the
+search goes, while the dual variables prove the matching found is the heaviest one. Weights are integers, so that
+every step is exact and ties are settled the same way on every platform.
+
+This follows the implementation of Joris van Rantwijk (mwmatching.py, after Z. Galil, "Efficient algorithms for
+finding maximum matching in graphs", ACM Computing Surveys, 1986), without its consistency checks.
+
+Examples:
+    ```python
+    max_weight_matching(4, [(0, 1, 2), (1, 2, 8), (2, 3, 2)])  # [-1, 2, 1, -1]
+    max_weight_matching(4, [(0, 1, 2), (1, 2, 8), (2, 3, 2)], max_cardinality=True)  # [1, 0, 3, 2]
+    ```
+"""
+
+
+def max_weight_matching(num_vertices, edges, max_cardinality=False):
+    """Matching of the graph with the highest total weight.
+
+    Args:
+        num_vertices (int): Vertices of the graph, numbered from 0.
+        edges: (i, j, weight) of each edge, i != j, with an integer weight and at most one edge per pair.
+        max_cardinality (bool): Whether to find the heaviest of the matchings with the most edges instead.
+
+    Returns:
+        The vertex matched to each vertex, -1 for the vertices left unmatched.
+    """
+    if not edges:
+        return [-1] * num_vertices
+    num_edges = len(edges)
+    max_weight = max(0, max(weight for _, _, weight in edges))
+    # twice the weight of each edge, the slack of edge k being dualvar[i] + dualvar[j] - weight2[k]
+    weight2 = [2 * weight for _, _, weight in edges]
+    # endpoint[p]: vertex of the end p of edge p // 2, the other end being p ^ 1
+    endpoint = [edges[p // 2][p % 2] for p in range(2 * num_edges)]
+    # ends of the edges of each vertex, at the other vertex
+    neighbend = [[] for _ in range(num_vertices)]
+    for k, (i, j, _) in enumerate(edges):
+        neighbend[i].append(2 * k + 1)
+        neighbend[j].append(2 * k)
+    # mate[v]: end of the matched edge at the vertex matched to v, -1 if v is single
+    mate = [-1] * num_vertices
+    # vertices and blossoms (numbered from num_vertices) are labelled 0 (free), 1 (S) or 2 (T), labelend being the
+    # end of the edge through which they got their label
+    label = [0] * (2 * num_vertices)
+    labelend = [-1] * (2 * num_vertices)
+    # top-level blossom of each vertex
+    inblossom = list(range(num_vertices))
+    blossomparent = [-1] * (2 * num_vertices)
+    # sub-blossoms of each blossom around its cycle from the base, with the edge ends between them
+    blossomchilds = [None] * (2 * num_vertices)
+    blossombase = list(range(num_vertices)) + [-1] * num_vertices
+    blossomendps = [None] * (2 * num_vertices)
+    # least slack edge from each vertex or blossom to an S-blossom, and from each S-blossom to the others
+    bestedge = [-1] * (2 * num_vertices)
+    blossombestedges = [None] * (2 * num_vertices)
+    unusedblossoms = list(range(num_vertices, 2 * num_vertices))
+    # dual variables of the vertices then of the blossoms
+    dualvar = [max_weight] * num_vertices + [0] * num_vertices
+    # edges of zero slack, which the search may use
+    allowedge = [False] * num_edges
+    queue = []
+
+    def slack(k):
+        i, j, _ = edges[k]
+        return dualvar[i] + dualvar[j] - weight2[k]
+
+    def blossom_leaves(b):
+        if b < num_vertices:
+            yield b
+        else:
+            for t in blossomchilds[b]:
+                if t < num_vertices:
+                    yield t
+                else:
+                    yield from blossom_leaves(t)
+
+    def assign_label(w, t, p):
+        # labels w and its top-level blossom t (1: S, 2: T) through the edge end p, and the mate of a T-blossom S
+        b = inblossom[w]
+        label[w] = label[b] = t
+        labelend[w] = labelend[b] = p
+        bestedge[w] = bestedge[b] = -1
+        if t == 1:
+            queue.extend(blossom_leaves(b))
+        else:
+            base = blossombase[b]
+            assign_label(endpoint[mate[base]], 1, mate[base] ^ 1)
+
+    def scan_blossom(v, w):
+        # base of the new blossom closed by the edge between the S-vertices v and w, -1 for an augmenting path
+        path = []
+        base = -1
+        while v != -1 or w != -1:
+            b = inblossom[v]
+            if label[b] & 4:
+                base = blossombase[b]
+                break
+            path.append(b)
+            label[b] = 5
+            if labelend[b] == -1:
+                v = -1
+            else:
+                v = endpoint[labelend[b]]
+                b = inblossom[v]
+                v = endpoint[labelend[b]]
+            if w != -1:
+                v, w = w, v
+        for b in path:
+            label[b] = 1
+        return base
+
+    def add_blossom(base, k):
+        # shrinks the cycle closed by edge k through base into a new S-blossom
+        v, w, _ = edges[k]
+        bb = inblossom[base]
+        bv = inblossom[v]
+        bw = inblossom[w]
+        b = unusedblossoms.pop()
+        blossombase[b] = base
+        blossomparent[b] = -1
+        blossomparent[bb] = b
+        blossomchilds[b] = path = []
+        blossomendps[b] = endps = []
+        while bv != bb:
+            blossomparent[bv] = b
+            path.append(bv)
+            endps.append(labelend[bv])
+            v = endpoint[labelend[bv]]
+            bv = inblossom[v]
+        path.append(bb)
+        path.reverse()
+        endps.reverse()
+        endps.append(2 * k)
+        while bw != bb:
+            blossomparent[bw] = b
+            path.append(bw)
+            endps.append(labelend[bw] ^ 1)
+            w = endpoint[labelend[bw]]
+            bw = inblossom[w]
+        label[b] = 1
+        labelend[b] = labelend[bb]
+        dualvar[b] = 0
+        for v in blossom_leaves(b):
+            if label[inblossom[v]] == 2:
+                # the T-vertices of the cycle become S-vertices
+                queue.append(v)
+            inblossom[v] = b
+        # least slack edges from the new blossom to each other S-blossom
+        bestedgeto = [-1] * (2 * num_vertices)
+        for bv in path:
+            if blossombestedges[bv] is None:
+                nblists = [[p // 2 for p in neighbend[v]] for v in blossom_leaves(bv)]
+            else:
+                nblists = [blossombestedges[bv]]
+            for nblist in nblists:
+                for k in nblist:
+                    i, j, _ = edges[k]
+                    if inblossom[j] == b:
+                        i, j = j, i
+                    bj = inblossom[j]
+                    if bj != b and label[bj] == 1 and (bestedgeto[bj] == -1 or slack(k) < slack(bestedgeto[bj])):
+                        bestedgeto[bj] = k
+            blossombestedges[bv] = None
+            bestedge[bv] = -1
+        blossombestedges[b] = [k for k in bestedgeto if k != -1]
+        bestedge[b] = -1
+        for k in blossombestedges[b]:
+            if bestedge[b] == -1 or slack(k) < slack(bestedge[b]):
+                bestedge[b] = k
+
+    def expand_blossom(b, endstage):
+        # turns the sub-blossoms of b back into top-level blossoms
+        for s in blossomchilds[b]:
+            blossomparent[s] = -1
+            if s < num_vertices:
+                inblossom[s] = s
+            elif endstage and dualvar[s] == 0:
+                expand_blossom(s, endstage)
+            else:
+                for v in blossom_leaves(s):
+                    inblossom[v] = s
+        if not endstage and label[b] == 2:
+            # relabels the sub-blossoms on the even path from the entry child to the base
+            entrychild = inblossom[endpoint[labelend[b] ^ 1]]
+            j = blossomchilds[b].index(entrychild)
+            if j & 1:
+                j -= len(blossomchilds[b])
+                jstep = 1
+                endptrick = 0
+            else:
+                jstep = -1
+                endptrick = 1
+            p = labelend[b]
+            while j != 0:
+                label[endpoint[p ^ 1]] = 0
+                label[endpoint[blossomendps[b][j - endptrick] ^ endptrick ^ 1]] = 0
+                assign_label(endpoint[p ^ 1], 2, p)
+                allowedge[blossomendps[b][j - endptrick] // 2] = True
+                j += jstep
+                p = blossomendps[b][j - endptrick] ^ endptrick
+                allowedge[p // 2] = True
+                j += jstep
+            bv = blossomchilds[b][j]
+            label[endpoint[p ^ 1]] = label[bv] = 2
+            labelend[endpoint[p ^ 1]] = labelend[bv] = p
+            bestedge[bv] = -1
+            j += jstep
+            # the sub-blossoms of the odd path are free, unless one of their vertices was reached from outside
+            while blossomchilds[b][j] != entrychild:
+                bv = blossomchilds[b][j]
+                if label[bv] == 1:
+                    j += jstep
+                    continue
+                for v in blossom_leaves(bv):
+                    if label[v] != 0:
+                        break
+                if label[v] != 0:
+                    label[v] = 0
+                    label[endpoint[mate[blossombase[bv]]]] = 0
+                    assign_label(v, 2, labelend[v])
+                j += jstep
+        label[b] = labelend[b] = -1
+        blossomchilds[b] = blossomendps[b] = None
+        blossombase[b] = -1
+        blossombestedges[b] = None
+        bestedge[b] = -1
+        unusedblossoms.append(b)
+
+    def augment_blossom(b, v):
+        # swaps the matched and unmatched edges of the path from v to the base of b, making v its base
+        t = v
+        while blossomparent[t] != b:
+            t = blossomparent[t]
+        if t >= num_vertices:
+            augment_blossom(t, v)
+        i = j = blossomchilds[b].index(t)
+        if i & 1:
+            j -= len(blossomchilds[b])
+            jstep = 1
+            endptrick = 0
+        else:
+            jstep = -1
+            endptrick = 1
+        while j != 0:
+            j += jstep
+            t = blossomchilds[b][j]
+            p = blossomendps[b][j - endptrick] ^ endptrick
+            if t >= num_vertices:
+                augment_blossom(t, endpoint[p])
+            j += jstep
+            t = blossomchilds[b][j]
+            if t >= num_vertices:
+                augment_blossom(t, endpoint[p ^ 1])
+            mate[endpoint[p]] = p ^ 1
+            mate[endpoint[p ^ 1]] = p
+        blossomchilds[b] = blossomchilds[b][i:] + blossomchilds[b][:i]
+        blossomendps[b] = blossomendps[b][i:] + blossomendps[b][:i]
+        blossombase[b] = blossombase[blossomchilds[b][0]]
+
+    def augment_matching(k):
+        # swaps the matched and unmatched edges of the augmenting path through edge k
+        v, w, _ = edges[k]
+        for s, p in ((v, 2 * k + 1), (w, 2 * k)):
+            while True:
+                bs = inblossom[s]
+                if bs >= num_vertices:
+                    augment_blossom(bs, s)
+                mate[s] = p
+                if labelend[bs] == -1:
+                    # reached a single vertex
+                    break
+                t = endpoint[labelend[bs]]
+                bt = inblossom[t]
+                s = endpoint[labelend[bt]]
+                j = endpoint[labelend[bt] ^ 1]
+                if bt >= num_vertices:
+                    augment_blossom(bt, j)
+                mate[j] = labelend[bt]
+                p = labelend[bt] ^ 1
+
+    # each stage augments the matching by one edge, or proves it is the heaviest
+    for _ in range(num_vertices):
+        label[:] = [0] * (2 * num_vertices)
+        bestedge[:] = [-1] * (2 * num_vertices)
+        blossombestedges[num_vertices:] = [None] * num_vertices
+        allowedge[:] = [False] * num_edges
+        queue[:] = []
+        for v in range(num_vertices):
+            if mate[v] == -1 and label[inblossom[v]] == 0:
+                assign_label(v, 1, -1)
+        augmented = False
+        while True:
+            while queue and not augmented:
+                v = queue.pop()
+                bv, dv = inblossom[v], dualvar[v]
+                for p in neighbend[v]:
+                    k = p >> 1
+                    w = endpoint[p]
+                    if bv == inblossom[w]:
+                        continue
+                    if not allowedge[k]:
+                        # slack(k), inlined in the hottest loop
+                        kslack = dv + dualvar[w] - weight2[k]
+                        if kslack <= 0:
+                            allowedge[k] = True
+                    if allowedge[k]:
+                        if label[inblossom[w]] == 0:
+                            assign_label(w, 2, p ^ 1)
+                        elif label[inblossom[w]] == 1:
+                            base = scan_blossom(v, w)
+                            if base >= 0:
+                                add_blossom(base, k)
+                                bv = inblossom[v]
+                            else:
+                                augment_matching(k)
+                                augmented = True
+                                break
+                        elif label[w] == 0:
+                            # w is inside a T-blossom but not yet reached from outside it
+                            label[w] = 2
+                            labelend[w] = p ^ 1
+                    elif label[inblossom[w]] == 1:
+                        if bestedge[bv] == -1 or kslack < slack(bestedge[bv]):
+                            bestedge[bv] = k
+                    elif label[w] == 0:
+                        if bestedge[w] == -1 or kslack < slack(bestedge[w]):
+                            bestedge[w] = k
+            if augmented:
+                break
+            # no augmenting path with the edges allowed: updates the dual variables by the least delta which
+            # allows another edge, expands a T-blossom or ends the search
+            delta_type = -1
+            delta = delta_edge = delta_blossom = None
+            if not max_cardinality:
+                delta_type = 1
+                delta = min(dualvar[:num_vertices])
+            for v in range(num_vertices):
+                if label[inblossom[v]] == 0 and bestedge[v] != -1:
+                    d = slack(bestedge[v])
+                    if delta_type == -1 or d < delta:
+                        delta, delta_type, delta_edge = d, 2, bestedge[v]
+            for b in range(2 * num_vertices):
+                if blossomparent[b] == -1 and label[b] == 1 and bestedge[b] != -1:
+                    d = slack(bestedge[b]) // 2
+                    if delta_type == -1 or d < delta:
+                        delta, delta_type, delta_edge = d, 3, bestedge[b]
+            for b in range(num_vertices, 2 * num_vertices):
+                if blossombase[b] >= 0 and blossomparent[b] == -1 and label[b] == 2 and (
+                        delta_type == -1 or dualvar[b] < delta):
+                    delta, delta_type, delta_blossom = dualvar[b], 4, b
+            if delta_type == -1:
+                # no more edges to allow with max_cardinality: the matching has the most edges
+                delta_type = 1
+                delta = max(0, min(dualvar[:num_vertices]))
+            for v in range(num_vertices):
+                if label[inblossom[v]] == 1:
+                    dualvar[v] -= delta
+                elif label[inblossom[v]] == 2:
+                    dualvar[v] += delta
+            for b in range(num_vertices, 2 * num_vertices):
+                if blossombase[b] >= 0 and blossomparent[b] == -1:
+                    if label[b] == 1:
+                        dualvar[b] += delta
+                    elif label[b] == 2:
+                        dualvar[b] -= delta
+            if delta_type == 1:
+                break
+            elif delta_type == 2:
+                allowedge[delta_edge] = True
+                i, j, _ = edges[delta_edge]
+                if label[inblossom[i]] == 0:
+                    i, j = j, i
+                queue.append(i)
+            elif delta_type == 3:
+                allowedge[delta_edge] = True
+                i, j, _ = edges[delta_edge]
+                queue.append(i)
+            else:
+                expand_blossom(delta_blossom, False)
+        if not augmented:
+            break
+        # S-blossoms whose dual variable reached 0 are expanded for the next stage
+        for b in range(num_vertices, 2 * num_vertices):
+            if blossomparent[b] == -1 and blossombase[b] >= 0 and label[b] == 1 and dualvar[b] == 0:
+                expand_blossom(b, True)
+    return [endpoint[p] if p >= 0 else -1 for p in mate]
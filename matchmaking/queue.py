@@ -0,0 +1,229 @@
+"""
+Matches the 1v1 queue in one go: every waiting player against every other, instead of one pair at a time.
+
+The fairness of a pair is the balancer's max(odds) - min(odds) (see common.odds), which for two players is
+tanh(|r_a - r_b| / (2 * scale)), where scale is the game scale of the pair. A pair is acceptable when its
+fairness is at most the acceptable fairness of the player who waited longest: max_fairness, relaxed by
+relaxation per second waited (see acceptable_fairness).
+
+The match modes:
+    "full": the matching with the most acceptable pairs and then the lowest total fairness, exactly. The fairness
+        of all pairs of players is computed in blocks of rows (fairness_matrix) and the acceptable pairs are
+        matched by the blossom algorithm (see matchmaking.matching), in O(n^3).
+    "banded": an approximation in O(n * band) memory and time, for queues too large for the full mode: thousands
+        of players are matched in tens of ms. Players are first sorted by rating and paired with a neighbour in
+        that order: the pairing with the most acceptable pairs and then the lowest total fairness is found by
+        dynamic programming in O(n). The players it leaves out are paired with each other in unacceptable pairs.
+        Each pair then exchanges players with the band pairs above it in rating order while it lowers the total
+        cost, where an unacceptable pair costs more than any two acceptable ones, so that exchanges also match
+        players left out. Each exchange round scores the exchanges of every candidate pair of pairs at once, and
+        applies those which are the best of both their pairs.
+    "auto": full up to FULL_MAX_PLAYERS players, banded above.
+
+Examples:
+    ```python
+    matches = match_queue(ratings, rds, wait_times, max_fairness=0.2)
+    for (a, b), fairness in zip(matches.pairs, matches.fairness):
+        start_game(queue[a], queue[b])
+    ```
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from common.constants import C_SD, BETA
+from matchmaking.matching import max_weight_matching
+
+MATCH_MODES = ("full", "banded", "auto")
+
+# the "auto" mode matches queues of up to this many players exactly (~15-45ms for 64 players)
+FULL_MAX_PLAYERS = 64
+
+# rows of the fairness matrix computed at once
+BLOCK_SIZE = 256
+
+# cost of a pair which is not acceptable, above the cost of any two acceptable pairs (fairness is at most 1)
+_UNACCEPTABLE_COST = 2.0
+
+# integer weight of a fairness of 1 in the exact matching, which needs integer weights
+_WEIGHT_SCALE = 2 ** 32
+
+# pairs: (pairs x 2) queue indices of the matched players, fairness: fairness of each pair,
+# unmatched: queue indices of the players left in the queue
+QueueMatches = namedtuple("QueueMatches", ["pairs", "fairness", "unmatched"])
+
+
+def pair_fairness(ratings_a, rds_a, ratings_b, rds_b, beta=BETA):
+    """Fairness of the 1v1 games of a against b, broadcast like NumPy operators."""
+    scale = C_SD * np.sqrt(np.square(rds_a) + np.square(rds_b) + 2 * beta ** 2)
+    return np.tanh(np.abs(np.subtract(ratings_a, ratings_b)) / (2 * scale))
+
+
+def fairness_matrix(ratings, rds, block_size=BLOCK_SIZE, beta=BETA):
+    """Fairness of every pair of players (n x n), computed block_size rows at a time to stay in cache.
+
+    Returns:
+        The symmetric matrix of pair_fairness(), with 0 on the diagonal.
+    """
+    ratings = np.asarray(ratings, dtype=float)
+    rds_squared = np.square(np.asarray(rds, dtype=float)) + beta ** 2
+    out = np.empty((len(ratings), len(ratings)))
+    for start in range(0, len(ratings), block_size):
+        stop = min(start + block_size, len(ratings))
+        block = out[start:stop]
+        # tanh(|r_a - r_b| / (2 * C_SD * sqrt(rd_a ** 2 + rd_b ** 2 + 2 * beta ** 2))), without temporaries
+        np.subtract(ratings[start:stop, None], ratings[None, :], out=block)
+        np.abs(block, out=block)
+        scale = np.add(rds_squared[start:stop, None], rds_squared[None, :])
+        np.sqrt(scale, out=scale)
+        scale *= 2 * C_SD
+        np.divide(block, scale, out=block)
+        np.tanh(block, out=block)
+    return out
+
+
+def acceptable_fairness(wait_times, max_fairness=0.2, relaxation=0.005):
+    """Fairness each player accepts after waiting wait_times seconds, max_fairness + relaxation per second."""
+    return np.minimum(max_fairness + relaxation * np.asarray(wait_times, dtype=float), 1.0)
+
+
+def _pick_disjoint(first, second, score, size):
+    # indices of edges with a positive score picked like a greedy pass from the best edge would, in rounds
+    # keeping every edge left which is the best of both its ends (first and second, in range(size))
+    by_score = np.argsort(-score, kind="stable")
+    by_score = by_score[score[by_score] > 0]
+    first, second, rank = first[by_score], second[by_score], np.arange(len(by_score))
+    used = np.zeros(size, dtype=bool)
+    picked = []
+    while len(rank):
+        best = np.full(size, np.iinfo(np.intp).max, dtype=np.intp)
+        np.minimum.at(best, first, rank)
+        np.minimum.at(best, second, rank)
+        is_best = (best[first] == rank) & (best[second] == rank)
+        picked.append(rank[is_best])
+        used[first[is_best]] = used[second[is_best]] = True
+        left = ~used[first] & ~used[second]
+        first, second, rank = first[left], second[left], rank[left]
+    return by_score[np.concatenate(picked)] if picked else np.zeros(0, dtype=np.intp)
+
+
+def _exchange(pairs, cost, first, second, max_rounds=50):
+    # swaps partners between the pairs first[e] and second[e] of the edges e while it lowers the total cost,
+    # cost(a, b) being the cost of the pairs of the players a and b
+    pairs = pairs.copy()
+    for _ in range(max_rounds):
+        a, b, c, d = pairs[first, 0], pairs[first, 1], pairs[second, 0], pairs[second, 1]
+        current = cost(a, b) + cost(c, d)
+        crossed = cost(a, c) + cost(b, d)
+        mixed = cost(a, d) + cost(b, c)
+        gain = current - np.minimum(crossed, mixed)
+        swaps = _pick_disjoint(first, second, np.where(gain > 1e-12, gain, 0), len(pairs))
+        if not len(swaps):
+            break
+        use_crossed = crossed[swaps] <= mixed[swaps]
+        pairs[first[swaps], 1] = np.where(use_crossed, c[swaps], d[swaps])
+        pairs[second[swaps], 0] = b[swaps]
+        pairs[second[swaps], 1] = np.where(use_crossed, d[swaps], c[swaps])
+    return pairs
+
+
+def _pair_neighbours(ratings, rds, acceptable, beta):
+    # pairs each player with a neighbour in rating order, the pairing with the most acceptable pairs and then the
+    # lowest total fairness, by dynamic programming over the order; returns pairs in rating order and the one
+    # player left out of an odd queue
+    order = np.argsort(ratings, kind="stable")
+    n = len(order)
+    below, above = order[:-1], order[1:]
+    fairness = pair_fairness(ratings[below], rds[below], ratings[above], rds[above], beta)
+    # scores above n - 1 for acceptable pairs, so that one more pair outweighs any fairness
+    score = np.where(fairness <= np.maximum(acceptable[below], acceptable[above]), n - fairness, -1.0).tolist()
+    # best[i]: best total score of the first i players of the order
+    best, paired = [0.0, 0.0], [False, False]
+    for i in range(2, n + 1):
+        with_pair = best[i - 2] + score[i - 2]
+        paired.append(score[i - 2] > 0 and with_pair > best[i - 1])
+        best.append(with_pair if paired[i] else best[i - 1])
+    pairs, i = [], n
+    while i >= 2:
+        if paired[i]:
+            pairs.append((order[i - 2], order[i - 1]))
+        i -= 2 if paired[i] else 1
+    pairs = np.array(pairs[::-1], dtype=np.intp).reshape(-1, 2)
+    matched = np.zeros(n, dtype=bool)
+    matched[pairs.ravel()] = True
+    # the players left are paired with each other too, in unacceptable pairs an exchange may turn into two
+    # acceptable ones, and the pairs are kept in rating order
+    unmatched = order[~matched[order]]
+    pairs = np.concatenate([pairs, unmatched[:len(unmatched) // 2 * 2].reshape(-1, 2)])
+    pairs = pairs[np.argsort(ratings[pairs[:, 0]] + ratings[pairs[:, 1]], kind="stable")]
+    return pairs, unmatched[len(unmatched) // 2 * 2:]
+
+
+def _match_full(ratings, rds, acceptable, beta):
+    # the acceptable pairs are weighted by 1 - fairness: the heaviest of the matchings with the most pairs has the
+    # lowest total fairness among them
+    fairness = fairness_matrix(ratings, rds, beta=beta)
+    a, b = np.triu_indices(len(ratings), 1)
+    kept = fairness[a, b] <= np.maximum(acceptable[a], acceptable[b])
+    a, b = a[kept], b[kept]
+    weights = np.rint((1 - fairness[a, b]) * _WEIGHT_SCALE).astype(np.int64)
+    mate = np.array(max_weight_matching(len(ratings), list(zip(a.tolist(), b.tolist(), weights.tolist())),
+                                        max_cardinality=True))
+    players = np.arange(len(ratings))
+    first = players[mate > players]
+    return np.stack([first, mate[first]], axis=1), players[mate < 0]
+
+
+def _match_banded(ratings, rds, acceptable, band, beta):
+    pairs, unmatched = _pair_neighbours(ratings, rds, acceptable, beta)
+
+    def cost(a, b):
+        fairness = pair_fairness(ratings[a], rds[a], ratings[b], rds[b], beta)
+        return np.where(fairness <= np.maximum(acceptable[a], acceptable[b]), fairness, _UNACCEPTABLE_COST)
+
+    # pairs are in rating order, each may exchange players with the band pairs above it
+    first = np.repeat(np.arange(len(pairs)), band)
+    second = first + np.tile(np.arange(1, band + 1), len(pairs))
+    inside = second < len(pairs)
+    return _exchange(pairs, cost, first[inside], second[inside]), unmatched
+
+
+def match_queue(ratings, rds, wait_times=None, mode="auto", max_fairness=0.2, relaxation=0.005, band=4,
+                beta=BETA):
+    """Pairs the players of a 1v1 queue, see the module docstring for the modes.
+
+    Args:
+        ratings: ratings of the players of the queue
+        rds: rating deviations of the players of the queue
+        wait_times: seconds each player has waited, 0 for everyone if not set
+        mode (str): One of MATCH_MODES.
+        max_fairness (float): Fairness every player accepts, see acceptable_fairness().
+        relaxation (float): Acceptable fairness gained per second waited.
+        band (int): Pairs above each pair in rating order it may exchange players with in the "banded" mode.
+
+    Returns:
+        A QueueMatches, the pairs with their lower queue index first, sorted by the first player.
+    """
+    ratings = np.asarray(ratings, dtype=float)
+    rds = np.asarray(rds, dtype=float)
+    if mode not in MATCH_MODES:
+        raise ValueError("Unknown match mode '{}', expected one of {}".format(mode, MATCH_MODES))
+    if len(rds) != len(ratings):
+        raise ValueError("{} ratings and {} rating deviations".format(len(ratings), len(rds)))
+    acceptable = acceptable_fairness(np.zeros(len(ratings)) if wait_times is None else wait_times, max_fairness,
+                                     relaxation)
+    if mode == "auto":
+        mode = "full" if len(ratings) <= FULL_MAX_PLAYERS else "banded"
+    if len(ratings) < 2:
+        pairs, unmatched = np.zeros((0, 2), dtype=np.intp), np.arange(len(ratings))
+    elif mode == "full":
+        pairs, unmatched = _match_full(ratings, rds, acceptable, beta)
+    else:
+        pairs, unmatched = _match_banded(ratings, rds, acceptable, band, beta)
+    fairness = pair_fairness(ratings[pairs[:, 0]], rds[pairs[:, 0]], ratings[pairs[:, 1]], rds[pairs[:, 1]], beta)
+    # the unacceptable pairs left go back to the queue
+    kept = fairness <= np.maximum(acceptable[pairs[:, 0]], acceptable[pairs[:, 1]])
+    unmatched = np.sort(np.concatenate([unmatched, pairs[~kept].ravel()]))
+    pairs = np.sort(pairs[kept], axis=1)
+    order = np.argsort(pairs[:, 0], kind="stable")
+    return QueueMatches(pairs=pairs[order], fairness=fairness[kept][order], unmatched=unmatched)
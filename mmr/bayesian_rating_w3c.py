@@ -1,8 +1,11 @@
+from typing import List
+
 import numpy as np
 from pydantic import BaseModel
 from scipy import integrate
 from scipy import optimize
 
+from common import metrics, odds
 from common.constants import C_SD, BETA
 
 class UpdateMmrRequestBody(BaseModel):
@@ -17,90 +20,568 @@ class UpdateMmrResponseBody(BaseModel):
     rds_list: list
 
 
+class UpdateMmrBatchRequestBody(BaseModel):
+    games: List[UpdateMmrRequestBody]
+
+
+class UpdateMmrBatchResponseBody(BaseModel):
+    games: List[UpdateMmrResponseBody]
+
+
+class PredictGameBody(BaseModel):
+    ratings_list: list
+    rds_list: list
+    number_of_teams: int
+
+
+class PredictRequestBody(BaseModel):
+    games: List[PredictGameBody]
+
+
+class PredictResponseBody(BaseModel):
+    # the win probability of each team of each game, in the order of games
+    odds: List[list]
+
+
 # ratings_list: ratings of all players in the game
 # rds_list: rating deviations of all players in the game
 # T_won: index of winning team so in [0,1] for solo/RT and in [0,1,2,3] for FFA
 # T: number of teams in the game (2 for solo/RT, 4 for FFA)
+# solver: how the maximum a posteriori is found, one of SOLVERS
+#   "analytic": trust-region Newton with the closed-form gradient and Hessian of the posterior
+#   "numeric": BFGS with finite difference gradients (the original implementation, kept for validation)
+# integrator: how the updated rating deviations are integrated, one of INTEGRATORS
+#   "grid": all players at once on a shared grid refined until the deviations move by less than rd_tol
+#   "quad": one adaptive scipy quad per player and moment (the original implementation, kept for validation)
+#   "laplace": on a small grid around each updated rating, sized by the curvature of the posterior there,
+#              with "grid" as a fallback for the games whose posterior is too skewed for it (see rds_laplace)
+# tol: convergence tolerance of the solver, its default when None (see find_map and find_map_batch)
+# x0: ratings the solver starts from, the prior ratings when None
+# beta, rd_min: the parameters of the rating system (see below), BETA and RD_MIN unless tuning them
+
+SOLVERS = ("analytic", "numeric")
+INTEGRATORS = ("grid", "quad", "laplace")
 
-def update_after_game(ratings_list, rds_list, winning_team, number_of_teams):
-    ratings_G = np.array(ratings_list)
-    rds_G = np.array(rds_list)
+# minimum rating deviation after a game
+RD_MIN = 80
+
+# integration bounds of the rating deviation integrals
+RATING_BOUNDS = (0, 5000)
+
+# points of the grid of each player in the "laplace" integrator and its half width, in deviations of the
+# Laplace approximation (~0.1 from the "grid" deviations)
+LAPLACE_POINTS = 33
+LAPLACE_WIDTH = 10
+
+
+def update_after_game(ratings_list, rds_list, winning_team, number_of_teams, solver="analytic",
+                      integrator="grid", rd_tol=0.01, beta=BETA, rd_min=RD_MIN, tol=None, x0=None):
+    ratings_G = np.array(ratings_list, dtype=float)
+    rds_G = np.array(rds_list, dtype=float)
 
     # the whole rating system has 3 parameters:
     # (mu_0, RD_0): starting rating and deviation of (1500, 350), as we currently use - handled in the matchmaking app
     # BETA: encodes performance uncertainty (this is game dependent - similar to the volatility param in Glicko2)
     # rd_min: a minimum rating deviation to prevent staleness
-    rd_min = 80
 
-    # N: number of players in the game
-    N = int(len(ratings_G))
     # maximum a posteriori to compute new ratings
-    opt = optimize.minimize(lambda x: -posterior_pdf(x, ratings_G, rds_G, BETA, winning_team, number_of_teams),
-                            x0=[ratings_G], tol=0.00000000001)
+    with metrics.timer("find_map"):
+        opt = find_map(ratings_G, rds_G, winning_team, number_of_teams, solver, beta, tol, x0)
+    metrics.count("optimizer_iterations", opt.nit)
+    metrics.count("optimizer_evaluations", opt.nfev)
     # updated ratings
     ratings_G_u = opt.x
+    if integrator == "grid":
+        with metrics.timer("rds_grid"):
+            rds_G_u = rds_grid(ratings_G_u, ratings_G, rds_G, winning_team, number_of_teams, rd_tol, beta=beta)
+    elif integrator == "quad":
+        with metrics.timer("rds_quad"):
+            rds_G_u = rds_quad(ratings_G_u, ratings_G, rds_G, winning_team, number_of_teams, beta)
+    elif integrator == "laplace":
+        with metrics.timer("rds_laplace"):
+            rds_G_u, skewed = rds_laplace(ratings_G_u, ratings_G, rds_G, winning_team, number_of_teams, beta=beta)
+        if skewed:
+            metrics.count("laplace_fallbacks")
+            with metrics.timer("rds_grid"):
+                rds_G_u = rds_grid(ratings_G_u, ratings_G, rds_G, winning_team, number_of_teams, rd_tol, beta=beta)
+    else:
+        raise ValueError("Unknown integrator '{}', expected one of {}".format(integrator, INTEGRATORS))
+    metrics.count("games")
+    # floor rating deviation to prevent rating staleness
+    rds_G_u = np.maximum(rd_min, rds_G_u)
+    return UpdateMmrResponseBody(ratings_list=ratings_G_u.tolist(), rds_list=rds_G_u.tolist())
+
+
+# inputs are sanitized before rating a game:
+# rating deviations under the floor rd_min are inflated and negative ratings are raised to 0
+# (lists or arrays, returned as float arrays)
+def clamp_inputs(ratings_list, rds_list, rd_min=RD_MIN):
+    ratings_G = np.maximum(np.asarray(ratings_list, dtype=float), 0)
+    rds_G = np.asarray(rds_list, dtype=float)
+    rds_G = np.where(rds_G < rd_min, rds_G * rd_min / 60.25, rds_G)
+    return ratings_G, rds_G
+
+
+# checks games of (ratings_list, rds_list, winning_team, number_of_teams) before any of them is rated,
+# raises a ValueError naming the first game whose players do not split in its teams or whose winner is not one of them
+def check_games(games):
+    for g, (ratings_list, rds_list, winning_team, number_of_teams) in enumerate(games):
+        N = len(ratings_list)
+        if len(rds_list) != N or number_of_teams < 1 or N < number_of_teams or N % number_of_teams:
+            raise ValueError("Game {}: {} ratings and {} rating deviations do not split in {} teams".format(
+                g, N, len(rds_list), number_of_teams))
+        if winning_team not in range(number_of_teams):
+            raise ValueError("Game {}: winning team {} is not one of the {} teams".format(g, winning_team,
+                                                                                        number_of_teams))
+
+
+# rates many games at once, games is a list of (ratings_list, rds_list, winning_team, number_of_teams)
+# and results are returned in the same order, with the same values as update_after_game
+# (inputs are clamped first unless clamp is False, note that clamping twice inflates low deviations twice).
+# Games of the same shape (number of players and number of teams) are stacked in arrays and solved together.
+# Games are checked first with check_games.
+def update_after_games(games, solver="analytic", integrator="grid", rd_tol=0.01, chunk_size=64, clamp=True,
+                       beta=BETA, rd_min=RD_MIN, tol=None):
+    check_games(games)
+    results = [None] * len(games)
+    shapes = {}
+    for g, (ratings_list, rds_list, winning_team, number_of_teams) in enumerate(games):
+        shapes.setdefault((len(ratings_list), number_of_teams), []).append(g)
+    for (N, number_of_teams), indices in shapes.items():
+        for k in range(0, len(indices), chunk_size):
+            chunk = indices[k:k + chunk_size]
+            inputs = [clamp_inputs(games[g][0], games[g][1], rd_min) if clamp else (games[g][0], games[g][1])
+                      for g in chunk]
+            if solver != "analytic" or integrator not in ("grid", "laplace"):
+                for g, (ratings_list, rds_list) in zip(chunk, inputs):
+                    results[g] = update_after_game(ratings_list, rds_list, games[g][2], number_of_teams,
+                                                   solver, integrator, rd_tol, beta, rd_min, tol)
+                continue
+            ratings_G = np.array([ratings_list for ratings_list, _ in inputs], dtype=float)
+            rds_G = np.array([rds_list for _, rds_list in inputs], dtype=float)
+            winning_team = np.array([games[g][2] for g in chunk])
+            ratings_G_u, rds_G_u = update_games_arrays(ratings_G, rds_G, winning_team, number_of_teams, rd_tol,
+                                                       beta, rd_min, integrator, tol)
+            for g, ratings, rds in zip(chunk, ratings_G_u, rds_G_u):
+                results[g] = UpdateMmrResponseBody(ratings_list=ratings.tolist(), rds_list=rds.tolist())
+    return results
+
+
+# pre-game win probabilities of many games at once, games is a list of (ratings_list, rds_list, number_of_teams)
+# inputs are clamped like the rating endpoints clamp them, and games of the same shape are stacked and scored
+# in one array pass (see common.odds)
+# returns the array of win probabilities of the teams of each game, in the order of games
+def predict_games(games, beta=BETA):
+    shapes = {}
+    for g, (ratings_list, rds_list, number_of_teams) in enumerate(games):
+        N = len(ratings_list)
+        if len(rds_list) != N or number_of_teams < 1 or N < number_of_teams or N % number_of_teams:
+            raise ValueError("Game {}: {} ratings and {} rating deviations do not split in {} teams".format(
+                g, N, len(rds_list), number_of_teams))
+        shapes.setdefault((N, number_of_teams), []).append(g)
+    results = [None] * len(games)
+    for (_, T), indices in shapes.items():
+        ratings_G, rds_G = clamp_inputs([games[g][0] for g in indices], [games[g][1] for g in indices])
+        with metrics.timer("win_probabilities"):
+            probabilities = win_probabilities(ratings_G, rds_G, T, beta)
+        for g, p in zip(indices, probabilities):
+            results[g] = p
+    metrics.count("predictions", len(games))
+    return results
+
+
+# analytic solver and grid (or laplace) integrator of update_after_game on stacked games of the same shape,
+# ratings_G and rds_G of shape (B, N) and winning_team of shape (B,), without clamping
+# returns the arrays (ratings_G_u, rds_G_u)
+def update_games_arrays(ratings_G, rds_G, winning_team, number_of_teams, rd_tol=0.01, beta=BETA, rd_min=RD_MIN,
+                        integrator="grid", tol=None):
+    winning_team = np.asarray(winning_team)
+    with metrics.timer("find_map_batch"):
+        ratings_G_u = find_map_batch(ratings_G, rds_G, winning_team, number_of_teams, beta=beta, tol=tol)
+    if integrator == "laplace":
+        with metrics.timer("rds_laplace"):
+            rds_G_u, skewed = rds_laplace(ratings_G_u, ratings_G, rds_G, winning_team, number_of_teams, beta=beta)
+        # only the skewed games go through the grid
+        g = np.flatnonzero(skewed)
+        metrics.count("laplace_fallbacks", len(g))
+    elif integrator == "grid":
+        rds_G_u, g = np.empty_like(ratings_G_u), np.arange(len(ratings_G))
+    else:
+        raise ValueError("Unknown integrator '{}', expected grid or laplace for stacked games".format(integrator))
+    if len(g):
+        with metrics.timer("rds_grid"):
+            rds_G_u[g] = rds_grid(ratings_G_u[g], ratings_G[g], rds_G[g], winning_team[g], number_of_teams, rd_tol,
+                                  beta=beta)
+    metrics.count("games", len(ratings_G))
+    return ratings_G_u, np.maximum(rd_min, rds_G_u)
+
+
+# maximum a posteriori of a game, tol is the tolerance of scipy's minimize (1e-11 by default)
+# and the search starts from x0, the prior ratings unless set. Its callers report the iterations and evaluations
+# of the result to common.metrics.
+def find_map(ratings_G, rds_G, winning_team, number_of_teams, solver="analytic", beta=BETA, tol=None, x0=None):
+    tol = 1e-11 if tol is None else tol
+    x0 = ratings_G if x0 is None else np.asarray(x0, dtype=float)
+    if solver == "analytic":
+        # the geometric mean (and its derivatives) is only defined for positive ratings,
+        # so the posterior is maximized over log ratings y = log(x), keeping every step inside the domain
+        def log_posterior(y):
+            return -posterior_pdf(np.exp(y), ratings_G, rds_G, beta, winning_team, number_of_teams)
+
+        def log_posterior_gradient(y):
+            x = np.exp(y)
+            return -x * posterior_gradient(x, ratings_G, rds_G, beta, winning_team, number_of_teams)
+
+        def log_posterior_hessian(y):
+            x = np.exp(y)
+            hessian = np.outer(x, x) * posterior_hessian(x, ratings_G, rds_G, beta, winning_team, number_of_teams)
+            hessian[np.diag_indices(len(x))] += x * posterior_gradient(x, ratings_G, rds_G, beta, winning_team,
+                                                                       number_of_teams)
+            return -hessian
+
+        opt = optimize.minimize(log_posterior, x0=np.log(np.maximum(x0, 1)), tol=tol,
+                                method="trust-exact", jac=log_posterior_gradient, hess=log_posterior_hessian)
+        opt.x = np.exp(opt.x)
+        return opt
+    if solver == "numeric":
+        def log_posterior_batch(x):
+            return posterior_pdf(x, ratings_G, rds_G, beta, winning_team, number_of_teams)
+
+        return optimize.minimize(lambda x: -log_posterior_batch(x), x0=x0, tol=tol,
+                                 jac=lambda x: -_finite_difference_gradient(log_posterior_batch, x))
+    raise ValueError("Unknown solver '{}', expected one of {}".format(solver, SOLVERS))
+
+
+# maximum a posteriori of stacked games of the same shape (arrays of shape (B, N))
+# with the same parametrization as the analytic solver of find_map: a Newton method on log ratings,
+# vectorized over games. The Hessian is made negative definite through its eigenvalues and steps are
+# backtracked until they increase the posterior enough. A game has converged when its gradient on log ratings
+# is below tol (1e-8 by default). Games which do not converge in max_iter iterations are solved one by one
+# with find_map, warm started from where the Newton method left them. x0 as in find_map.
+def find_map_batch(ratings_G, rds_G, winning_team, number_of_teams, max_iter=50, beta=BETA, tol=None, x0=None):
+    winning_team = np.asarray(winning_team)
+    tol = 1e-8 if tol is None else tol
+    N = ratings_G.shape[-1]
+    y = np.log(np.maximum(ratings_G if x0 is None else x0, 1))
+    value = _posterior_values(np.exp(y), ratings_G, rds_G, beta, winning_team, number_of_teams)
+    active = np.ones(len(y), dtype=bool)
+    for _ in range(max_iter):
+        if not np.any(active):
+            break
+        a = np.flatnonzero(active)
+        metrics.count("optimizer_iterations", len(a))
+        x = np.exp(y[a])
+        gradient_x = posterior_gradient(x, ratings_G[a], rds_G[a], beta, winning_team[a], number_of_teams)
+        gradient = x * gradient_x
+        hessian = x[:, :, None] * x[:, None, :] * posterior_hessian(x, ratings_G[a], rds_G[a], beta,
+                                                                     winning_team[a], number_of_teams)
+        hessian[:, np.arange(N), np.arange(N)] += gradient
+        eigenvalues, eigenvectors = np.linalg.eigh(hessian)
+        eigenvalues = np.maximum(np.abs(eigenvalues), 1e-12)
+        projected = (np.swapaxes(eigenvectors, -1, -2) @ gradient[:, :, None])[:, :, 0]
+        step = (eigenvectors @ (projected / eigenvalues)[:, :, None])[:, :, 0]
+        slope = np.sum(step * gradient, axis=-1)
+        alpha = np.ones(len(a))
+        pending = np.ones(len(a), dtype=bool)
+        for _ in range(30):
+            y_new = y[a[pending]] + alpha[pending, None] * step[pending]
+            value_new = _posterior_values(np.exp(y_new), ratings_G[a[pending]], rds_G[a[pending]], beta,
+                                          winning_team[a[pending]], number_of_teams)
+            metrics.count("optimizer_evaluations", len(y_new))
+            accepted = value_new >= value[a[pending]] + 1e-4 * alpha[pending] * slope[pending]
+            done = np.flatnonzero(pending)[accepted]
+            y[a[done]] = y_new[accepted]
+            value[a[done]] = value_new[accepted]
+            pending[done] = False
+            if not np.any(pending):
+                break
+            alpha[pending] /= 2
+        # converged when the gradient vanishes or the steps stop moving the ratings
+        # (the gradient on log ratings also vanishes when a rating goes to the boundary at 0)
+        small_gradient = np.max(np.abs(gradient), axis=-1) < tol
+        small_step = np.max(np.abs(alpha[:, None] * step), axis=-1) < 1e-12
+        active[a[small_gradient | small_step | pending]] = False
+        failed = a[pending & ~small_gradient]
+        for g in failed:
+            y[g] = _find_map_counted(ratings_G[g], rds_G[g], winning_team[g], number_of_teams, beta, y[g])
+    for g in np.flatnonzero(active):
+        y[g] = _find_map_counted(ratings_G[g], rds_G[g], winning_team[g], number_of_teams, beta, y[g])
+    return np.exp(y)
+
+
+def _find_map_counted(ratings_G, rds_G, winning_team, number_of_teams, beta, y):
+    # log ratings of the MAP of a game find_map_batch did not solve, warm started from its log ratings y
+    opt = find_map(ratings_G, rds_G, winning_team, number_of_teams, beta=beta, x0=np.exp(y))
+    metrics.count("optimizer_iterations", opt.nit)
+    metrics.count("optimizer_evaluations", opt.nfev)
+    return np.log(opt.x)
+
+
+# updated rating deviations with one pair of quad integrals per player
+def rds_quad(ratings_G_u, ratings_G, rds_G, winning_team, number_of_teams, beta=BETA):
+    a, b = RATING_BOUNDS
     rds_G_u = []
-    for p in range(N):
+    for p in range(len(ratings_G)):
         # compute the normalization constant by fixing other ratings to their updated values
         # (slight approximation but alternative is a nasty (N dimensional) integration step, not feasible)
-        C_int, _ = integrate.quad(lambda x: np.exp(
+        C_int, _, info = integrate.quad(lambda x: np.exp(
             posterior_pdf(np.concatenate([ratings_G_u[:p], np.array(x), ratings_G_u[p + 1:]], axis=None),
-                          ratings_G, rds_G, BETA, winning_team, number_of_teams, p)),
-                                  # integration bounds a -> b
-                                  a=0, b=5000)
+                          ratings_G, rds_G, beta, winning_team, number_of_teams, p)),
+                                        # integration bounds a -> b
+                                        a=a, b=b, full_output=1)[:3]
+        metrics.count("quad_evaluations", info["neval"])
         # compute second moment of posterior to get new rating deviation
         # integral of p(x)*(x-mu)**2/C_int over the domain
-        rd_G_u_p = np.sqrt(
-            integrate.quad(lambda x: (x - ratings_G_u[p]) ** 2 / C_int * np.exp(posterior_pdf(np.concatenate(
-                [ratings_G_u[:p], np.array(x), ratings_G_u[p + 1:]], axis=None), ratings_G, rds_G, BETA, winning_team,
+        second_moment, _, info = integrate.quad(
+            lambda x: (x - ratings_G_u[p]) ** 2 / C_int * np.exp(posterior_pdf(np.concatenate(
+                [ratings_G_u[:p], np.array(x), ratings_G_u[p + 1:]], axis=None), ratings_G, rds_G, beta, winning_team,
                 number_of_teams, p)),
-                           a=0, b=5000)[0])
-        # floor rating deviation to prevent rating staleness
-        rd_G_u_p = max(rd_min, rd_G_u_p)
-        # updated rating deviations
+            a=a, b=b, full_output=1)[:3]
+        metrics.count("quad_evaluations", info["neval"])
+        rd_G_u_p = np.sqrt(second_moment)
         rds_G_u.append(rd_G_u_p)
-    return UpdateMmrResponseBody(ratings_list=ratings_G_u.tolist(), rds_list=rds_G_u)
+    return np.array(rds_G_u)
+
+
+# updated rating deviations of all players integrated together on one shared grid
+# same approximation as rds_quad: the other ratings are fixed to their updated values.
+# Simpson's rule on a grid over RATING_BOUNDS, doubled until no deviation moves by more than rd_tol
+# (the points of the coarser grid are reused), the normalizer and second moment share the evaluations.
+def rds_grid(ratings_G_u, ratings_G, rds_G, winning_team, number_of_teams, rd_tol=0.01,
+             initial_points=257, max_points=16385, beta=BETA):
+    a, b = RATING_BOUNDS
+    grid = np.linspace(a, b, initial_points)
+    log_pdf = marginal_log_pdf(grid, ratings_G_u, ratings_G, rds_G, beta, winning_team, number_of_teams)
+    rds_G_u = _grid_rds(grid, log_pdf, ratings_G_u)
+    while len(grid) < max_points:
+        midpoints = (grid[:-1] + grid[1:]) / 2
+        log_pdf_mid = marginal_log_pdf(midpoints, ratings_G_u, ratings_G, rds_G, beta, winning_team, number_of_teams)
+        grid = _interleave(grid, midpoints)
+        log_pdf = _interleave(log_pdf, log_pdf_mid)
+        rds_G_u_prev, rds_G_u = rds_G_u, _grid_rds(grid, log_pdf, ratings_G_u)
+        if np.max(np.abs(rds_G_u - rds_G_u_prev)) < rd_tol:
+            break
+    metrics.count("grid_points", len(grid) * ratings_G_u.size)
+    return rds_G_u
+
+
+# updated rating deviations from the Laplace approximation of the posterior of each player: its deviation
+# sigma = 1 / sqrt(-d2/dx2 log posterior) at the updated rating. sigma alone underestimates the deviations by up to
+# a third, the logistic prior having heavier tails than a normal, so it only sizes a grid of LAPLACE_POINTS over
+# +-LAPLACE_WIDTH sigma around each updated rating, on which the deviation is integrated like in rds_grid.
+# Same approximation as rds_grid (the other ratings are fixed to their updated values), vectorized over games.
+# A player's posterior is too skewed for that grid when its skewness is above skew_tol, when it is within 3 sigma
+# of 0 (where the geometric mean bends the likelihood), or when the grid misses part of it (it is above exp(-8)
+# of its maximum at an end of the grid that is not a bound of RATING_BOUNDS).
+# returns (rds_G_u, skewed) with skewed of shape (...): True for the games with a skewed posterior,
+# whose deviations should be integrated with rds_grid instead
+def rds_laplace(ratings_G_u, ratings_G, rds_G, winning_team, number_of_teams, skew_tol=1.0, beta=BETA):
+    a, b = RATING_BOUNDS
+    hessian = posterior_hessian(ratings_G_u, ratings_G, rds_G, beta, winning_team, number_of_teams)
+    curvature = -np.diagonal(hessian, axis1=-2, axis2=-1)
+    skewed = ~(curvature > 0)
+    sigma = 1 / np.sqrt(np.where(skewed, 1, curvature))
+    skewed |= ratings_G_u < 3 * sigma
+    low = np.maximum(ratings_G_u - LAPLACE_WIDTH * sigma, a)
+    high = np.minimum(ratings_G_u + LAPLACE_WIDTH * sigma, b)
+    grid = low[..., None] + (high - low)[..., None] * np.linspace(0, 1, LAPLACE_POINTS)
+    log_pdf = marginal_log_pdf(grid, ratings_G_u, ratings_G, rds_G, beta, winning_team, number_of_teams)
+    pdf = _simpson_pdf(log_pdf)
+    deviation = grid - ratings_G_u[..., None]
+    rds_G_u = np.sqrt(np.sum(pdf * deviation ** 2, axis=-1))
+    centered = deviation - np.sum(pdf * deviation, axis=-1, keepdims=True)
+    variance = np.sum(pdf * centered ** 2, axis=-1)
+    skewed |= np.abs(np.sum(pdf * centered ** 3, axis=-1)) > skew_tol * variance ** 1.5
+    top = np.max(log_pdf, axis=-1)
+    skewed |= (low > a) & (log_pdf[..., 0] > top - 8) | (high < b) & (log_pdf[..., -1] > top - 8)
+    return rds_G_u, np.any(skewed, axis=-1)
+
+
+# Simpson's rule weights times the densities of each row of log_pdf (on evenly spaced points), normalized to 1
+def _simpson_pdf(log_pdf):
+    weights = np.ones(log_pdf.shape[-1])
+    weights[1:-1:2] = 4
+    weights[2:-1:2] = 2
+    # the normalization constant cancels out so the densities are rescaled to avoid underflow
+    pdf = np.exp(log_pdf - np.max(log_pdf, axis=-1, keepdims=True)) * weights
+    return pdf / np.sum(pdf, axis=-1, keepdims=True)
+
+
+# square root of the second moment around ratings_G_u of each row of log_pdf with Simpson's rule
+def _grid_rds(grid, log_pdf, ratings_G_u):
+    return np.sqrt(np.sum(_simpson_pdf(log_pdf) * (grid - ratings_G_u[..., None]) ** 2, axis=-1))
+
+
+def _interleave(x, midpoints):
+    out = np.empty(x.shape[:-1] + (x.shape[-1] + midpoints.shape[-1],))
+    out[..., 0::2] = x
+    out[..., 1::2] = midpoints
+    return out
+
+
+# log of the posterior marginalized on each player, evaluated on a grid of ratings for all players at once
+# (or on a grid of shape (..., N, K) with one row per player)
+# returns an array of shape (..., N, K), with row n equal to
+# posterior_pdf(ratings_G_u with player n set to x, ..., m=n) at every x of the grid (of player n)
+# (vectorized over stacked games like posterior_gradient)
+def marginal_log_pdf(grid, ratings_G_u, ratings_G_o, rds_G_o, BETA, T_won, T):
+    N = int(ratings_G_u.shape[-1])
+    P = int(float(N) / float(T))
+    team = np.repeat(np.arange(T), P)
+    _, ratings_T_u, scale, _, _, _ = _posterior_terms(ratings_G_u, rds_G_o, BETA, T)
+    # team ratings seen by player n at every x: only the team of n changes, by a factor (x / r_n) ** (1/P)
+    ratings_T_x = np.repeat(ratings_T_u[..., None, :, None], N, axis=-3)
+    ratings_T_x = np.repeat(ratings_T_x, grid.shape[-1], axis=-1)
+    ratings_T_x[..., np.arange(N), team, :] = ratings_T_u[..., team, None] * np.power(
+        grid / ratings_G_u[..., None], 1 / float(P))
+    u = P * ratings_T_x / scale[..., None, None, None]
+    u_max = np.max(u, axis=-2)
+    u_won = np.sum(_won(T_won, T)[..., None, :, None] * u, axis=-2)
+    loglikelihood = u_won - u_max - np.log(np.sum(np.exp(u - u_max[..., None, :]), axis=-2))
+    return loglikelihood + _log_logistic_pdf(grid, ratings_G_o[..., None], C_SD * rds_G_o[..., None])
+
+
+# central finite difference gradient of f at x, with all the 2N shifted points evaluated in one call of f
+# f takes a batch of points of shape (K, N) and returns their K values
+def _finite_difference_gradient(f, x):
+    # step of the order of the cube root of the machine precision, relative to x, like scipy's 3-point scheme
+    h = np.finfo(float).eps ** (1 / 3.) * np.maximum(1, np.abs(x))
+    shifts = np.diag(h)
+    values = f(np.concatenate([x + shifts, x - shifts]))
+    return (values[:len(x)] - values[len(x):]) / (2 * h)
 
 
 # this is faster than using the scipy.stats implementation
 # (it's always the case on every project I've ever worked with, no surprises)
+# computed from its log, which stays finite where exp((x - mu) / s) overflows
 def logistic_pdf(x, mu, s):
-    return np.exp((x - mu) / s) / (s * (1 + np.exp((x - mu) / s)) ** 2)
+    return np.exp(_log_logistic_pdf(x, mu, s))
 
 
-# this is the posterior probabiliy density function
+# this is the (log of the) posterior probabiliy density function
+# ratings_G_u: updated ratings, of shape (N,) or a batch of candidates of shape (..., N) evaluated in one call
 # ratings_G_o: prior mean
 # rds_G_o: prior deviation
 # BETA: performance uncertainty
 # T_won: index of winning team
 # T: number of teams in the game
 # m: marginlization variable for integration purposes
+# returns a float, or an array of shape (...) for a batch of candidates
 def posterior_pdf(ratings_G_u, ratings_G_o, rds_G_o, BETA, T_won, T, m=None):
-    # N: number of players in the game
-    N = int(len(ratings_G_o))
-    # P: number of players per team
-    P = int(float(N) / float(T))
-
+    ratings_G_u = np.asarray(ratings_G_u, dtype=float)
     # the game's collective rating deviation
     # each player's rating deviation is inflated by BETA, which quantifies performance uncertainty
     # see https://jmlr.csail.mit.edu/papers/volume12/weng11a/weng11a.pdf
     # section 3.5, that's where I found this idea :)
-    rd_G = np.sqrt(np.sum(np.power(rds_G_o, 2)) + N * BETA ** 2)
-    # each team's collective rating as the geometric mean of ratings
-    ratings_T_u = np.array([(np.prod(np.power(ratings_G_u[t * P:(t + 1) * P], 1 / float(P)))) for t in range(T)])
     # Bradley-Terry model which handles both 1 team vs 1 team and FFA
     # differs from usual BT as we have:
     # 1) different rating deviation for each team
     # 2) performance uncertainty with BETA
     # 3) multiple players by team
-    s_p = np.exp((P * ratings_T_u[T_won]) / (C_SD * rd_G))
-    s_G = np.sum(np.exp((P * ratings_T_u) / (C_SD * rd_G)))
-    # s_p/s_G = win probability for the winning team
+    # (see _team_strengths, the geometric mean of negative ratings is taken as 0)
+    u = _team_strengths(np.maximum(ratings_G_u, 0), rds_G_o, BETA, T)[2]
+    # log of s_p/s_G = win probability for the winning team, through log-sum-exp so that it never overflows
     # this is the evidence for the observed result
-    loglikelihood = np.log(s_p / s_G)
-    for n in range(N):
-        # trick for the marginalization step in the integral
-        if m == None or m == n:
-            # this is the evidence for each player's updated rating under the prior
-            loglikelihood += np.log(logistic_pdf(ratings_G_u[n], ratings_G_o[n], C_SD * rds_G_o[n]))
-    return loglikelihood
+    u_won = u[..., T_won] if np.ndim(T_won) == 0 else np.sum(_won(T_won, T) * u, axis=-1)
+    loglikelihood = u_won - np.logaddexp.reduce(u, axis=-1)
+    # this is the evidence for each player's updated rating under the prior
+    prior = _log_logistic_pdf(ratings_G_u, ratings_G_o, C_SD * np.asarray(rds_G_o, dtype=float))
+    # trick for the marginalization step in the integral
+    loglikelihood = loglikelihood + (np.sum(prior, axis=-1) if m is None else prior[..., m])
+    return float(loglikelihood) if np.ndim(loglikelihood) == 0 else loglikelihood
+
+
+# the functions below are vectorized over games: ratings_G_u, ratings_G_o and rds_G_o can be stacked
+# in arrays of shape (..., N) with one game of the same shape per row, T_won is then an array of shape (...)
+
+# team ratings R_t, the scale C_SD * rd_G and the Bradley-Terry strength u_t = P * R_t / scale of each team t
+# (see common.odds, shared with the balancer)
+def _team_strengths(ratings_G_u, rds_G_o, BETA, T):
+    P = int(float(ratings_G_u.shape[-1]) / float(T))
+    scale = odds.game_scale(rds_G_o, BETA)
+    # geometric mean of each team through the mean of log ratings (0 when a rating is 0)
+    with np.errstate(divide="ignore"):
+        ratings_T_u = odds.team_ratings(np.log(ratings_G_u), T)
+    return ratings_T_u, scale, P * ratings_T_u / scale[..., None]
+
+
+# the pieces of the posterior likelihood shared by its value, gradient and Hessian:
+# team index of each player, team ratings R_t, the scale C_SD * rd_G,
+# team strengths u_t, win probabilities p_t and du_t/dr_n for the team t of each player n
+def _posterior_terms(ratings_G_u, rds_G_o, BETA, T):
+    N = int(ratings_G_u.shape[-1])
+    P = int(float(N) / float(T))
+    team = np.repeat(np.arange(T), P)
+    # u_t is the Bradley-Terry strength of team t, p_t its win probability
+    ratings_T_u, scale, u = _team_strengths(ratings_G_u, rds_G_o, BETA, T)
+    p = odds.softmax(u)
+    # du_t/dr_n for the team t player n belongs to (the geometric mean is R_t / (P * r_n) in r_n)
+    du = ratings_T_u[..., team] / (scale[..., None] * ratings_G_u)
+    return team, ratings_T_u, scale, u, p, du
+
+
+# pre-game win probability of each team (the s_p / s_G of posterior_pdf at the prior ratings),
+# ratings_G and rds_G of shape (..., N), returns an array of shape (..., T)
+def win_probabilities(ratings_G, rds_G, number_of_teams, beta=BETA):
+    return odds.win_probabilities(ratings_G, rds_G, number_of_teams, beta)
+
+
+def _won(T_won, T):
+    return (np.arange(T) == np.asarray(T_won)[..., None]).astype(float)
+
+
+# log of logistic_pdf, written to stay finite far in the tails
+def _log_logistic_pdf(x, mu, s):
+    z = np.abs(x - mu) / s
+    return -z - 2 * np.log1p(np.exp(-z)) - np.log(s)
+
+
+# posterior_pdf for stacked games, without marginalization
+def _posterior_values(ratings_G_u, ratings_G_o, rds_G_o, BETA, T_won, T):
+    _, _, _, u, p, _ = _posterior_terms(ratings_G_u, rds_G_o, BETA, T)
+    loglikelihood = np.log(np.sum(_won(T_won, T) * p, axis=-1))
+    return loglikelihood + np.sum(_log_logistic_pdf(ratings_G_u, ratings_G_o, C_SD * rds_G_o), axis=-1)
+
+
+# gradient of posterior_pdf with respect to ratings_G_u, same arguments
+def posterior_gradient(ratings_G_u, ratings_G_o, rds_G_o, BETA, T_won, T, m=None):
+    ratings_G_u = np.asarray(ratings_G_u, dtype=float)
+    team, _, _, _, p, du = _posterior_terms(ratings_G_u, rds_G_o, BETA, T)
+    # d/dr_n of u_won - log(sum_t exp(u_t))
+    gradient = (_won(T_won, T) - p)[..., team] * du
+    # d/dx of the log-logistic prior is -tanh(z/2)/s with z = (x - mu)/s
+    s = C_SD * np.asarray(rds_G_o, dtype=float)
+    prior = -np.tanh((ratings_G_u - ratings_G_o) / (2 * s)) / s
+    if m is None:
+        gradient += prior
+    else:
+        gradient[..., m] += prior[..., m]
+    return gradient
+
+
+# Hessian of posterior_pdf with respect to ratings_G_u, same arguments
+def posterior_hessian(ratings_G_u, ratings_G_o, rds_G_o, BETA, T_won, T, m=None):
+    ratings_G_u = np.asarray(ratings_G_u, dtype=float)
+    N = int(ratings_G_u.shape[-1])
+    P = int(float(N) / float(T))
+    diagonal = (Ellipsis,) + np.diag_indices(N)
+    team, ratings_T_u, scale, _, p, du = _posterior_terms(ratings_G_u, rds_G_o, BETA, T)
+    # second derivatives of each u_t, only non zero for two players of the same team
+    same_team = team[:, None] == team[None, :]
+    d2u = same_team * du[..., :, None] * du[..., None, :] * (
+            scale[..., None, None] / (P * ratings_T_u[..., team][..., :, None]))
+    d2u[diagonal] -= du / ratings_G_u
+    hessian = (_won(T_won, T) - p)[..., team][..., :, None] * d2u
+    # minus the covariance of the softmax mapped back on players
+    J = (np.arange(T)[:, None] == team[None, :]) * du[..., None, :]
+    covariance = p[..., :, None] * np.eye(T) - p[..., :, None] * p[..., None, :]
+    hessian -= np.swapaxes(J, -1, -2) @ covariance @ J
+    # d2/dx2 of the log-logistic prior is -2 * sigmoid(z) * (1 - sigmoid(z)) / s**2
+    s = C_SD * np.asarray(rds_G_o, dtype=float)
+    sigmoid = 1 / (1 + np.exp(-(ratings_G_u - ratings_G_o) / s))
+    prior = -2 * sigmoid * (1 - sigmoid) / s ** 2
+    if m is None:
+        hessian[diagonal] += prior
+    else:
+        hessian[..., m, m] += prior[..., m]
+    return hessian
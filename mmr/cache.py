@@ -0,0 +1,218 @@
+import fcntl
+import json
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from common.constants import BETA, C_SD
+from mmr.bayesian_rating_w3c import UpdateMmrResponseBody, RD_MIN, RATING_BOUNDS
+
+CACHE_KINDS = ("memory", "file")
+
+
+class RatingCache:
+    """
+    Memoizes rating updates (see update_after_game) on quantized inputs.
+
+    Many games share the same inputs up to a fraction of a point, e.g. new accounts all start
+    at (1500, 350) and placement games hit the same rating deviation floors. Inputs are rounded to
+    multiples of rating_step and rd_step, the rounded values are what gets rated, and the result
+    is cached under the rounded inputs, the winning team and the number of teams. A hit therefore
+    returns exactly what rating the rounded inputs would give.
+
+    This cache lives in the process and evicts the least recently used results beyond max_size,
+    see SharedRatingCache for a cache shared by the workers of a host.
+
+    Examples:
+        ```python
+        cache = RatingCache(max_size=10000, rating_step=1, rd_step=1)
+        key, ratings_list, rds_list = cache.quantize(ratings_list, rds_list, winning_team, number_of_teams)
+        result = cache.get(key)
+        if result is None:
+            result = update_after_game(ratings_list, rds_list, winning_team, number_of_teams)
+            cache.put(key, result)
+        ```
+    """
+
+    def __init__(self, max_size=10000, rating_step=1.0, rd_step=1.0):
+        self.max_size = max_size
+        self.rating_step = rating_step
+        self.rd_step = rd_step
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, options=None):
+        """Builds the cache configured by RATING_CACHE ("memory" or "file", no cache if unset),
+        RATING_CACHE_SIZE, RATING_CACHE_RATING_STEP, RATING_CACHE_RD_STEP and, for "file",
+        RATING_CACHE_PATH. options are the options of the rating updates (see SharedRatingCache).
+        """
+        kind = os.environ.get("RATING_CACHE")
+        if not kind:
+            return None
+        if kind not in CACHE_KINDS:
+            raise ValueError("Unknown cache kind '{}', expected one of {}".format(kind, CACHE_KINDS))
+        kwargs = dict(max_size=int(os.environ.get("RATING_CACHE_SIZE", 10000)),
+                      rating_step=float(os.environ.get("RATING_CACHE_RATING_STEP", 1)),
+                      rd_step=float(os.environ.get("RATING_CACHE_RD_STEP", 1)))
+        if kind == "file":
+            return SharedRatingCache(os.environ.get("RATING_CACHE_PATH", "/tmp/mmr-rating-cache.bin"), options=options,
+                                     **kwargs)
+        return cls(**kwargs)
+
+    def quantize(self, ratings_list, rds_list, winning_team, number_of_teams):
+        """Rounds the inputs of a game.
+
+        Returns:
+            A tuple (key, ratings_list, rds_list) with the cache key of the game and its rounded inputs.
+        """
+        ratings_q = np.round(np.asarray(ratings_list, dtype=float) / self.rating_step).astype(np.int64)
+        rds_q = np.round(np.asarray(rds_list, dtype=float) / self.rd_step).astype(np.int64)
+        key = (int(winning_team), int(number_of_teams)) + tuple(ratings_q.tolist()) + tuple(rds_q.tolist())
+        return key, (ratings_q * self.rating_step).tolist(), (rds_q * self.rd_step).tolist()
+
+    def get(self, key):
+        with self._lock:
+            result = self._results.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self._results.move_to_end(key)
+            self.hits += 1
+        return UpdateMmrResponseBody(ratings_list=list(result[0]), rds_list=list(result[1]))
+
+    def put(self, key, result):
+        with self._lock:
+            self._results[key] = (tuple(result.ratings_list), tuple(result.rds_list))
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+
+    def __len__(self):
+        return len(self._results)
+
+    def info(self):
+        """Usage of the cache.
+
+        Returns:
+            A dict with the hits, misses, hit_rate, size and max_size of the cache.
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self), "max_size": self.max_size}
+
+
+class SharedRatingCache(RatingCache):
+    """
+    RatingCache stored in a memory-mapped file, shared by every process of the host which opens the same path.
+
+    The file is a table of max_size fixed size records (games of up to max_players players), a game
+    is stored in the record its key hashes to, replacing whatever was there (so eviction is by
+    collision rather than least recently used). Records are written without locks, each carries a
+    checksum of its content and a record which does not match it (being written, or torn by two
+    writers) reads as a miss. Hit and miss counts are those of the current process.
+
+    The records follow a JSON header describing what produced them: the version of the format, the sizes of the
+    table, the quantization, the parameters of the rating model and options, the options of the rating updates
+    (e.g. the integrator and tol of main.RATING_OPTIONS). A file left by a service with other settings (a
+    previous deploy) does not match it and is replaced by an empty table, under a lock on path + ".lock" so that
+    the processes opening it at the same time replace it once.
+    """
+
+    # version of the file format, in its header
+    VERSION = 1
+
+    # bytes before the records: uint64 length of the JSON header, the header and zero padding
+    HEADER_BYTES = 4096
+
+    # checksum, number of players, winning team, number of teams
+    _HEADER = 4
+
+    def __init__(self, path, max_size=10000, rating_step=1.0, rd_step=1.0, max_players=16, options=None):
+        super().__init__(max_size, rating_step, rd_step)
+        self.path = path
+        self.max_players = max_players
+        self._record_size = self._HEADER + 4 * max_players
+        self.header = {"version": self.VERSION, "max_size": max_size, "record_size": self._record_size,
+                       "max_players": max_players, "rating_step": rating_step, "rd_step": rd_step,
+                       "model": {"beta": BETA, "c_sd": C_SD, "rd_min": RD_MIN, "rating_bounds": list(RATING_BOUNDS)},
+                       "options": dict(options or {})}
+        self._records = self._open(path, (max_size, self._record_size), self.header)
+
+    @classmethod
+    def _open(cls, path, shape, header):
+        with open(path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if cls.read_header(path) != json.loads(json.dumps(header)):
+                # a new file replaces the old one at once, the processes still mapping the old one keep using it
+                encoded = json.dumps(header, sort_keys=True).encode("utf-8")
+                if len(encoded) + 8 > cls.HEADER_BYTES:
+                    raise ValueError("The header of the rating cache does not fit in {} bytes".format(
+                        cls.HEADER_BYTES))
+                tmp_path = "{}.{}.tmp".format(path, os.getpid())
+                with open(tmp_path, "wb") as f:
+                    f.write(struct.pack("<Q", len(encoded)) + encoded)
+                    f.truncate(cls.HEADER_BYTES + int(np.prod(shape)) * np.dtype(np.float64).itemsize)
+                os.replace(tmp_path, path)
+            return np.memmap(path, dtype=np.float64, mode="r+", shape=shape, offset=cls.HEADER_BYTES)
+
+    @classmethod
+    def read_header(cls, path):
+        """The header of the cache file at path, None when there is no file or it is not a complete cache file."""
+        try:
+            with open(path, "rb") as f:
+                data = f.read(cls.HEADER_BYTES)
+                size = os.fstat(f.fileno()).st_size
+            (length,) = struct.unpack_from("<Q", data)
+            header = json.loads(data[8:8 + length].decode("utf-8"))
+            expected = cls.HEADER_BYTES + header["max_size"] * header["record_size"] * 8
+        except (OSError, struct.error, ValueError, TypeError, KeyError):
+            return None
+        return header if size == expected else None
+
+    def _slot(self, key):
+        return zlib.crc32(np.asarray(key, dtype=np.int64).tobytes()) % self.max_size
+
+    @staticmethod
+    def _checksum(record):
+        return float(zlib.crc32(record[1:].tobytes()))
+
+    def get(self, key):
+        number_of_players = (len(key) - 2) // 2
+        if number_of_players > self.max_players:
+            self.misses += 1
+            return None
+        record = np.array(self._records[self._slot(key)])
+        n = number_of_players
+        stored_key = (record[2], record[3]) + tuple(record[self._HEADER:self._HEADER + n]) + tuple(
+            record[self._HEADER + self.max_players:self._HEADER + self.max_players + n])
+        if record[0] != self._checksum(record) or record[1] != n or stored_key != key:
+            self.misses += 1
+            return None
+        self.hits += 1
+        values = self._HEADER + 2 * self.max_players
+        return UpdateMmrResponseBody(ratings_list=record[values:values + n].tolist(),
+                                     rds_list=record[values + self.max_players:values + self.max_players + n].tolist())
+
+    def put(self, key, result):
+        n = (len(key) - 2) // 2
+        if n > self.max_players:
+            return
+        record = np.zeros(self._record_size)
+        record[1:self._HEADER] = (n, key[0], key[1])
+        record[self._HEADER:self._HEADER + n] = key[2:2 + n]
+        record[self._HEADER + self.max_players:self._HEADER + self.max_players + n] = key[2 + n:]
+        values = self._HEADER + 2 * self.max_players
+        record[values:values + n] = result.ratings_list
+        record[values + self.max_players:values + self.max_players + n] = result.rds_list
+        record[0] = self._checksum(record)
+        self._records[self._slot(key)] = record
+
+    def __len__(self):
+        return int(np.count_nonzero(self._records[:, 1]))
@@ -0,0 +1,289 @@
+"""
+Replays a match history through the Bayesian rating update, e.g. to re-rate whole seasons after tuning BETA or RD_MIN.
+
+Match logs list games in chronological order, players of a game ordered team by team like ratings_list:
+    .csv: columns players (player ids separated by spaces), winning_team and number_of_teams
+    .jsonl: one game per line, {"players": [...], "winning_team": 0, "number_of_teams": 2}
+    .npz: columnar arrays players (all the player ids of all the games), offsets (games start at
+          players[offsets[g]] and end before players[offsets[g + 1]]), winning_team and number_of_teams
+
+Logs are read in chunks of games. Within a chunk every game is scheduled in the first round after the last game
+of each of its players, games of a round share no player so they are rated together (see update_games_arrays),
+and each player still sees its games in chronological order. Ratings therefore follow the same sequence of
+updates as rating the games one by one, but not to the last digit: the games of a batch are solved by
+find_map_batch and integrated by rds_grid together, whose convergence tests cover the whole batch. Inputs are
+clamped like the service clamps them, with clamp_inputs and the rd_min replayed, so that a replay with another
+rd_min reproduces a service running with it.
+
+Usage:
+    python -m mmr.replay matches.csv ratings.csv --beta 215 --rd-min 80 --checkpoint-dir checkpoints
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from common.constants import BETA
+from common.storage import save_arrays
+from mmr.bayesian_rating_w3c import RD_MIN, clamp_inputs, update_games_arrays, win_probabilities
+
+# a chunk of a match log, player ids of game g are players[offsets[g]:offsets[g + 1]]
+Matches = namedtuple("Matches", ["players", "offsets", "winning_team", "number_of_teams"])
+
+MATCH_FORMATS = (".csv", ".jsonl", ".npz")
+
+
+class PlayerTable:
+    """
+    Rating state of every player seen so far, stored in arrays indexed by the order players were first seen.
+
+    Examples:
+        ```python
+        table = PlayerTable()
+        rows = table.indices(["alice", "bob"])
+        table.ratings[rows], table.rds[rows]
+        ```
+    """
+
+    def __init__(self, initial_rating=1500.0, initial_rd=350.0, capacity=1024):
+        self.initial_rating = initial_rating
+        self.initial_rd = initial_rd
+        self.ids = []
+        self._rows = {}
+        self.ratings = np.full(capacity, initial_rating, dtype=float)
+        self.rds = np.full(capacity, initial_rd, dtype=float)
+        self.games = np.zeros(capacity, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def indices(self, ids):
+        """Rows of the players ids, players seen for the first time start at (initial_rating, initial_rd)."""
+        rows = np.empty(len(ids), dtype=np.int64)
+        for k, player in enumerate(ids):
+            row = self._rows.get(player)
+            if row is None:
+                row = self._add(player)
+            rows[k] = row
+        return rows
+
+    def _add(self, player):
+        row = len(self.ids)
+        if row == len(self.ratings):
+            # arrays double in size when full
+            capacity = 2 * len(self.ratings)
+            self.ratings = np.concatenate([self.ratings, np.full(capacity - row, self.initial_rating, dtype=float)])
+            self.rds = np.concatenate([self.rds, np.full(capacity - row, self.initial_rd, dtype=float)])
+            self.games = np.concatenate([self.games, np.zeros(capacity - row, dtype=np.int64)])
+        self.ids.append(player)
+        self._rows[player] = row
+        return row
+
+    def save(self, path):
+        """Writes the table to path, as .npz (ids, ratings, rds, games) or otherwise as csv."""
+        n = len(self)
+        if path.endswith(".npz"):
+            save_arrays(path, ids=np.array(self.ids), ratings=self.ratings[:n], rds=self.rds[:n],
+                        games=self.games[:n])
+            return
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["player", "rating", "rd", "games"])
+            for player, rating, rd, games in zip(self.ids, self.ratings[:n].tolist(), self.rds[:n].tolist(),
+                                                 self.games[:n].tolist()):
+                writer.writerow([player, rating, rd, games])
+
+    @classmethod
+    def load(cls, path, initial_rating=1500.0, initial_rd=350.0):
+        """Table saved by save() as .npz, e.g. a checkpoint to resume from."""
+        with np.load(path) as data:
+            table = cls(initial_rating, initial_rd, capacity=max(1024, len(data["ids"])))
+            rows = table.indices(data["ids"].tolist())
+            table.ratings[rows] = data["ratings"]
+            table.rds[rows] = data["rds"]
+            table.games[rows] = data["games"]
+        return table
+
+
+def read_matches(path, chunk_size=100000):
+    """Reads a match log in chunks of chunk_size games.
+
+    Yields:
+        Matches, with the player ids as read (strings for .csv and .jsonl).
+    """
+    extension = os.path.splitext(path)[1]
+    if extension == ".npz":
+        with np.load(path) as data:
+            players, offsets = data["players"], data["offsets"]
+            winning_team, number_of_teams = data["winning_team"], data["number_of_teams"]
+        for start in range(0, len(winning_team), chunk_size):
+            stop = min(start + chunk_size, len(winning_team))
+            yield Matches(players[offsets[start]:offsets[stop]], offsets[start:stop + 1] - offsets[start],
+                          winning_team[start:stop], number_of_teams[start:stop])
+        return
+    if extension == ".csv":
+        with open(path, newline="") as f:
+            rows = ((row["players"].split(), row["winning_team"], row["number_of_teams"])
+                    for row in csv.DictReader(f))
+            yield from _chunks(rows, chunk_size)
+    elif extension == ".jsonl":
+        with open(path) as f:
+            rows = (json.loads(line) for line in f if line.strip())
+            rows = ((row["players"], row["winning_team"], row["number_of_teams"]) for row in rows)
+            yield from _chunks(rows, chunk_size)
+    else:
+        raise ValueError("Unknown match log format '{}', expected one of {}".format(extension, MATCH_FORMATS))
+
+
+def _chunks(rows, chunk_size):
+    players, offsets, winning_team, number_of_teams = [], [0], [], []
+    for game_players, winning, teams in rows:
+        players.extend(game_players)
+        offsets.append(len(players))
+        winning_team.append(int(winning))
+        number_of_teams.append(int(teams))
+        if len(winning_team) == chunk_size:
+            yield Matches(np.array(players), np.array(offsets), np.array(winning_team), np.array(number_of_teams))
+            players, offsets, winning_team, number_of_teams = [], [0], [], []
+    if winning_team:
+        yield Matches(np.array(players), np.array(offsets), np.array(winning_team), np.array(number_of_teams))
+
+
+def schedule_rounds(rows, offsets):
+    """Round of each game: one more than the last round of any of its players (rows are table rows)."""
+    last_round = {}
+    rounds = np.empty(len(offsets) - 1, dtype=np.int64)
+    for g in range(len(rounds)):
+        game_rows = rows[offsets[g]:offsets[g + 1]].tolist()
+        r = max([last_round.get(row, -1) for row in game_rows]) + 1
+        for row in game_rows:
+            last_round[row] = r
+        rounds[g] = r
+    return rounds
+
+
+def rate_matches(table, matches, beta=BETA, rd_min=RD_MIN, rd_tol=0.01, batch_size=256, executor=None):
+    """Rates a chunk of games in order, updating table in place.
+
+    Args:
+        executor: Optional concurrent.futures executor rating the batches of each round in parallel.
+
+    Returns:
+        The pre-game win probability of each team of each game, an array of shape (games, most teams in a game)
+        with NaN past the number of teams of a game.
+    """
+    rows = table.indices(matches.players.tolist())
+    offsets = np.asarray(matches.offsets)
+    sizes = np.diff(offsets)
+    winning_team = np.asarray(matches.winning_team)
+    number_of_teams = np.asarray(matches.number_of_teams)
+    invalid = np.flatnonzero((number_of_teams < 2) | (sizes % np.maximum(number_of_teams, 1) != 0))
+    if len(invalid):
+        raise ValueError("Game {} has {} players which do not split in {} teams".format(
+            invalid[0], sizes[invalid[0]], number_of_teams[invalid[0]]))
+    probabilities = np.full((len(sizes), int(np.max(number_of_teams, initial=2))), np.nan)
+    rounds = schedule_rounds(rows, offsets)
+    order = np.lexsort((number_of_teams, sizes, rounds))
+    # games of the same round and shape are consecutive in order
+    keys = np.stack([rounds[order], sizes[order], number_of_teams[order]], axis=1)
+    starts = np.flatnonzero(np.concatenate([[True], np.any(keys[1:] != keys[:-1], axis=1)]))
+    stops = np.append(starts[1:], len(order))
+    round_starts = np.flatnonzero(np.concatenate([[True], keys[starts[1:], 0] != keys[starts[:-1], 0]]))
+    for first, last in zip(round_starts, np.append(round_starts[1:], len(starts))):
+        # batches of one round share no player
+        batches = []
+        for start, stop in zip(starts[first:last], stops[first:last]):
+            N, T = int(keys[start, 1]), int(keys[start, 2])
+            for k in range(start, stop, batch_size):
+                games = order[k:min(k + batch_size, stop)]
+                batches.append((rows[offsets[games][:, None] + np.arange(N)], games, T))
+        inputs = [clamp_inputs(table.ratings[game_rows], table.rds[game_rows], rd_min) for game_rows, _, _ in batches]
+        args = ([ratings_G for ratings_G, _ in inputs], [rds_G for _, rds_G in inputs],
+                [winning_team[games] for _, games, _ in batches], [T for _, _, T in batches],
+                [rd_tol] * len(batches), [beta] * len(batches), [rd_min] * len(batches))
+        results = executor.map(update_games_arrays, *args) if executor is not None else map(update_games_arrays,
+                                                                                             *args)
+        for (_, games, T), ratings_G, rds_G in zip(batches, args[0], args[1]):
+            probabilities[games, :T] = win_probabilities(ratings_G, rds_G, T, beta)
+        for (game_rows, _, _), (ratings_G_u, rds_G_u) in zip(batches, results):
+            table.ratings[game_rows] = ratings_G_u
+            table.rds[game_rows] = rds_G_u
+            table.games[game_rows] += 1
+    return probabilities
+
+
+def replay(path, table=None, beta=BETA, rd_min=RD_MIN, rd_tol=0.01, batch_size=256, chunk_size=100000,
+           checkpoint_dir=None, checkpoint_every=None, progress=None, executor=None):
+    """Rates every game of the match log at path in order.
+
+    Args:
+        table (PlayerTable): Starting state, a new table when None.
+        checkpoint_dir (str): Where the table is saved, as ratings-{games}.npz, after the chunk which reaches every
+            checkpoint_every games (chunk_size is reduced to checkpoint_every so checkpoints fall on chunks).
+        progress: Optional callable called with the number of games rated after each chunk.
+        executor: Optional executor rating the batches of each round in parallel, see rate_matches.
+
+    Returns:
+        The PlayerTable after the last game.
+    """
+    table = table if table is not None else PlayerTable()
+    if checkpoint_every:
+        chunk_size = min(chunk_size, checkpoint_every)
+    games = 0
+    next_checkpoint = checkpoint_every
+    for matches in read_matches(path, chunk_size):
+        rate_matches(table, matches, beta, rd_min, rd_tol, batch_size, executor)
+        games += len(matches.winning_team)
+        if checkpoint_dir and checkpoint_every and games >= next_checkpoint:
+            table.save(os.path.join(checkpoint_dir, "ratings-{:09d}.npz".format(games)))
+            next_checkpoint += checkpoint_every
+        if progress is not None:
+            progress(games)
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replays a match log through the Bayesian rating update.")
+    parser.add_argument("matches", help="match log, one of " + ", ".join(MATCH_FORMATS))
+    parser.add_argument("output", help="final ratings, .npz or .csv")
+    parser.add_argument("--beta", type=float, default=BETA)
+    parser.add_argument("--rd-min", type=float, default=RD_MIN)
+    parser.add_argument("--rd-tol", type=float, default=0.01)
+    parser.add_argument("--initial-rating", type=float, default=1500.0)
+    parser.add_argument("--initial-rd", type=float, default=350.0)
+    parser.add_argument("--resume", help="checkpoint (.npz) to start from instead of an empty table")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--checkpoint-dir")
+    parser.add_argument("--checkpoint-every", type=int)
+    parser.add_argument("--workers", type=int, default=1, help="processes rating the games of a round in parallel")
+    args = parser.parse_args(argv)
+
+    if args.resume:
+        table = PlayerTable.load(args.resume, args.initial_rating, args.initial_rd)
+    else:
+        table = PlayerTable(args.initial_rating, args.initial_rd)
+    start = time.perf_counter()
+
+    def progress(games):
+        elapsed = time.perf_counter() - start
+        print("{} games in {:.1f}s ({:.0f} games/min)".format(games, elapsed, 60 * games / elapsed), file=sys.stderr)
+
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            replay(args.matches, table, args.beta, args.rd_min, args.rd_tol, args.batch_size, args.chunk_size,
+                   args.checkpoint_dir, args.checkpoint_every, progress, executor)
+    else:
+        replay(args.matches, table, args.beta, args.rd_min, args.rd_tol, args.batch_size, args.chunk_size,
+               args.checkpoint_dir, args.checkpoint_every, progress)
+    table.save(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Sweeps the parameters of the Bayesian rating (BETA and RD_MIN) over a match history.
+
+Each candidate (beta, rd_min) replays the whole history (see mmr.replay) in its own worker process and is scored
+by how well the ratings before each game predicted its result, with the Bradley-Terry win probabilities of
+posterior_pdf (see win_probabilities):
+    log_loss: mean of -log(probability of the winning team)
+    brier: mean of sum over teams of (probability of the team - 1 if it won else 0) ** 2
+
+The history is read once and its arrays are written as .npy files to a temporary directory (on /dev/shm when
+available), which every worker memory-maps, so the workers share one copy of the history.
+
+Usage:
+    python -m mmr.sweep matches.csv --beta 150 215 300 --rd-min 60 80 100 --workers 4 --output sweep.csv
+"""
+import argparse
+import csv
+import itertools
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from common.storage import save_array
+from mmr.replay import Matches, PlayerTable, rate_matches, read_matches
+
+SweepResult = namedtuple("SweepResult", ["beta", "rd_min", "log_loss", "brier", "games"])
+
+_COLUMNS = ("players", "offsets", "winning_team", "number_of_teams")
+
+
+def share_matches(path, directory):
+    """Reads the match log at path into arrays saved in directory, player ids replaced by their row in a PlayerTable.
+
+    Returns:
+        The number of players.
+    """
+    table = PlayerTable()
+    players, offsets, winning_team, number_of_teams = [], [np.zeros(1, dtype=np.int64)], [], []
+    for matches in read_matches(path):
+        players.append(table.indices(matches.players.tolist()))
+        offsets.append(np.asarray(matches.offsets[1:]) + offsets[-1][-1])
+        winning_team.append(np.asarray(matches.winning_team))
+        number_of_teams.append(np.asarray(matches.number_of_teams))
+    for name, parts in zip(_COLUMNS, (players, offsets, winning_team, number_of_teams)):
+        save_array(os.path.join(directory, name + ".npy"),
+                   np.concatenate(parts).astype(np.int64) if parts else np.zeros(0, dtype=np.int64))
+    return len(table)
+
+
+def score(directory, num_players, beta, rd_min, rd_tol=0.01, batch_size=256, chunk_size=100000, burn_in=0,
+          initial_rating=1500.0, initial_rd=350.0):
+    """Replays the matches shared in directory with (beta, rd_min) and scores its pre-game predictions.
+
+    Args:
+        burn_in (int): Number of first games rated but not scored, while most ratings are still far from settled.
+
+    Returns:
+        A SweepResult.
+    """
+    players, offsets, winning_team, number_of_teams = (
+        np.load(os.path.join(directory, name + ".npy"), mmap_mode="r") for name in _COLUMNS)
+    table = PlayerTable(initial_rating, initial_rd, capacity=max(num_players, 1))
+    # the players of the history are numbered by order of appearance, so are the rows of the table
+    table.indices(range(num_players))
+    log_loss, brier, games = 0.0, 0.0, 0
+    for start in range(0, len(winning_team), chunk_size):
+        stop = min(start + chunk_size, len(winning_team))
+        chunk_offsets = np.array(offsets[start:stop + 1])
+        matches = Matches(np.array(players[chunk_offsets[0]:chunk_offsets[-1]]), chunk_offsets - chunk_offsets[0],
+                          np.array(winning_team[start:stop]), np.array(number_of_teams[start:stop]))
+        probabilities = rate_matches(table, matches, beta, rd_min, rd_tol, batch_size)
+        scored = np.arange(len(matches.winning_team)) >= burn_in - start
+        if not np.any(scored):
+            continue
+        probabilities = probabilities[scored]
+        won = matches.winning_team[scored]
+        outcomes = (np.arange(probabilities.shape[1]) == won[:, None]).astype(float)
+        p_won = probabilities[np.arange(len(won)), won]
+        log_loss -= np.sum(np.log(np.maximum(p_won, np.finfo(float).tiny)))
+        brier += np.sum(np.nansum((probabilities - outcomes) ** 2, axis=1))
+        games += len(won)
+    return SweepResult(beta, rd_min, log_loss / max(games, 1), brier / max(games, 1), games)
+
+
+def sweep(path, betas, rd_mins, workers=None, **kwargs):
+    """Scores every (beta, rd_min) of the grid betas x rd_mins on the match log at path, see score() for kwargs.
+
+    Returns:
+        The SweepResults, best (lowest log loss) first.
+    """
+    shared = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    directory = tempfile.mkdtemp(prefix="mmr-sweep-", dir=shared)
+    try:
+        num_players = share_matches(path, directory)
+        grid = list(itertools.product(betas, rd_mins))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(score, directory, num_players, beta, rd_min, **kwargs) for beta, rd_min in grid]
+            results = [future.result() for future in futures]
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return sorted(results, key=lambda result: (result.log_loss, result.brier))
+
+
+def format_table(results):
+    lines = ["{:>4} {:>10} {:>10} {:>10} {:>10} {:>10}".format("rank", "beta", "rd_min", "log_loss", "brier", "games")]
+    for rank, result in enumerate(results, 1):
+        lines.append("{:>4} {:>10g} {:>10g} {:>10.6f} {:>10.6f} {:>10}".format(
+            rank, result.beta, result.rd_min, result.log_loss, result.brier, result.games))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sweeps BETA and RD_MIN over a match log, ranked by log loss.")
+    parser.add_argument("matches", help="match log, see mmr.replay")
+    parser.add_argument("--beta", type=float, nargs="+", required=True)
+    parser.add_argument("--rd-min", type=float, nargs="+", required=True)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--burn-in", type=int, default=0, help="number of first games not scored")
+    parser.add_argument("--rd-tol", type=float, default=0.01)
+    parser.add_argument("--output", help="csv file for the ranked table")
+    args = parser.parse_args(argv)
+
+    results = sweep(args.matches, args.beta, args.rd_min, args.workers, burn_in=args.burn_in, rd_tol=args.rd_tol)
+    print(format_table(results))
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(("rank",) + SweepResult._fields)
+            for rank, result in enumerate(results, 1):
+                writer.writerow((rank,) + tuple(result))
+
+
+if __name__ == "__main__":
+    main()
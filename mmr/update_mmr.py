@@ -20,20 +20,30 @@ class UpdateMmrResponseBody(BaseModel):
     rds_list: list
 
 
-def update_after_game(ratings_list, rds_list, T1_won):
+# minimum rating deviation
+m = 60.24
+# volatility of the team players by team size
+vols = {4: 0.2375, 2: 0.1195}
+vol_default = 0.06
+
+# solver: "scipy" runs the original glicko2.Player / SLSQP / xi loop implementation, the default so that
+#             replays of past seasons reproduce their ratings,
+#         "vectorized" runs update_after_games on a single game, faster but its ratings can differ from SLSQP
+#             by a few points (SLSQP stops at its default ftol)
+SOLVERS = ("scipy", "vectorized")
+
+
+def update_after_game(ratings_list, rds_list, T1_won, solver="scipy"):
+    if solver == "vectorized":
+        ratings_G_u, rds_G_u = update_after_games(np.array([ratings_list], dtype=float),
+                                                  np.array([rds_list], dtype=float), np.array([T1_won]))
+        return UpdateMmrResponseBody(ratings_list=ratings_G_u[0].tolist(), rds_list=rds_G_u[0].tolist())
+    if solver != "scipy":
+        raise ValueError("Unknown solver '{}', expected one of {}".format(solver, SOLVERS))
     ratings_G = np.array(ratings_list)
     rds_G = np.array(rds_list)
     T_G = int(len(ratings_list) / 2)
-    m = 60.24
-    vol_4 = 0.2375
-    vol_2 = 0.1195
-    vol_1 = 0.06
-    if T_G == 4:
-        vol_p = vol_4
-    elif T_G == 2:
-        vol_p = vol_2
-    else:
-        vol_p = vol_1
+    vol_p = vols.get(T_G, vol_default)
     ratings_T1 = ratings_G[:T_G]
     ratings_T2 = ratings_G[T_G:]
 
@@ -147,6 +157,145 @@ def f_geomean_Delta(ratings_G_u, ratings_G_o, rds_G_o, delta_set):
 
     return (r_T1_u - r_T2_u - delta_set)
 
+
+# update_after_game for many games of the same size at once, without scipy:
+# ratings_G, rds_G are arrays of shape (B, N) with one game per row, T1_won an array of shape (B,)
+# returns the updated (ratings_G, rds_G).
+# The team Glicko-2 step is vectorized over games (glicko2_update), rating deviations are scaled in closed form
+# (update_RD_closed_form) and the ratings are projected with a few Newton steps (update_ratings_newton).
+def update_after_games(ratings_G, rds_G, T1_won):
+    ratings_G = np.asarray(ratings_G, dtype=float)
+    rds_G = np.asarray(rds_G, dtype=float)
+    T1_won = np.asarray(T1_won, dtype=float)
+    T_G = int(ratings_G.shape[1] / 2)
+    vol_p = vols.get(T_G, vol_default)
+
+    r_T1 = np.prod(np.power(ratings_G[:, :T_G], 1 / T_G), axis=1)
+    r_T2 = np.prod(np.power(ratings_G[:, T_G:], 1 / T_G), axis=1)
+    delta_o = (r_T1 - r_T2)
+    rd_T1 = np.sqrt(np.sum(np.power(rds_G[:, :T_G], 2), axis=1))
+    rd_T2 = np.sqrt(np.sum(np.power(rds_G[:, T_G:], 2), axis=1))
+
+    # both teams as glicko2 players, the second one is rated relative to the first, as in update_after_game
+    T1_rating, T1_rd = glicko2_update(r_T1, rd_T1, vol_p, r_T1 - delta_o * T_G, rd_T2, T1_won)
+    T2_rating, T2_rd = glicko2_update(r_T1 - delta_o * T_G, rd_T2, vol_p, r_T1, rd_T1, 1 - T1_won)
+
+    delta_u = 1 / T_G * (T1_rating - T2_rating)
+    xi_1 = T1_rd / rd_T1
+    xi_2 = T2_rd / rd_T2
+    rds_G_u = np.concatenate([update_RD_closed_form(rds_G[:, :T_G], m, xi_1),
+                              update_RD_closed_form(rds_G[:, T_G:], m, xi_2)], axis=1)
+    ratings_G_u = update_ratings_newton(ratings_G, rds_G, delta_u)
+    return ratings_G_u, rds_G_u
+
+
+# glicko2.Player(vol=vol).update_player([opponent_rating], [opponent_rd], [outcome]) for arrays of players,
+# returns their new (rating, rd). This follows the glicko2 package step by step, including its volatility
+# function which uses the player's rating where the Glicko-2 paper has its deviation.
+def glicko2_update(rating, rd, vol, opponent_rating, opponent_rd, outcome, tau=0.5, eps=0.000001):
+    scale = 173.7178
+    mu = (np.asarray(rating, dtype=float) - 1500) / scale
+    phi = np.asarray(rd, dtype=float) / scale
+    mu_j = (np.asarray(opponent_rating, dtype=float) - 1500) / scale
+    phi_j = np.asarray(opponent_rd, dtype=float) / scale
+
+    g = 1 / np.sqrt(1 + 3 * np.power(phi_j, 2) / np.pi ** 2)
+    E = 1 / (1 + np.exp(-g * (mu - mu_j)))
+    v = 1 / (np.power(g, 2) * E * (1 - E))
+    delta = v * g * (outcome - E)
+
+    # new volatility with the Illinois algorithm, iterated until every player converges
+    a = np.full(mu.shape, np.log(vol ** 2))
+
+    def f(x):
+        ex = np.exp(x)
+        return ex * (delta ** 2 - mu ** 2 - v - ex) / (2 * (mu ** 2 + v + ex) ** 2) - (x - a) / tau ** 2
+
+    A = a.copy()
+    large_delta = delta ** 2 > phi ** 2 + v
+    with np.errstate(invalid="ignore"):
+        B = np.where(large_delta, np.log(delta ** 2 - phi ** 2 - v), 0)
+    k = np.ones(mu.shape)
+    searching = ~large_delta
+    while np.any(searching):
+        searching &= f(a - k * tau) < 0
+        k += searching
+    B = np.where(large_delta, B, a - k * tau)
+    fA = f(A)
+    fB = f(B)
+    active = np.abs(B - A) > eps
+    while np.any(active):
+        C = A + (A - B) * fA / (fB - fA)
+        fC = f(C)
+        switch = fC * fB <= 0
+        A = np.where(active & switch, B, A)
+        fA = np.where(active & switch, fB, np.where(active, fA / 2.0, fA))
+        B = np.where(active, C, B)
+        fB = np.where(active, fC, fB)
+        active &= np.abs(B - A) > eps
+    new_vol = np.exp(A / 2)
+
+    phi_star = np.sqrt(phi ** 2 + new_vol ** 2)
+    new_phi = 1 / np.sqrt(1 / phi_star ** 2 + 1 / v)
+    new_mu = mu + new_phi ** 2 * g * (outcome - E)
+    return new_mu * scale + 1500, new_phi * scale
+
+
+# closed form of update_RD_for_Team for arrays of teams (rds_T of shape (B, P), xi of shape (B,)):
+# the updated deviations are max(m, c * rds_T) with the team deviation scaled by xi, which is what the
+# xi loop converges to. Sorting the deviations, the k largest are above the floor for exactly one k,
+# which gives c in closed form.
+def update_RD_closed_form(rds_T, m, xi):
+    rds_T = np.asarray(rds_T, dtype=float)
+    P = rds_T.shape[1]
+    target = xi ** 2 * np.sum(np.power(rds_T, 2), axis=1)
+    rds_sorted = -np.sort(-rds_T, axis=1)
+    k = np.arange(1, P + 1)
+    # c when the k largest deviations are above the floor and the others are at the floor
+    with np.errstate(invalid="ignore", divide="ignore"):
+        c = np.sqrt((target[:, None] - (P - k) * m ** 2) / np.cumsum(np.power(rds_sorted, 2), axis=1))
+    smallest_above = rds_sorted * c
+    next_below = np.concatenate([rds_sorted[:, 1:], np.zeros((len(rds_T), 1))], axis=1) * c
+    valid = (smallest_above >= m) & (next_below <= m)
+    # without any valid k the whole team is at the floor
+    c_T = np.where(np.any(valid, axis=1), c[np.arange(len(rds_T)), np.argmax(valid, axis=1)], 0)
+    return np.maximum(m, c_T[:, None] * rds_T)
+
+
+# update_ratings for arrays of games (ratings_G and rds_G of shape (B, N), delta_u of shape (B,)):
+# minimizes f_likelihood under the f_geomean_Delta constraint by Newton's method on its optimality conditions
+#   2 * (r - r_o) / rd ** 2 = lambda * grad(r_T1_u - r_T2_u),   r_T1_u - r_T2_u = delta_u
+# starting from the original ratings.
+def update_ratings_newton(ratings_G, rds_G, delta_u, max_iter=20, tol=1e-9):
+    B, N = ratings_G.shape
+    T_G = int(N / 2)
+    sign = np.concatenate([np.ones(T_G), -np.ones(T_G)])
+    same_team = np.equal.outer(sign, sign)
+    r = ratings_G.copy()
+    lam = np.zeros(B)
+    for _ in range(max_iter):
+        r_T = np.concatenate([np.repeat(np.prod(np.power(r[:, :T_G], 1 / T_G), axis=1)[:, None], T_G, axis=1),
+                              np.repeat(np.prod(np.power(r[:, T_G:], 1 / T_G), axis=1)[:, None], T_G, axis=1)],
+                             axis=1)
+        # gradient and Hessian of the constraint r_T1_u - r_T2_u
+        grad_c = sign * r_T / (T_G * r)
+        hess_c = same_team * (sign * r_T)[:, :, None] / (T_G ** 2 * r[:, :, None] * r[:, None, :])
+        hess_c[:, np.arange(N), np.arange(N)] -= sign * r_T / (T_G * r ** 2)
+        residual = np.concatenate([2 * (r - ratings_G) / rds_G ** 2 - lam[:, None] * grad_c,
+                                   (r_T[:, 0] - r_T[:, -1] - delta_u)[:, None]], axis=1)
+        if np.max(np.abs(residual)) < tol:
+            break
+        jacobian = np.zeros((B, N + 1, N + 1))
+        jacobian[:, :N, :N] = -lam[:, None, None] * hess_c
+        jacobian[:, np.arange(N), np.arange(N)] += 2 / rds_G ** 2
+        jacobian[:, :N, N] = -grad_c
+        jacobian[:, N, :N] = grad_c
+        step = np.linalg.solve(jacobian, -residual[:, :, None])[:, :, 0]
+        r = r + step[:, :N]
+        lam = lam + step[:, N]
+    return r
+
+
 # example usage:
 
 # update_after_game([1400, 1600, 1340, 1700, 1200, 1900, 1400, 1900], [61, 100, 100, 67, 65, 62, 63, 70], 1)
@@ -1,18 +1,110 @@
+import heapq
+import math
+import os
+import time
+from collections import namedtuple
+from functools import lru_cache
+from typing import Optional
+
 import numpy as np
 from itertools import combinations
 from pydantic import BaseModel
 
-from common.constants import C_SD, BETA
+from common import metrics
+from common.constants import BETA
+from common.odds import game_scale, softmax, team_strengths, win_probabilities
+from common.storage import save_array
+from teambalance.search import SearchResult, branch_and_bound
+
+SEARCH_MODES = ("exhaustive", "branch_and_bound", "auto")
+
+# the "auto" search mode enumerates game modes with up to this many games (3v3v3v3 has 15400, 4v4v4v4 2627625)
+AUTO_EXHAUSTIVE_MAX_GAMES = 100000
+
+# games scored at once by top_games() and iter_better_games()
+SCORE_CHUNK_SIZE = 8192
+
+# teams: the team (starting at 1) of each player, fairness: max(odds) - min(odds), odds: win probability of each team
+RankedGame = namedtuple("RankedGame", ["teams", "fairness", "odds"])
+
+# players: indices into the pool of the players of the lobby, teams: the team (starting at 1) of each of them
+Lobby = namedtuple("Lobby", ["players", "teams", "fairness"])
+
+# what find_best_lobbies() minimizes: the fairness of the least balanced lobby or the sum over the lobbies
+POOL_OBJECTIVES = ("max", "sum")
+
+# elements (lobbies x games x players) of the arrays scored at once by _lobbies_best_games()
+LOBBIES_CHUNK_ELEMENTS = 4000000
+
 
 class BalanceTeamRequestBody(BaseModel):
     ratings_list: list
     rds_list: list
     gamemode: str
+    # arranged teams in the form "T1+T2+T3+T4" (see Balance.find_best_game), all solo players if not set
+    team_constraints: Optional[str] = None
+    # search mode and time budget in seconds (see Balance.search_best_game)
+    search: str = "auto"
+    time_budget: float = 1.0
 
 
 class BalanceTeamResponseBody(BaseModel):
+    # the team (starting at 1) of each player, in the order of ratings_list
+    teams: list
+    # whether the game is proven to be the most balanced one
+    exact: bool = True
+
+
+class BalanceTopRequestBody(BaseModel):
+    ratings_list: list
+    rds_list: list
+    gamemode: str
+    team_constraints: Optional[str] = None
+    # number of games returned
+    k: int = 5
+    # stop the search once k games are at most this unfair (see Balance.top_games)
+    threshold: Optional[float] = None
+
+
+class RankedGameBody(BaseModel):
+    teams: list
+    fairness: float
+    # win probability of each team
+    odds: list
+
+
+class BalanceTopResponseBody(BaseModel):
+    # the fairest games first
+    games: list
+    # whether every game was scored, False when the threshold stopped the search early
+    exact: bool = True
+
+
+class BalancePoolRequestBody(BaseModel):
+    # the players of the pool, split in len(ratings_list) / players of gamemode lobbies
     ratings_list: list
     rds_list: list
+    gamemode: str
+    # see POOL_OBJECTIVES
+    objective: str = "max"
+    # seconds the swaps between lobbies may take
+    time_budget: float = 0.5
+
+
+class LobbyBody(BaseModel):
+    # indices into ratings_list of the players of the lobby
+    players: list
+    # the team (starting at 1) of each player of the lobby
+    teams: list
+    fairness: float
+
+
+class BalancePoolResponseBody(BaseModel):
+    lobbies: list
+    # fairness of the least balanced lobby
+    max_fairness: float
+    # sum of the fairness of the lobbies
+    total_fairness: float
 
 
 class Balance:
@@ -23,6 +115,8 @@ class Balance:
     As we go from 15400 possibilities to 369600 - it's really worth doing it as runtime goes from ~1 sec to 30 secs.
     I generalized this to make it for any number of teams & number of players on the team.
     This only needs to be done "once" ever - so need to make sure it's not recalculated needlessly all the time
+    Each game mode's set is kept as a compact int8 matrix with the team of each player in each game,
+    which can be saved to and memory-mapped from superset_dir so that worker processes share it.
 
     Examples:
         ```python
@@ -42,8 +136,22 @@ class Balance:
         ```
     """
 
-    def __init__(self):
+    def __init__(self, superset_dir=None, constraints_cache_size=256):
+        """
+        Args:
+            superset_dir (str): Optional directory where supersets are saved as "<game_mode>.npy"
+                the first time they are generated, and memory-mapped from on later loads,
+                so that processes of the same host share their pages instead of each building its own copy.
+            constraints_cache_size (int): How many (game_mode, team_constraints) pairs keep
+                their constrained games cached, least recently used first out.
+        """
         self.superset = {}
+        self.superset_dir = superset_dir
+        self.potential_games = {}
+        self.team_masks = {}
+        # constrained games by (game_mode, team_constraints) loaded from a shared state, see teambalance.shared
+        self.shared_constrained_games = {}
+        self._constrained_games = lru_cache(maxsize=constraints_cache_size)(self._index_constraints)
 
     def parse_game_mode(self, game_mode):
         """Parse a game mode string into number of teams and players.
@@ -62,47 +170,63 @@ class Balance:
         num_players_per_team = int(game_mode[0])
         return (num_teams, num_players_per_team)
 
-    def _recursion(self, set_players, potential_games, num_players_per_team):
-        """Expands the set of potential_games by adding (all the possible combinations of)
-           a new team. This function gets called (T-1) times where T is the number
-           of teams for that game mode.
+    def generate_superset(self, num_teams, num_players_per_team):
+        """Generates the set of unique games with a certain number of players
+           and a certain number of players per team.
+
+           Each game is generated once in its canonical form: players are sorted within teams
+           and teams are ordered by their first player, which is the lowest player left when
+           the team gets picked. Every team is thus the lowest player left plus any combination
+           of the others, and these combinations are the same for every game at a given team,
+           so whole teams are added to all games at once.
 
         Args:
-            set_players: the set players.
-            potential_games: the incomplete set of potential games.
-            num_players_per_team: the number of players per team.
+            num_teams (int): Number of participating teams.
+            num_players_per_team (int): Number of players for each team.
 
         Returns:
-            Potential_games with one more team than before call.
+            A matrix (games x players) with the team (from 0 to num_teams-1) of each player in each unique game.
         """
-        potential_game_next = []
-        for game in potential_games:
-            set_players_left = set_players - set([p for team in game for p in list(team)])
-            for team in combinations(set_players_left, num_players_per_team):
-                game_copy = game.copy()
-                game_copy.append(frozenset(team))
-                potential_game_next.append(game_copy)
+        num_players = num_teams * num_players_per_team
+        dtype = np.int8 if num_players <= np.iinfo(np.int8).max else np.int16
+        games = np.zeros((1, 0), dtype=dtype)
+        players_left = np.arange(num_players, dtype=dtype)[None, :]
+        for num_left in range(num_players, 0, -num_players_per_team):
+            # positions (among the players left) of the players of the next team, the first is always picked
+            picked = np.array([(0,) + c for c in combinations(range(1, num_left), num_players_per_team - 1)],
+                              dtype=np.intp)
+            not_picked = np.array([[k for k in range(num_left) if k not in team] for team in picked],
+                                  dtype=np.intp).reshape(len(picked), num_left - num_players_per_team)
+            games = np.concatenate([np.repeat(games, len(picked), axis=0),
+                                    players_left[:, picked].reshape(-1, num_players_per_team)], axis=1)
+            players_left = players_left[:, not_picked].reshape(len(games), num_left - num_players_per_team)
+        # games lists players ordered by team, invert it into the team of each player
+        teams = np.empty(games.shape, dtype=dtype)
+        np.put_along_axis(teams, games.astype(np.intp),
+                          (np.arange(num_players) // num_players_per_team).astype(dtype)[None, :], axis=1)
+        return teams
 
-        return potential_game_next
-
-    def generate_superset(self, num_teams, num_players_per_team):
-        """Generates the set of unique games with a certain number of players
-           and a certain number of players per team.
+    def get_superset(self, game_mode):
+        """Returns the superset of a game mode, generating it (or loading it from superset_dir)
+           the first time it is needed.
 
         Args:
-            num_teams (int): Number of participating teams.
-            num_players_per_team (int): Number of players for each team.
+            game_mode (str): Game mode in the form "PvPvP" (e.g. "3v3v3v3").
 
         Returns:
-            A set that has all the unique games for that game mode.
+            The matrix of unique games of generate_superset().
         """
-        set_players = set(i for i in range(num_teams * num_players_per_team))
-        potential_games = []
-        for c in combinations(set_players, num_players_per_team):
-            potential_games.append([frozenset(c)])
-        for k in range(1,num_teams):
-            potential_games = self._recursion(set_players, potential_games, num_players_per_team)
-        return set(frozenset(game) for game in potential_games)
+        if game_mode not in self.superset:
+            path = os.path.join(self.superset_dir, game_mode + ".npy") if self.superset_dir else None
+            if path and os.path.exists(path):
+                self.superset[game_mode] = np.load(path, mmap_mode="r")
+            else:
+                superset = self.generate_superset(*self.parse_game_mode(game_mode))
+                if path:
+                    save_array(path, superset)
+                    superset = np.load(path, mmap_mode="r")
+                self.superset[game_mode] = superset
+        return self.superset[game_mode]
 
     def _game_odds(self, ratings_game, rds, num_teams, num_players_per_team):
         """This gives the winning odds for each team for configuration of the game.
@@ -116,39 +240,207 @@ class Balance:
         Returns:
             a list of length num_teams with the modeled win probability for each team as values
         """
-        num_players_per_game = len(rds)
-        rd_game = np.sqrt(np.sum(rds ** 2) + num_players_per_game * BETA ** 2)
-
-        rating_teams = []
-        for team_index in range(num_teams):
-            #ratings of the players on the team
-            cur_game_ratings = ratings_game[team_index*num_players_per_team:(team_index + 1)*num_players_per_team]
-            #geometric mean of the ratings on the team
-            team_rating = np.prod(np.power(cur_game_ratings, 1 / float(num_players_per_team)))
-            rating_teams.append(team_rating)
-        ratings_T = np.array(rating_teams)
-        #winning odds from Bradley-terry model
-        odds = np.exp((num_players_per_team * ratings_T) / (C_SD * rd_game)) / np.sum(np.exp((num_players_per_team * ratings_T) / (C_SD * rd_game)))
-        return odds
+        #winning odds from Bradley-terry model, see common.odds
+        return win_probabilities(ratings_game, rds, num_teams, BETA)
 
-    def _filter_constraints(self, gm_set, gm_const):
+    def _games_odds(self, log_ratings_games, rds, num_teams, num_players_per_team):
+        """_game_odds() for many games at once.
+
+        Args:
+            log_ratings_games: matrix (games x players) of the log of the ratings of players
+                in each potential game, ordered by team
+            rds: rating deviations of players in the potential game
+            num_teams (int): Number of participating teams.
+            num_players_per_team (int): Number of players for each team.
+
+        Returns:
+            a matrix (games x num_teams) with the modeled win probability for each team of each game
+        """
+        #winning odds from Bradley-terry model, see common.odds
+        return softmax(team_strengths(log_ratings_games, game_scale(rds, BETA), num_teams))
+
+    def _potential_games(self, game_mode):
+        """The players of each game of the superset ordered by team, by index within a team."""
+        if game_mode not in self.potential_games:
+            superset = self.get_superset(game_mode)
+            self.potential_games[game_mode] = np.argsort(superset, axis=1, kind="stable").astype(superset.dtype)
+        return self.potential_games[game_mode]
+
+    def _team_masks(self, game_mode):
+        """Bitmask of the players of each team of each game of the superset (games x teams)."""
+        if game_mode not in self.team_masks:
+            superset = self.get_superset(game_mode)
+            num_games, num_players = superset.shape
+            team_masks = np.zeros((num_games, self.parse_game_mode(game_mode)[0]), dtype=np.uint64)
+            for p in range(num_players):
+                team_masks[np.arange(num_games), superset[:, p]] |= np.uint64(1 << p)
+            self.team_masks[game_mode] = team_masks
+        return self.team_masks[game_mode]
+
+    def _index_constraints(self, game_mode, team_constraints):
+        """Indices of the games of the superset which satisfy the constraints, see constrained_games()."""
+        team_masks = self._team_masks(game_mode)
+        keep = np.ones(len(team_masks), dtype=bool)
         k = 0
-        teams = gm_const.split('+')
-        set_teams = set()
-        for team_size in teams:
-            arranged_team = frozenset(k + i for i in range(int(team_size)))
+        for team_size in team_constraints.split('+'):
+            # an arranged team is satisfied when it is a subset of one of the teams, solo players always are
+            if int(team_size) > 1:
+                arranged_team = np.uint64(((1 << int(team_size)) - 1) << k)
+                keep &= np.any(team_masks & arranged_team == arranged_team, axis=1)
             k += int(team_size)
-            set_teams.add(arranged_team)
-        gm_spec_set = set()
-        for potential_game in gm_set:
-            all_constraints = []
-            for arranged_team in set_teams:
-                all_constraints.append(any([arranged_team.issubset(team) for team in potential_game]))
-            if all(all_constraints):
-                gm_spec_set.add(potential_game)
-        return gm_spec_set
-
-    def find_best_game(self, ratings, rds, game_mode, team_constraints):
+        constrained = np.flatnonzero(keep)
+        constrained.setflags(write=False)
+        return constrained
+
+    def constrained_games(self, game_mode, team_constraints):
+        """Indices of the games of the superset of game_mode which satisfy team_constraints.
+           Results are cached, see constraints_cache_info().
+
+        Args:
+            game_mode (str): Game mode in the form "PvPvP" (e.g. "3v3v3v3").
+            team_constraints (str): A string in the form "T1+T2+T3+T4" (e.g. 1+1+2+1) that entails the AT constraints.
+
+        Returns:
+            A read-only array of indices into get_superset(game_mode).
+        """
+        constrained = self.shared_constrained_games.get((game_mode, team_constraints))
+        if constrained is not None:
+            return constrained
+        return self._constrained_games(game_mode, team_constraints)
+
+    def constraints_cache_info(self):
+        """Usage of the cache of constrained_games().
+
+        Returns:
+            A dict with the hits, misses, hit_rate, size and max_size of the cache.
+        """
+        info = self._constrained_games.cache_info()
+        lookups = info.hits + info.misses
+        return {"hits": info.hits, "misses": info.misses, "hit_rate": info.hits / lookups if lookups else 0.0,
+                "size": info.currsize, "max_size": info.maxsize}
+
+    def warm_up(self, game_mode, team_constraints=None):
+        """Builds (or loads from superset_dir) everything the exhaustive search of game_mode needs,
+        so that the first request of the game mode does not pay for it.
+
+        Args:
+            game_mode (str): Game mode in the form "PvPvP" (e.g. "3v3v3v3").
+            team_constraints (list): Constraints to index ahead of time, arranged_team_constraints() by default.
+
+        Returns:
+            The number of constraint sets indexed, 0 for game modes searched by branch and bound.
+        """
+        if self.num_games(game_mode) > AUTO_EXHAUSTIVE_MAX_GAMES:
+            return 0
+        self._potential_games(game_mode)
+        if team_constraints is None:
+            team_constraints = self.arranged_team_constraints(game_mode)
+        for constraints in team_constraints:
+            self.constrained_games(game_mode, constraints)
+        return len(team_constraints)
+
+    def arranged_team_constraints(self, game_mode):
+        """Every way to split the players of game_mode in arranged teams which fit in its teams, listed from the
+        biggest team to the smallest (e.g. "2+2+1+1"), the constraints warm_up() indexes by default.
+        """
+        (num_teams, num_players_per_team) = self.parse_game_mode(game_mode)
+        return ["+".join(str(size) for size in sizes)
+                for sizes in _arranged_team_sizes(num_teams * num_players_per_team, num_players_per_team)
+                if _fits_teams(sizes, num_teams, num_players_per_team)]
+
+    def check_team_constraints(self, game_mode, num_players, team_constraints):
+        """Checks that a game of num_players players can be played in game_mode with team_constraints.
+
+        Raises:
+            ValueError: The game mode does not have num_players players, or the arranged teams of team_constraints
+                do not add up to them or cannot be packed in the teams of the game mode.
+        """
+        (num_teams, num_players_per_team) = self.parse_game_mode(game_mode)
+        if num_players != num_teams * num_players_per_team:
+            raise ValueError("Game mode '{}' has {} players, not {}".format(
+                game_mode, num_teams * num_players_per_team, num_players))
+        try:
+            sizes = [int(size) for size in team_constraints.split("+")]
+        except ValueError:
+            raise ValueError("Arranged teams '{}' are not in the form T1+T2+T3".format(team_constraints))
+        if min(sizes) < 1 or sum(sizes) != num_players:
+            raise ValueError("Arranged teams '{}' do not add up to the {} players".format(team_constraints,
+                                                                                        num_players))
+        if not _fits_teams(sizes, num_teams, num_players_per_team):
+            raise ValueError("Arranged teams '{}' do not fit in {} teams of {}".format(
+                team_constraints, num_teams, num_players_per_team))
+
+    def check_search(self, game_mode, search):
+        """Checks that search_best_game() can search game_mode with search.
+
+        Raises:
+            ValueError: search is not one of SEARCH_MODES, or is "exhaustive" for a game mode of more than
+                AUTO_EXHAUSTIVE_MAX_GAMES games.
+        """
+        if search not in SEARCH_MODES:
+            raise ValueError("Unknown search mode '{}', expected one of {}".format(search, SEARCH_MODES))
+        if search == "exhaustive" and self.num_games(game_mode) > AUTO_EXHAUSTIVE_MAX_GAMES:
+            raise ValueError("Game mode '{}' has too many games to search them exhaustively".format(game_mode))
+
+    def _constraints_mask(self, gm_set, gm_const):
+        """Which games of gm_set satisfy the constraints, see _filter_constraints()."""
+        keep = np.ones(len(gm_set), dtype=bool)
+        k = 0
+        for team_size in gm_const.split('+'):
+            arranged_team = gm_set[:, k:k + int(team_size)]
+            keep &= np.all(arranged_team == arranged_team[:, :1], axis=1)
+            k += int(team_size)
+        return keep
+
+    def _filter_constraints(self, gm_set, gm_const):
+        """Keeps the games where the players of each arranged team play on the same team.
+
+        Args:
+            gm_set: matrix of games (games x players) from generate_superset().
+            gm_const (str): A string in the form "T1+T2+T3+T4" (e.g. 1+1+2+1) that entails the AT constraints,
+                players of an arranged team are consecutive.
+
+        Returns:
+            The rows of gm_set which satisfy the constraints.
+        """
+        return gm_set[self._constraints_mask(gm_set, gm_const)]
+
+    def num_games(self, game_mode):
+        """Number of unique games of a game mode, without generating them."""
+        (num_teams, num_players_per_team) = self.parse_game_mode(game_mode)
+        return math.factorial(num_teams * num_players_per_team) // (
+                math.factorial(num_players_per_team) ** num_teams * math.factorial(num_teams))
+
+    def search_best_game(self, ratings, rds, game_mode, team_constraints, search="auto", time_budget=1.0):
+        """Finds the most balanced game with the given search mode.
+
+        Args:
+            ratings: ratings of players in the potential game
+            rds: rating deviations of players in the potential game
+            game_mode (str): Game mode in the form "PvPvP" or "PonPonP" (e.g. "3v3v3v3").
+            team_constraints (str): A string in the form "T1+T2+T3+T4" (e.g. 1+1+2+1) that entails the AT constraints.
+            search (str): One of SEARCH_MODES
+                "exhaustive": scores every game of the superset, always exact.
+                "branch_and_bound": search.branch_and_bound() within time_budget, for modes too large to enumerate.
+                "auto": exhaustive up to AUTO_EXHAUSTIVE_MAX_GAMES games in the game mode, branch and bound above.
+            time_budget (float): Seconds the branch and bound search may take.
+
+        Returns:
+            A search.SearchResult with the team of each player, the fairness of the game and whether it is exact.
+
+        Raises:
+            ValueError: The search mode cannot search the game mode, see check_search().
+        """
+        self.check_search(game_mode, search)
+        if search == "auto":
+            search = "exhaustive" if self.num_games(game_mode) <= AUTO_EXHAUSTIVE_MAX_GAMES else "branch_and_bound"
+        if search == "exhaustive":
+            return self._exhaustive_search(ratings, rds, game_mode, team_constraints)
+        (num_teams, num_players_per_team) = self.parse_game_mode(game_mode)
+        with metrics.timer("branch_and_bound"):
+            return branch_and_bound(ratings, rds, num_teams, num_players_per_team, team_constraints, time_budget)
+
+    def find_best_game(self, ratings, rds, game_mode, team_constraints, search="exhaustive", time_budget=1.0):
         """Finds the most balanced game.
 
         Args:
@@ -156,26 +448,250 @@ class Balance:
             rds: rating deviations of players in the potential game
             game_mode (str): Game mode in the form "PvPvP" or "PonPonP" (e.g. "3v3v3v3").
             team_constraints (str): A string in the form "T1+T2+T3+T4" (e.g. 1+1+2+1) that entails the AT constraints.
+            search (str): Search mode, see search_best_game().
+            time_budget (float): Seconds the branch and bound search may take.
         Returns:
             a list with the index of the team each player should be put on
         """
+        return self.search_best_game(ratings, rds, game_mode, team_constraints, search, time_budget).teams
+
+    def _scored_games(self, ratings, rds, game_mode, team_constraints, chunk_size=SCORE_CHUNK_SIZE):
+        """Scores the games of the superset which satisfy the constraints, chunk_size games at a time.
+
+        Yields:
+            Tuples (games, fairness, odds) with the indices into the superset of the games of the chunk,
+            their fairness and their odds (games x teams).
+        """
         (num_teams, num_players_per_team) = self.parse_game_mode(game_mode)
+        if self.num_games(game_mode) > AUTO_EXHAUSTIVE_MAX_GAMES:
+            raise ValueError("Game mode '{}' has too many games to score them all".format(game_mode))
+        constrained = self.constrained_games(game_mode, team_constraints)
+        potential_games = self._potential_games(game_mode)
+        with np.errstate(divide="ignore"):
+            log_ratings = np.log(ratings)
+        for start in range(0, len(constrained), chunk_size):
+            games = constrained[start:start + chunk_size]
+            with metrics.timer("games_odds"):
+                odds = self._games_odds(log_ratings[potential_games[games]], rds, num_teams, num_players_per_team)
+            yield games, np.max(odds, axis=1) - np.min(odds, axis=1), odds
 
-        if game_mode not in self.superset:
-            self.superset[game_mode] = self.generate_superset(num_teams,
-                                                              num_players_per_team)
-        games_set_constrained = self._filter_constraints(self.superset[game_mode], team_constraints)
-        most_fair = 1
-        for game in games_set_constrained:
-            potential_game = [p for Team in game for p in Team]
-            ratings_game = ratings[potential_game]
-            odds = self._game_odds(ratings_game, rds, num_teams, num_players_per_team)
-            
-            # That's helpstone's metric for a fair game.
-            fairness_game = np.max(odds) - np.min(odds)
-
-            if fairness_game < most_fair:
-                best_game = potential_game
-                most_fair = fairness_game
+    def _ranked_game(self, game_mode, game, fairness, odds):
+        # the superset holds the team (from 0) of each player, numbered by order of their first player
+        return RankedGame(teams=(self.get_superset(game_mode)[game].astype(int) + 1).tolist(), fairness=float(fairness),
+                          odds=odds.tolist())
+
+    def top_games(self, ratings, rds, game_mode, team_constraints, k=5, threshold=None,
+                  chunk_size=SCORE_CHUNK_SIZE):
+        """The k most balanced games, found in one pass over the games satisfying the constraints.
+
+        Each chunk of games only passes its k fairest (np.argpartition) to a heap holding the k fairest so far.
+        Ties are settled by the order of the superset, like search_best_game().
+
+        Args:
+            ratings: ratings of players in the potential game
+            rds: rating deviations of players in the potential game
+            game_mode (str): Game mode in the form "PvPvP" (e.g. "3v3v3v3"),
+                with at most AUTO_EXHAUSTIVE_MAX_GAMES games.
+            team_constraints (str): A string in the form "T1+T2+T3+T4" (e.g. 1+1+2+1) that entails the AT constraints.
+            k (int): Number of games returned, fewer when fewer games satisfy the constraints.
+            threshold (float): Stops the search once k games have a fairness of at most threshold.
+            chunk_size (int): Games scored at once.
+
+        Returns:
+            A tuple (games, exact) with the RankedGames fairest first and whether every game was scored.
+        """
+        # (-fairness, -game, odds): the least fair of the games kept, last in the superset among ties, on top
+        heap = []
+        exact = True
+        for games, fairness, odds in self._scored_games(ratings, rds, game_mode, team_constraints, chunk_size):
+            kept = np.argpartition(fairness, k - 1)[:k] if len(games) > k else range(len(games))
+            for g in kept:
+                item = (-float(fairness[g]), -int(games[g]), odds[g])
+                if len(heap) < k:
+                    heapq.heappush(heap, item)
+                elif item[:2] > heap[0][:2]:
+                    heapq.heapreplace(heap, item)
+            if threshold is not None and len(heap) == k and -heap[0][0] <= threshold:
+                exact = bool(games[-1] == self.constrained_games(game_mode, team_constraints)[-1])
+                break
+        ranked = sorted(heap, key=lambda item: (-item[0], -item[1]))
+        return [self._ranked_game(game_mode, -game, -fairness, odds) for fairness, game, odds in ranked], exact
+
+    def iter_better_games(self, ratings, rds, game_mode, team_constraints, threshold=None,
+                          chunk_size=SCORE_CHUNK_SIZE):
+        """Streams the games of top_games() which are more balanced than all the games scored before them,
+        so that the caller can stop at any game that is fair enough.
+
+        Args:
+            threshold (float): Stops after the first game with a fairness of at most threshold.
+
+        Yields:
+            RankedGames, each more balanced than the previous one, the last one is the most balanced game
+            when the stream runs to its end without reaching the threshold.
+        """
+        best = np.inf
+        for games, fairness, odds in self._scored_games(ratings, rds, game_mode, team_constraints, chunk_size):
+            g = int(np.argmin(fairness))
+            if fairness[g] < best:
+                best = fairness[g]
+                yield self._ranked_game(game_mode, games[g], fairness[g], odds[g])
+                if threshold is not None and best <= threshold:
+                    return
+
+    def _lobbies_best_games(self, log_ratings, rds, game_mode):
+        """Most balanced game of many lobbies of solo players at once.
+
+        Args:
+            log_ratings: matrix (lobbies x players) of the log ratings of the players of each lobby
+            rds: matrix (lobbies x players) of their rating deviations
+            game_mode (str): Game mode of the lobbies.
+
+        Returns:
+            A tuple (games, fairness) with the index into the superset of the best game of each lobby and its fairness.
+        """
+        (num_teams, num_players_per_team) = self.parse_game_mode(game_mode)
+        potential_games = self._potential_games(game_mode)
+        num_lobbies = len(log_ratings)
+        scale = game_scale(rds, BETA)
+        games = np.empty(num_lobbies, dtype=np.intp)
+        fairness = np.empty(num_lobbies)
+        chunk = max(1, LOBBIES_CHUNK_ELEMENTS // potential_games.size)
+        for start in range(0, num_lobbies, chunk):
+            stop = min(start + chunk, num_lobbies)
+            # same odds as _games_odds(), with the rating deviation of each lobby
+            odds = softmax(team_strengths(log_ratings[start:stop, potential_games], scale[start:stop, None],
+                                          num_teams))
+            fairness_games = np.max(odds, axis=2) - np.min(odds, axis=2)
+            games[start:stop] = np.argmin(fairness_games, axis=1)
+            fairness[start:stop] = fairness_games[np.arange(stop - start), games[start:stop]]
+        return games, fairness
+
+    def find_best_lobbies(self, ratings, rds, game_mode, objective="max", time_budget=0.5):
+        """Splits a pool of solo players in lobbies of game_mode and balances the game of each lobby.
+
+        The lobbies start as runs of players of similar ratings, then the swap of two players between two lobbies
+        which most improves the objective is applied, pair of lobbies after pair of lobbies, until no swap does
+        (or time_budget runs out). All the swaps of a pair of lobbies are scored at once (see _lobbies_best_games()),
+        which for 48 players in 4v4 lobbies is 15 pairs of 64 swaps.
+
+        Args:
+            ratings: ratings of the players of the pool
+            rds: rating deviations of the players of the pool
+            game_mode (str): Game mode of the lobbies, with at most AUTO_EXHAUSTIVE_MAX_GAMES games.
+            objective (str): One of POOL_OBJECTIVES
+                "max": the fairness of the least balanced lobby, then the sum of the fairness of the lobbies.
+                "sum": the sum of the fairness of the lobbies.
+            time_budget (float): Seconds after which the swaps stop.
+
+        Returns:
+            The Lobbies, strongest first.
+        """
+        (num_teams, num_players_per_team) = self.parse_game_mode(game_mode)
+        num_players = num_teams * num_players_per_team
+        if objective not in POOL_OBJECTIVES:
+            raise ValueError("Unknown objective '{}', expected one of {}".format(objective, POOL_OBJECTIVES))
+        if len(ratings) == 0 or len(ratings) % num_players:
+            raise ValueError("A pool of {} players does not split in lobbies of {} players".format(
+                len(ratings), num_players))
+        if self.num_games(game_mode) > AUTO_EXHAUSTIVE_MAX_GAMES:
+            raise ValueError("Game mode '{}' has too many games to balance lobbies of it".format(game_mode))
+        deadline = time.perf_counter() + time_budget
+        rds = np.asarray(rds, dtype=float)
+        with np.errstate(divide="ignore"):
+            log_ratings = np.log(np.asarray(ratings, dtype=float))
+
+        lobbies = np.argsort(-log_ratings, kind="stable").reshape(-1, num_players)
+        with metrics.timer("lobbies_best_games"):
+            games, fairness = self._lobbies_best_games(log_ratings[lobbies], rds[lobbies], game_mode)
+        # the swap s exchanges the player swapped[s, 0] of a lobby with the player swapped[s, 1] of the other
+        swapped = np.divmod(np.arange(num_players ** 2), num_players)
+        swaps = np.arange(num_players ** 2)
+        improved = True
+        while improved and time.perf_counter() < deadline:
+            improved = False
+            for a, b in combinations(range(len(lobbies)), 2):
+                if time.perf_counter() >= deadline:
+                    break
+                lobbies_a = np.repeat(lobbies[a][None, :], len(swaps), axis=0)
+                lobbies_b = np.repeat(lobbies[b][None, :], len(swaps), axis=0)
+                lobbies_a[swaps, swapped[0]] = lobbies[b][swapped[1]]
+                lobbies_b[swaps, swapped[1]] = lobbies[a][swapped[0]]
+                candidates = np.concatenate([lobbies_a, lobbies_b])
+                with metrics.timer("lobbies_best_games"):
+                    candidate_games, candidate_fairness = self._lobbies_best_games(
+                        log_ratings[candidates], rds[candidates], game_mode)
+                fairness_a, fairness_b = candidate_fairness[:len(swaps)], candidate_fairness[len(swaps):]
+                pair = fairness_a + fairness_b
+                if objective == "max":
+                    rest = np.delete(fairness, [a, b])
+                    worst = np.maximum(np.maximum(fairness_a, fairness_b), np.max(rest) if len(rest) else 0.0)
+                    s = np.lexsort((pair, worst))[0]
+                    current_worst = np.max(fairness)
+                    better = worst[s] < current_worst - 1e-15 or (
+                            worst[s] <= current_worst + 1e-15 and pair[s] < fairness[a] + fairness[b] - 1e-15)
+                else:
+                    s = np.argmin(pair)
+                    better = pair[s] < fairness[a] + fairness[b] - 1e-15
+                if better:
+                    lobbies[a], lobbies[b] = lobbies_a[s], lobbies_b[s]
+                    games[a], games[b] = candidate_games[s], candidate_games[len(swaps) + s]
+                    fairness[a], fairness[b] = fairness_a[s], fairness_b[s]
+                    improved = True
+
+        superset = self.get_superset(game_mode)
+        order = np.argsort(-np.mean(log_ratings[lobbies], axis=1), kind="stable")
+        return [Lobby(players=lobbies[i].tolist(), teams=(superset[games[i]].astype(int) + 1).tolist(),
+                      fairness=float(fairness[i])) for i in order]
+
+    def _exhaustive_search(self, ratings, rds, game_mode, team_constraints):
+        """Scores every game of the superset which satisfies the constraints, see search_best_game()."""
+        (num_teams, num_players_per_team) = self.parse_game_mode(game_mode)
+
+        with metrics.timer("constrained_games"):
+            potential_games = self._potential_games(game_mode)[self.constrained_games(game_mode, team_constraints)]
+        metrics.gauge("balance_superset_games", len(self.get_superset(game_mode)))
+        metrics.gauge("balance_candidate_games", len(potential_games))
+        with np.errstate(divide="ignore"):
+            log_ratings = np.log(ratings)
+        with metrics.timer("games_odds"):
+            odds = self._games_odds(log_ratings[potential_games], rds, num_teams, num_players_per_team)
+
+        # That's helpstone's metric for a fair game.
+        fairness_games = np.max(odds, axis=1) - np.min(odds, axis=1)
+        # games tied up to rounding errors are settled by their order in the superset
+        best = np.argmax(fairness_games <= np.min(fairness_games) + 1e-12)
+        best_game = potential_games[best].tolist()
         #this inverts the index so that each player, ordered as in the initial MMR list is mapped to a team
-        return [int(np.ceil((best_game.index(p) + 1) / num_players_per_team)) for p in range(num_teams * num_players_per_team)]
+        teams = [int(np.ceil((best_game.index(p) + 1) / num_players_per_team)) for p in range(num_teams * num_players_per_team)]
+        fairness = float(fairness_games[best])
+        return SearchResult(teams=teams, fairness=fairness, exact=True, lower_bound=fairness)
+
+
+def _fits_teams(sizes, num_teams, num_players_per_team):
+    """Whether arranged teams of sizes can be packed in num_teams teams of num_players_per_team."""
+    sizes = sorted(sizes, reverse=True)
+    room = [num_players_per_team] * num_teams
+
+    def place(i):
+        if i == len(sizes):
+            return True
+        tried = set()
+        for t in range(num_teams):
+            # teams with the same room left are interchangeable
+            if room[t] >= sizes[i] and room[t] not in tried:
+                tried.add(room[t])
+                room[t] -= sizes[i]
+                if place(i + 1):
+                    return True
+                room[t] += sizes[i]
+        return False
+
+    return sum(sizes) <= num_teams * num_players_per_team and place(0)
+
+
+def _arranged_team_sizes(num_players, max_size):
+    """Every way to split num_players players in arranged teams of at most max_size, biggest teams first."""
+    if num_players == 0:
+        return [()]
+    return [(size,) + rest for size in range(min(num_players, max_size), 0, -1)
+            for rest in _arranged_team_sizes(num_players - size, size)]
@@ -0,0 +1,212 @@
+"""
+Searches for the most balanced game without enumerating every game of the game mode,
+for lobbies where the superset would be too large (e.g. 4v4v4v4).
+
+Arranged teams are placed as blocks: players of an arranged team always end on the same team.
+Teams are interchangeable, so a block only ever opens the first empty team.
+"""
+import math
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from common.constants import C_SD, BETA
+
+# teams: the team (starting at 1, numbered by order of their first player) of each player
+# fairness: max(odds) - min(odds) of that game
+# exact: whether the game is proven to be the most balanced one
+# lower_bound: no game is more balanced than this (equal to fairness when exact)
+SearchResult = namedtuple("SearchResult", ["teams", "fairness", "exact", "lower_bound"])
+
+
+def _log(rating):
+    return math.log(rating) if rating > 0 else -math.inf
+
+
+def _blocks(team_constraints):
+    """Players of each arranged team, bigger teams first."""
+    blocks = []
+    k = 0
+    for team_size in team_constraints.split('+'):
+        blocks.append(list(range(k, k + int(team_size))))
+        k += int(team_size)
+    return blocks
+
+
+def _fairness(team_log_sums, num_players_per_team, scale):
+    # odds of the Bradley-Terry model from the sum of the log ratings of each team
+    strengths = [num_players_per_team * math.exp(s / num_players_per_team) / scale for s in team_log_sums]
+    top = max(strengths)
+    weights = [math.exp(u - top) for u in strengths]
+    return (max(weights) - min(weights)) / sum(weights)
+
+
+def _spread(team_log_sums, num_players_per_team):
+    # the fairness only moves with the strongest and weakest teams and has many local minima,
+    # the spread of the mean log ratings of all the teams is what the local search evens out instead
+    means = [s / num_players_per_team for s in team_log_sums]
+    center = sum(means) / len(means)
+    return sum((m - center) ** 2 for m in means)
+
+
+def _canonical_teams(team_of_player):
+    # renumber teams by order of their first player, like the games of the superset
+    numbers = {}
+    for t in team_of_player:
+        numbers.setdefault(t, len(numbers) + 1)
+    return [numbers[t] for t in team_of_player]
+
+
+def local_search(ratings, rds, num_teams, num_players_per_team, team_constraints, deadline=None):
+    """Greedy game refined by swaps of arranged teams of the same size between two teams.
+
+    Blocks are placed from the biggest and strongest on the team with the lowest sum of log ratings
+    among those with room for them, then the swap that most reduces the spread of the mean log ratings
+    of the teams is applied until none does (or the deadline passes).
+
+    Returns:
+        A tuple (team_of_player, fairness) with teams numbered from 0.
+    """
+    num_players = num_teams * num_players_per_team
+    scale = C_SD * np.sqrt(np.sum(np.asarray(rds, dtype=float) ** 2) + num_players * BETA ** 2)
+    log_ratings = [_log(r) for r in ratings]
+    blocks = sorted(_blocks(team_constraints), key=lambda b: (-len(b), -sum(log_ratings[p] for p in b)))
+    block_sums = [sum(log_ratings[p] for p in b) for b in blocks]
+
+    team_log_sums = [0.0] * num_teams
+    team_counts = [0] * num_teams
+    block_team = []
+    for b, block in enumerate(blocks):
+        # the team with the lowest sum of log ratings among those with room left
+        candidates = [t for t in range(num_teams) if team_counts[t] + len(block) <= num_players_per_team]
+        if not candidates:
+            raise ValueError("Arranged teams '{}' do not fit in {} teams of {}".format(
+                team_constraints, num_teams, num_players_per_team))
+        t = min(candidates, key=lambda t: team_log_sums[t])
+        team_log_sums[t] += block_sums[b]
+        team_counts[t] += len(block)
+        block_team.append(t)
+    if any(count != num_players_per_team for count in team_counts):
+        raise ValueError("Arranged teams '{}' do not fit in {} teams of {}".format(
+            team_constraints, num_teams, num_players_per_team))
+
+    spread = _spread(team_log_sums, num_players_per_team)
+    while deadline is None or time.perf_counter() < deadline:
+        best_swap = None
+        for a in range(len(blocks)):
+            for b in range(a + 1, len(blocks)):
+                t_a, t_b = block_team[a], block_team[b]
+                if t_a == t_b or len(blocks[a]) != len(blocks[b]):
+                    continue
+                delta = block_sums[b] - block_sums[a]
+                team_log_sums[t_a] += delta
+                team_log_sums[t_b] -= delta
+                swapped_spread = _spread(team_log_sums, num_players_per_team)
+                team_log_sums[t_a] -= delta
+                team_log_sums[t_b] += delta
+                if swapped_spread < spread - 1e-15:
+                    spread, best_swap = swapped_spread, (a, b)
+        if best_swap is None:
+            break
+        a, b = best_swap
+        delta = block_sums[b] - block_sums[a]
+        team_log_sums[block_team[a]] += delta
+        team_log_sums[block_team[b]] -= delta
+        block_team[a], block_team[b] = block_team[b], block_team[a]
+
+    team_of_player = [0] * num_players
+    for block, t in zip(blocks, block_team):
+        for p in block:
+            team_of_player[p] = t
+    return team_of_player, _fairness(team_log_sums, num_players_per_team, scale)
+
+
+def branch_and_bound(ratings, rds, num_teams, num_players_per_team, team_constraints, time_budget=1.0):
+    """Most balanced game by branch and bound, starting from the local_search() game.
+
+    Blocks are placed one at a time (biggest and strongest first) in depth first order. A partial game
+    is pruned when the fairness of all the games it can lead to is bounded below by the best game found:
+    each team will end with a mean log rating between what it has plus the smallest, or the largest,
+    log ratings left, so the strongest team is at least as strong as the largest lower bound, the weakest
+    at most as strong as the smallest upper bound, and the odds are at most normalized by the upper bounds.
+
+    Args:
+        time_budget (float): Seconds after which the search stops and returns the best game found so far.
+
+    Returns:
+        A SearchResult, exact when the search ran to completion.
+    """
+    deadline = time.perf_counter() + time_budget
+    num_players = num_teams * num_players_per_team
+    P = num_players_per_team
+    scale = C_SD * float(np.sqrt(np.sum(np.asarray(rds, dtype=float) ** 2) + num_players * BETA ** 2))
+    log_ratings = [_log(r) for r in ratings]
+    blocks = sorted(_blocks(team_constraints), key=lambda b: (-len(b), -sum(log_ratings[p] for p in b)))
+    block_sums = [sum(log_ratings[p] for p in b) for b in blocks]
+    block_sizes = [len(b) for b in blocks]
+
+    # sums of the k smallest and k largest log ratings left after placing the first d blocks
+    smallest, largest = [], []
+    for d in range(len(blocks) + 1):
+        left = sorted(log_ratings[p] for b in blocks[d:] for p in b)
+        smallest.append([sum(left[:k]) for k in range(P + 1)])
+        largest.append([sum(left[len(left) - k:]) if k else 0.0 for k in range(P + 1)])
+
+    def lower_bound(d, team_log_sums, team_counts):
+        lo = [(team_log_sums[t] + smallest[d][P - team_counts[t]]) / P for t in range(num_teams)]
+        hi = [(team_log_sums[t] + largest[d][P - team_counts[t]]) / P for t in range(num_teams)]
+        hi_strengths = [P * math.exp(h) / scale for h in hi]
+        top = max(hi_strengths)
+        strongest = P * math.exp(max(lo)) / scale
+        weakest = min(hi_strengths)
+        if strongest <= weakest:
+            return 0.0
+        return (math.exp(strongest - top) - math.exp(weakest - top)) / sum(math.exp(u - top) for u in hi_strengths)
+
+    best_team_of_player, best_fairness = local_search(ratings, rds, num_teams, num_players_per_team,
+                                                      team_constraints, deadline)
+    best_block_team = None
+    # nodes: (lower bound, number of blocks placed, team log sums, team counts, team of each block placed)
+    stack = [(lower_bound(0, [0.0] * num_teams, [0] * num_teams), 0, (0.0,) * num_teams, (0,) * num_teams, ())]
+    visited = 0
+    while stack:
+        visited += 1
+        if visited % 256 == 0 and time.perf_counter() > deadline:
+            break
+        bound, d, team_log_sums, team_counts, block_team = stack.pop()
+        if bound >= best_fairness - 1e-15:
+            continue
+        if d == len(blocks):
+            fairness = _fairness(team_log_sums, P, scale)
+            if fairness < best_fairness - 1e-15:
+                best_fairness, best_block_team = fairness, block_team
+            continue
+        children = []
+        opened_empty_team = False
+        for t in range(num_teams):
+            if team_counts[t] + block_sizes[d] > P:
+                continue
+            if team_counts[t] == 0:
+                # empty teams are interchangeable
+                if opened_empty_team:
+                    continue
+                opened_empty_team = True
+            child_sums = team_log_sums[:t] + (team_log_sums[t] + block_sums[d],) + team_log_sums[t + 1:]
+            child_counts = team_counts[:t] + (team_counts[t] + block_sizes[d],) + team_counts[t + 1:]
+            child_bound = lower_bound(d + 1, child_sums, child_counts)
+            if child_bound < best_fairness - 1e-15:
+                children.append((child_bound, d + 1, child_sums, child_counts, block_team + (t,)))
+        # most promising child on top of the stack
+        children.sort(key=lambda node: -node[0])
+        stack.extend(children)
+
+    if best_block_team is not None:
+        best_team_of_player = [0] * num_players
+        for block, t in zip(blocks, best_block_team):
+            for p in block:
+                best_team_of_player[p] = t
+    exact = not stack
+    lower = best_fairness if exact else min([best_fairness] + [node[0] for node in stack])
+    return SearchResult(teams=_canonical_teams(best_team_of_player), fairness=best_fairness, exact=exact,
+                        lower_bound=lower)
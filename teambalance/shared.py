@@ -0,0 +1,210 @@
+"""
+Balancing state shared by the processes of a host: built once, published in shared memory and attached read-only.
+
+Every process answering /team/balance needs, for each game mode, the superset, the players of its games ordered by
+team, the team masks and the constrained games of the usual constraint sets (see Balance.warm_up). Built in each
+gunicorn worker and each process of its balancing pool, they cost the warm-up time and the memory once per process.
+Instead, the gunicorn master builds them once and publishes them with publish() (see gunicorn_conf.py): all the
+arrays go into one file of /dev/shm (of the temporary directory if there is none), after a JSON header describing
+them. The workers attach() to the file by its path, memory-mapping it read-only, and load_into() hands views of its
+arrays to their Balance, so that every process maps the same pages of shared memory and the memory of the balancer
+does not grow with the number of workers.
+
+File layout: uint64 length of the header, the UTF-8 JSON header, then each array at an offset aligned on
+ALIGNMENT bytes. The header is {"arrays": [{"kind", "game_mode", "team_constraints", "dtype", "shape", "offset"}]},
+kind being one of ARRAY_KINDS and team_constraints only set for "constrained_games".
+
+Examples:
+    ```python
+    # in the master, before forking the workers
+    state = publish(Balance(), ["3v3v3v3", "4v4"])
+    os.environ["BALANCE_SHARED_STATE"] = state.path
+    # in each worker
+    attach(os.environ["BALANCE_SHARED_STATE"]).load_into(balance)
+    # in the master, on exit
+    state.unlink()
+    ```
+"""
+import glob
+import json
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+ARRAY_KINDS = ("superset", "potential_games", "team_masks", "constrained_games")
+
+# game modes warmed up by default, see warmup_game_modes()
+DEFAULT_WARMUP_GAME_MODES = "1v1,2v2,3v3,4v4,1v1v1v1,3v3v3v3"
+
+# files of publish() are named after the process which published them, so that remove_stale() can find them
+_FILE_PREFIX = "mmr-balance-{}-"
+
+# arrays start on cache lines
+ALIGNMENT = 64
+
+_HEADER_LENGTH = struct.Struct("<Q")
+
+
+class SharedBalanceState:
+    """
+    Arrays of a balancing state published in a file of shared memory, see publish() and attach().
+
+    The arrays are read-only views of the memory-mapped file, which stays mapped as long as one of them lives.
+    """
+
+    def __init__(self, path, buffer):
+        """
+        Args:
+            path (str): Path of the file.
+            buffer: The memory-mapped bytes of the file.
+        """
+        self.path = path
+        self._buffer = buffer
+        (header_length,) = _HEADER_LENGTH.unpack_from(buffer, 0)
+        header = json.loads(bytes(buffer[_HEADER_LENGTH.size:_HEADER_LENGTH.size + header_length]).decode("utf-8"))
+        self.arrays = []
+        for entry in header["arrays"]:
+            array = np.ndarray(entry["shape"], dtype=np.dtype(entry["dtype"]), buffer=buffer, offset=entry["offset"])
+            array.flags.writeable = False
+            self.arrays.append((entry["kind"], entry["game_mode"], entry.get("team_constraints"), array))
+
+    @property
+    def nbytes(self):
+        return len(self._buffer)
+
+    def game_modes(self):
+        return sorted({game_mode for _, game_mode, _, _ in self.arrays})
+
+    def load_into(self, balance):
+        """Hands the arrays to balance, whose game modes then never build them.
+
+        Returns:
+            The game modes loaded.
+        """
+        for kind, game_mode, team_constraints, array in self.arrays:
+            if kind == "superset":
+                balance.superset[game_mode] = array
+            elif kind == "potential_games":
+                balance.potential_games[game_mode] = array
+            elif kind == "team_masks":
+                balance.team_masks[game_mode] = array
+            else:
+                balance.shared_constrained_games[(game_mode, team_constraints)] = array
+        return self.game_modes()
+
+    def unlink(self):
+        """Removes the file, processes which attached it keep their mapping."""
+        os.remove(self.path)
+
+
+def _state_arrays(balance, game_modes):
+    # the arrays of the game modes searched exhaustively, warmed up first
+    arrays = []
+    for game_mode in game_modes:
+        if not balance.warm_up(game_mode):
+            continue
+        arrays += [("superset", game_mode, None, balance.get_superset(game_mode)),
+                   ("potential_games", game_mode, None, balance.potential_games[game_mode]),
+                   ("team_masks", game_mode, None, balance.team_masks[game_mode])]
+        arrays += [("constrained_games", game_mode, constraints, balance.constrained_games(game_mode, constraints))
+                   for constraints in balance.arranged_team_constraints(game_mode)]
+    return arrays
+
+
+def _layout(arrays):
+    # the header and the size of a file holding arrays
+    entries = []
+    for kind, game_mode, team_constraints, array in arrays:
+        entry = {"kind": kind, "game_mode": game_mode, "dtype": array.dtype.str, "shape": list(array.shape)}
+        if team_constraints is not None:
+            entry["team_constraints"] = team_constraints
+        entries.append(entry)
+    # offsets depend on the length of the header, which depends on the offsets: place the arrays after a header
+    # padded to a length that leaves room for the offsets
+    header_length = len(json.dumps({"arrays": [dict(entry, offset=2 ** 63) for entry in entries]}).encode("utf-8"))
+    offset = -(-(_HEADER_LENGTH.size + header_length) // ALIGNMENT) * ALIGNMENT
+    for entry, (_, _, _, array) in zip(entries, arrays):
+        entry["offset"] = offset
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({"arrays": entries}).encode("utf-8")
+    return _HEADER_LENGTH.pack(len(header)) + header, max(offset, ALIGNMENT)
+
+
+def warmup_game_modes():
+    """Game modes prepared before the service reports ready and published by the gunicorn master: those of
+    WARMUP_GAME_MODES, comma separated (DEFAULT_WARMUP_GAME_MODES if unset, none if empty).
+    """
+    return [game_mode.strip() for game_mode in os.environ.get("WARMUP_GAME_MODES", DEFAULT_WARMUP_GAME_MODES).split(",")
+            if game_mode.strip()]
+
+
+def shared_directory():
+    """Directory of the files of publish(): /dev/shm, or the temporary directory when there is none."""
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+def remove_stale(directory=None):
+    """Removes the files of publish() in directory (shared_directory() by default) left by processes which no
+    longer run, e.g. a gunicorn master which crashed before unlinking its state.
+
+    Returns:
+        The paths removed.
+    """
+    removed = []
+    for path in glob.glob(os.path.join(directory or shared_directory(), _FILE_PREFIX.format("*") + "*.bin")):
+        pid = os.path.basename(path).split("-")[2]
+        if not pid.isdigit() or _is_running(int(pid)):
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        removed.append(path)
+    return removed
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # another user's process
+        return True
+    return True
+
+
+def publish(balance, game_modes, path=None):
+    """Warms up balance for game_modes and copies its state into a new file of shared memory.
+
+    Args:
+        balance (Balance): The balancer building the state, which can then be dropped.
+        game_modes (list): Game modes to publish, those searched by branch and bound have no state and are skipped.
+        path (str): Path of the file, a new file of shared_directory() named after this process by default.
+
+    Returns:
+        The SharedBalanceState of the file, whose owner must unlink() it once the workers are done.
+    """
+    arrays = _state_arrays(balance, game_modes)
+    header, size = _layout(arrays)
+    if path is None:
+        fd, path = tempfile.mkstemp(prefix=_FILE_PREFIX.format(os.getpid()), suffix=".bin", dir=shared_directory())
+        os.close(fd)
+    buffer = np.memmap(path, dtype=np.uint8, mode="w+", shape=(size,))
+    buffer[:len(header)] = np.frombuffer(header, dtype=np.uint8)
+    for entry, (_, _, _, array) in zip(json.loads(header[_HEADER_LENGTH.size:].decode("utf-8"))["arrays"], arrays):
+        buffer[entry["offset"]:entry["offset"] + array.nbytes] = np.ascontiguousarray(array).view(np.uint8).ravel()
+    buffer.flush()
+    del buffer
+    return attach(path)
+
+
+def attach(path):
+    """Attaches the state published in the file at path, read-only.
+
+    Returns:
+        A SharedBalanceState.
+    """
+    return SharedBalanceState(path, np.memmap(path, dtype=np.uint8, mode="r"))
@@ -1,4 +1,7 @@
+import time
+
 import numpy as np
+import pytest
 from teambalance.balance import Balance
 
 
@@ -69,3 +72,158 @@ def test_2RTplus2ATv4RT():
     expected_teams = [1, 1, 2, 2, 2, 2, 1, 1]
     expected_set_cardinality = 15
     balance_tester(ratings_G, rds_G, game_mode, 2, team_constraints, expected_teams, expected_set_cardinality)
+
+def test_superset_is_canonical():
+    b = Balance()
+    superset = b.generate_superset(4, 3)
+    assert superset.shape == (15400, 12)
+    assert len(set(map(tuple, superset))) == 15400
+    # teams are numbered in order of their first player and have 3 players each
+    assert all(list(dict.fromkeys(game)) == [0, 1, 2, 3] for game in superset)
+    assert np.all(np.apply_along_axis(np.bincount, 1, superset) == 3)
+
+def test_superset_dir(tmp_path):
+    b = Balance(superset_dir=str(tmp_path))
+    superset = b.get_superset("2v2v2")
+    assert (tmp_path / "2v2v2.npy").exists()
+    loaded = Balance(superset_dir=str(tmp_path)).get_superset("2v2v2")
+    assert isinstance(loaded, np.memmap)
+    assert np.array_equal(loaded, superset)
+
+def test_best_game_is_fairest():
+    b = Balance()
+    rng = np.random.default_rng(0)
+    for game_mode in ["2v2v2", "3v3v3v3", "4v4"]:
+        (num_teams, num_players_per_team) = b.parse_game_mode(game_mode)
+        number_of_players = num_teams * num_players_per_team
+        ratings_G = rng.normal(1500, 300, number_of_players)
+        rds_G = rng.uniform(60, 350, number_of_players)
+        team_constraints = "+".join(["1"] * number_of_players)
+        output_teams = b.find_best_game(ratings_G, rds_G, game_mode, team_constraints)
+
+        def fairness(teams):
+            potential_game = np.argsort(teams, kind="stable")
+            odds = b._game_odds(ratings_G[potential_game], rds_G, num_teams, num_players_per_team)
+            return np.max(odds) - np.min(odds)
+
+        fairness_games = [fairness(game) for game in b.superset[game_mode]]
+        assert np.isclose(fairness(output_teams), np.min(fairness_games), rtol=0, atol=1e-12)
+
+def test_constraints_index():
+    b = Balance(constraints_cache_size=2)
+    for game_mode, team_constraints in [("4v4", "2+1+1+1+1+1+1"), ("4v4", "4+1+1+1+1"), ("3v3v3v3", "2+1+3+1+1+1+1+1+1"),
+                                        ("2v2v2v2", "1+2+1+2+1+1")]:
+        superset = b.get_superset(game_mode)
+        indexed = superset[b.constrained_games(game_mode, team_constraints)]
+        assert np.array_equal(indexed, b._filter_constraints(superset, team_constraints))
+    b.constrained_games("2v2v2v2", "1+2+1+2+1+1")
+    info = b.constraints_cache_info()
+    assert info["hits"] == 1 and info["misses"] == 4 and info["size"] == 2 and info["hit_rate"] == 0.2
+
+def test_branch_and_bound():
+    b = Balance()
+    cases = [(test_footies, "3v3v3v3", "1+1+1+1+1+1+1+1+1+1+1+1"), (test_2RTvsRT, "2v2", "1+1+1+1"),
+             (test_2ATvs2RT, "2v2", "2+1+1"), (test_4RTvs4RT, "4v4", "1+1+1+1+1+1+1+1"),
+             (test_3ATplus1v4RT, "4v4", "4+1+1+1+1"), (test_2RTplus2ATv4RT, "4v4", "2+1+1+1+1+1+1")]
+    rng = np.random.default_rng(0)
+    for _, game_mode, team_constraints in cases:
+        number_of_players = sum(int(team_size) for team_size in team_constraints.split("+"))
+        for _ in range(5):
+            ratings_G = rng.normal(1500, 300, number_of_players)
+            rds_G = rng.uniform(60, 350, number_of_players)
+            exhaustive = b.search_best_game(ratings_G, rds_G, game_mode, team_constraints, search="exhaustive")
+            searched = b.search_best_game(ratings_G, rds_G, game_mode, team_constraints,
+                                          search="branch_and_bound", time_budget=10)
+            assert searched.exact
+            assert abs(searched.fairness - exhaustive.fairness) < 1e-12
+
+def test_branch_and_bound_large_lobby():
+    b = Balance()
+    ratings_G = np.random.default_rng(1).normal(1500, 300, 16)
+    rds_G = np.array([90] * 16)
+    result = b.search_best_game(ratings_G, rds_G, "4v4v4v4", "+".join(["1"] * 16), time_budget=0.05)
+    assert "4v4v4v4" not in b.superset
+    assert sorted(result.teams) == [1] * 4 + [2] * 4 + [3] * 4 + [4] * 4
+    assert result.lower_bound <= result.fairness
+
+def test_top_games():
+    b = Balance()
+    rng = np.random.default_rng(2)
+    ratings_G = rng.normal(1500, 300, 12)
+    rds_G = rng.uniform(60, 350, 12)
+    team_constraints = "2+1+1+1+1+1+1+1+1+1+1"
+    games, exact = b.top_games(ratings_G, rds_G, "3v3v3v3", team_constraints, k=10, chunk_size=1000)
+    assert exact and len(games) == 10
+    # the same games as sorting every game at once
+    _, fairness, _ = next(b._scored_games(ratings_G, rds_G, "3v3v3v3", team_constraints, chunk_size=10 ** 6))
+    assert np.allclose([game.fairness for game in games], np.sort(fairness)[:10], rtol=0, atol=1e-12)
+    best = b.search_best_game(ratings_G, rds_G, "3v3v3v3", team_constraints)
+    assert games[0].teams == best.teams and np.isclose(games[0].fairness, best.fairness)
+    assert all(np.isclose(np.sum(game.odds), 1) for game in games)
+    # fewer games than k
+    games, exact = b.top_games(ratings_G[:4], rds_G[:4], "2v2", "1+1+1+1", k=5)
+    assert len(games) == 3 and exact
+
+def test_iter_better_games():
+    b = Balance()
+    rng = np.random.default_rng(3)
+    ratings_G = rng.normal(1500, 300, 12)
+    rds_G = rng.uniform(60, 350, 12)
+    team_constraints = "+".join(["1"] * 12)
+    streamed = list(b.iter_better_games(ratings_G, rds_G, "3v3v3v3", team_constraints, chunk_size=500))
+    fairness = [game.fairness for game in streamed]
+    assert fairness == sorted(fairness, reverse=True) and len(set(fairness)) == len(fairness)
+    assert streamed[-1].teams == b.find_best_game(ratings_G, rds_G, "3v3v3v3", team_constraints)
+    # stops at the first game under the threshold
+    threshold = fairness[len(fairness) // 2]
+    stopped = list(b.iter_better_games(ratings_G, rds_G, "3v3v3v3", team_constraints, threshold, chunk_size=500))
+    assert stopped[-1].fairness <= threshold and len(stopped) <= len(streamed)
+    games, exact = b.top_games(ratings_G, rds_G, "3v3v3v3", team_constraints, k=1, threshold=threshold,
+                               chunk_size=500)
+    assert not exact and games[0].fairness <= threshold
+
+def test_find_best_lobbies():
+    b = Balance()
+    rng = np.random.default_rng(4)
+    ratings_G = rng.normal(1500, 300, 48)
+    rds_G = rng.uniform(60, 350, 48)
+    for game_mode, objective in [("4v4", "max"), ("2v2", "sum"), ("2v2v2", "max")]:
+        naive = b.find_best_lobbies(ratings_G, rds_G, game_mode, objective, time_budget=0)
+        start = time.perf_counter()
+        lobbies = b.find_best_lobbies(ratings_G, rds_G, game_mode, objective)
+        assert time.perf_counter() - start < 1
+        assert sorted(p for lobby in lobbies for p in lobby.players) == list(range(48))
+        for lobby in lobbies:
+            # the game of each lobby is its most balanced one
+            players = np.array(lobby.players)
+            best = b.search_best_game(ratings_G[players], rds_G[players], game_mode, "+".join(["1"] * len(players)))
+            assert np.isclose(lobby.fairness, best.fairness, rtol=0, atol=1e-12)
+            assert sorted(lobby.teams) == sorted(best.teams)
+        fairness, naive_fairness = [lobby.fairness for lobby in lobbies], [lobby.fairness for lobby in naive]
+        if objective == "max":
+            assert max(fairness) <= max(naive_fairness)
+        else:
+            assert sum(fairness) <= sum(naive_fairness)
+
+
+def test_team_constraints_fit():
+    b = Balance()
+    assert b.arranged_team_constraints("3v3") == ["3+3", "3+2+1", "3+1+1+1", "2+2+1+1", "2+1+1+1+1",
+                                                  "1+1+1+1+1+1"]
+    for game_mode in ("2v2", "4v4", "3v3v3v3"):
+        for constraints in b.arranged_team_constraints(game_mode):
+            assert len(b.constrained_games(game_mode, constraints)) > 0
+    b.check_team_constraints("3v3v3v3", 12, "3+3+2+1+1+1+1")
+    for game_mode, num_players, constraints in [("3v3", 6, "2+2+2"), ("3v3v3v3", 12, "2+2+2+2+2+2"),
+                                                ("3v3", 6, "2+1+1"), ("3v3", 6, "3+a"), ("3v3", 4, "1+1+1+1")]:
+        with pytest.raises(ValueError):
+            b.check_team_constraints(game_mode, num_players, constraints)
+
+
+def test_search_modes():
+    b = Balance()
+    ratings_G, rds_G = np.full(16, 1500.0), np.full(16, 90.0)
+    with pytest.raises(ValueError):
+        b.search_best_game(ratings_G[:4], rds_G[:4], "2v2", "1+1+1+1", search="bogus")
+    with pytest.raises(ValueError):
+        b.search_best_game(ratings_G, rds_G, "4v4v4v4", "+".join(["1"] * 16), search="exhaustive")
@@ -0,0 +1,129 @@
+import numpy as np
+
+from common import metrics
+from common.constants import BETA
+from mmr.bayesian_rating_w3c import posterior_pdf, posterior_gradient, posterior_hessian, update_after_game, \
+    update_after_games, clamp_inputs, logistic_pdf, find_map, find_map_batch, rds_laplace, SOLVERS
+
+
+def test_posterior_derivatives():
+    ratings_G = np.array([1400., 1600., 1340., 1700., 1563., 1490., 1520., 1590.])
+    rds_G = np.array([350., 350., 350., 350., 278., 290., 310., 302.])
+    x = ratings_G * 1.01
+    eps = 1e-3
+    for m in (None, 3):
+        basis = np.eye(len(x)) * eps
+        gradient = posterior_gradient(x, ratings_G, rds_G, BETA, 0, 2, m)
+        numeric = [(posterior_pdf(x + e, ratings_G, rds_G, BETA, 0, 2, m) -
+                    posterior_pdf(x - e, ratings_G, rds_G, BETA, 0, 2, m)) / (2 * eps) for e in basis]
+        assert np.allclose(gradient, numeric, atol=1e-8)
+
+        hessian = posterior_hessian(x, ratings_G, rds_G, BETA, 0, 2, m)
+        numeric = [(posterior_gradient(x + e, ratings_G, rds_G, BETA, 0, 2, m) -
+                    posterior_gradient(x - e, ratings_G, rds_G, BETA, 0, 2, m)) / (2 * eps) for e in basis]
+        assert np.allclose(hessian, numeric, atol=1e-10)
+
+
+def test_solvers_agree():
+    ratings_list = [1400, 1600, 1340, 1700]
+    rds_list = [350, 350, 350, 350]
+    analytic = update_after_game(ratings_list, rds_list, 2, 4, solver="analytic")
+    numeric = update_after_game(ratings_list, rds_list, 2, 4, solver="numeric")
+    assert np.max(np.abs(np.array(analytic.ratings_list) - numeric.ratings_list)) < 1
+    assert np.max(np.abs(np.array(analytic.rds_list) - numeric.rds_list)) < 1
+
+
+def test_integrators_agree():
+    ratings_list = [1400, 1600, 1340, 1700, 1563, 1490, 1520, 1590]
+    rds_list = [350, 350, 350, 350, 278, 290, 310, 302]
+    grid = update_after_game(ratings_list, rds_list, 1, 2, integrator="grid", rd_tol=0.001)
+    quad = update_after_game(ratings_list, rds_list, 1, 2, integrator="quad")
+    assert np.max(np.abs(np.array(grid.rds_list) - quad.rds_list)) < 0.01
+
+
+def test_laplace_integrator():
+    rng = np.random.default_rng(1)
+    games = []
+    for number_of_teams, players_per_team in [(2, 1), (2, 4), (4, 1)] * 4:
+        N = number_of_teams * players_per_team
+        games.append((list(rng.normal(1500, 300, N)), list(rng.uniform(60, 350, N)),
+                      int(rng.integers(number_of_teams)), number_of_teams))
+    for game, batched in zip(games, update_after_games(games, integrator="laplace", tol=1e-6)):
+        ratings_list, rds_list = clamp_inputs(game[0], game[1])
+        grid = update_after_game(ratings_list, rds_list, game[2], game[3], rd_tol=0.001)
+        laplace = update_after_game(ratings_list, rds_list, game[2], game[3], integrator="laplace")
+        assert np.max(np.abs(np.array(laplace.rds_list) - grid.rds_list)) < 0.25
+        assert np.max(np.abs(np.array(batched.ratings_list) - grid.ratings_list)) < 0.1
+        assert np.max(np.abs(np.array(batched.rds_list) - grid.rds_list)) < 0.25
+    # the posterior of a rating near 0 is too skewed, the grid integrates it instead
+    ratings_G, rds_G = np.array([5., 1500, 1400, 1300]), np.array([350., 100, 80, 80])
+    ratings_G_u = find_map(ratings_G, rds_G, 1, 2).x
+    assert rds_laplace(ratings_G_u, ratings_G, rds_G, 1, 2)[1]
+    ratings_G[0] = 1500
+    ratings_G_u = find_map(ratings_G, rds_G, 1, 2).x
+    assert not rds_laplace(ratings_G_u[None], ratings_G[None], rds_G[None], np.array([1]), 2)[1][0]
+
+
+def test_find_map_warm_start():
+    ratings_G = np.array([1400., 1600., 1340., 1700.])
+    rds_G = np.array([350., 350., 350., 350.])
+    opt = find_map(ratings_G, rds_G, 2, 4)
+    warm = find_map(ratings_G, rds_G, 2, 4, x0=opt.x)
+    assert warm.nit <= 1 and np.allclose(warm.x, opt.x)
+    assert np.max(np.abs(find_map(ratings_G, rds_G, 2, 4, tol=1e-3).x - opt.x)) < 0.5
+    batch = find_map_batch(np.stack([ratings_G] * 2), np.stack([rds_G] * 2), np.array([2, 0]), 4,
+                           x0=np.stack([opt.x, ratings_G]))
+    assert np.allclose(batch[0], opt.x)
+
+
+def test_zero_rating():
+    result = update_after_game([0, 1500, 1400, 1300], [100, 100, 80, 80], 0, 2)
+    assert np.all(np.isfinite(result.ratings_list)) and np.all(np.isfinite(result.rds_list))
+    assert np.min(result.ratings_list) > 0
+
+
+def test_update_after_games_matches_single_games():
+    rng = np.random.default_rng(0)
+    games = []
+    for number_of_teams, players_per_team in [(2, 1), (2, 2), (2, 4), (4, 1)] * 5:
+        N = number_of_teams * players_per_team
+        games.append((list(rng.normal(1500, 300, N)), list(rng.uniform(60, 350, N)),
+                      int(rng.integers(number_of_teams)), number_of_teams))
+    for game, result in zip(games, update_after_games(games)):
+        ratings_list, rds_list = clamp_inputs(game[0], game[1])
+        expected = update_after_game(ratings_list, rds_list, game[2], game[3])
+        assert np.max(np.abs(np.array(result.ratings_list) - expected.ratings_list)) < 0.01
+        assert np.max(np.abs(np.array(result.rds_list) - expected.rds_list)) < 0.01
+
+
+def test_posterior_batch():
+    rng = np.random.default_rng(1)
+    ratings_G = rng.normal(1500, 300, 6)
+    rds_G = rng.uniform(60, 350, 6)
+    candidates = ratings_G * rng.uniform(0.8, 1.2, (3, 10, 6))
+    for m in (None, 2):
+        batch = posterior_pdf(candidates, ratings_G, rds_G, BETA, 1, 3, m)
+        assert batch.shape == (3, 10)
+        assert np.allclose(batch, [[posterior_pdf(x, ratings_G, rds_G, BETA, 1, 3, m) for x in row]
+                                   for row in candidates], rtol=0, atol=1e-12)
+
+
+def test_posterior_extreme_ratings():
+    ratings_G = np.array([1e5, 1500, 0, 1500])
+    rds_G = np.array([80, 80, 350, 80])
+    x = np.array([[1e6, 1500, 0, -5], [1e9, 1e9, 1e9, 0], [0, 0, 0, 0]])
+    assert np.all(np.isfinite(posterior_pdf(x, ratings_G, rds_G, BETA, 1, 2)))
+    assert np.isfinite(logistic_pdf(1e6, 0, 10)) and np.isclose(logistic_pdf(0, 0, 10), 1 / 40)
+    result = find_map(np.array([3000., 1200.]), np.array([90., 300.]), 1, 2, solver="numeric")
+    assert result.success and np.all(np.isfinite(result.x))
+
+
+def test_optimizer_counts():
+    # the optimizer iterations and evaluations are counted once
+    ratings_list, rds_list = [1400, 1600, 1340, 1700], [350, 350, 350, 350]
+    for solver in SOLVERS:
+        opt = find_map(np.array(ratings_list, dtype=float), np.array(rds_list, dtype=float), 0, 2, solver=solver)
+        with metrics.collecting() as stats:
+            update_after_game(ratings_list, rds_list, 0, 2, solver=solver)
+        assert stats["counts"]["optimizer_iterations"] == opt.nit
+        assert stats["counts"]["optimizer_evaluations"] == opt.nfev
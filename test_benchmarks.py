@@ -0,0 +1,15 @@
+from benchmarks.run import BENCHMARKS, compare, main
+
+
+def test_compare():
+    baseline = {"a": {"median": 1.0}, "b": {"median": 1.0}, "c": {"median": 1.0}}
+    results = {"a": {"median": 1.3}, "b": {"median": 0.7}, "c": {"median": 1.1}, "d": {"median": 1.0}}
+    assert compare(results, baseline, threshold=0.2) == {"a": "slower", "b": "faster", "c": "ok", "d": "new"}
+
+
+def test_run_and_compare(tmp_path):
+    assert "balance.find_best_game[3v3v3v3]" in BENCHMARKS
+    baseline = str(tmp_path / "baseline.json")
+    assert main(["-k", "posterior_pdf[1v1]", "--rounds", "1", "--min-time", "0", "--save", baseline]) == 0
+    assert main(["-k", "posterior_pdf[1v1]", "--rounds", "1", "--min-time", "0", "--compare", baseline,
+                 "--threshold", "100"]) == 0
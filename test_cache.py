@@ -0,0 +1,64 @@
+import numpy as np
+
+from mmr.bayesian_rating_w3c import UpdateMmrResponseBody, update_after_game
+from mmr.cache import RatingCache, SharedRatingCache
+
+
+def test_quantize():
+    cache = RatingCache(rating_step=5, rd_step=2)
+    key, ratings_list, rds_list = cache.quantize([1501.2, 1498], [349.2, 81], 1, 2)
+    assert ratings_list == [1500, 1500] and rds_list == [350, 80]
+    assert key == cache.quantize([1499, 1502.4], [350.9, 80.2], 1, 2)[0]
+    assert key != cache.quantize([1499, 1502.4], [350.9, 80.2], 0, 2)[0]
+
+
+def test_lru():
+    cache = RatingCache(max_size=2)
+    results = {}
+    for ratings_list in ([1500, 1500], [1600, 1400], [1400, 1600]):
+        key, ratings_list, rds_list = cache.quantize(ratings_list, [350, 350], 0, 2)
+        assert cache.get(key) is None
+        results[key] = update_after_game(ratings_list, rds_list, 0, 2)
+        cache.put(key, results[key])
+        if len(results) == 2:
+            # the first game becomes the most recently used
+            assert cache.get(next(iter(results))) == results[next(iter(results))]
+    keys = list(results)
+    assert cache.get(keys[0]) is not None and cache.get(keys[1]) is None and cache.get(keys[2]) is not None
+    info = cache.info()
+    assert info["size"] == 2 and info["hits"] == 3 and info["misses"] == 4
+
+
+def test_shared(tmp_path):
+    path = str(tmp_path / "cache.bin")
+    writer = SharedRatingCache(path, max_size=64)
+    reader = SharedRatingCache(path, max_size=64)
+    key, ratings_list, rds_list = writer.quantize([1400, 1600, 1340, 1700], [350, 350, 350, 350], 1, 2)
+    assert reader.get(key) is None
+    result = UpdateMmrResponseBody(ratings_list=[1401.5, 1601.5, 1341.5, 1701.5], rds_list=[300.25, 301, 302, 303])
+    writer.put(key, result)
+    assert reader.get(key) == result
+    # a torn record reads as a miss
+    writer._records[writer._slot(key), -1] += 1
+    assert reader.get(key) is None
+    assert len(reader) == 1
+    assert np.isclose(reader.info()["hit_rate"], 1 / 3)
+
+
+def test_shared_settings_change(tmp_path):
+    path = str(tmp_path / "cache.bin")
+    key, _, _ = RatingCache().quantize([1500, 1500], [350, 350], 0, 2)
+    result = UpdateMmrResponseBody(ratings_list=[1600.0, 1400.0], rds_list=[300.0, 300.0])
+    SharedRatingCache(path, max_size=100).put(key, result)
+    assert SharedRatingCache(path, max_size=100).get(key) == result
+    # a bigger table, or other rating options, start from an empty file instead of waiting for it to grow
+    bigger = SharedRatingCache(path, max_size=1000)
+    assert bigger.get(key) is None and SharedRatingCache.read_header(path)["max_size"] == 1000
+    bigger.put(key, result)
+    assert SharedRatingCache(path, max_size=1000, options={"integrator": "laplace", "tol": 1e-6}).get(key) is None
+    assert SharedRatingCache.read_header(path)["options"] == {"integrator": "laplace", "tol": 1e-6}
+    # so does a file which is not a cache
+    with open(path, "wb") as f:
+        f.write(b"\xff" * 100)
+    assert SharedRatingCache.read_header(path) is None
+    assert len(SharedRatingCache(path, max_size=100)) == 0
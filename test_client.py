@@ -0,0 +1,117 @@
+import asyncio
+
+import httpx
+import numpy as np
+
+from client.mmr_client import MmrClient
+from main import app
+
+GAMES = [
+    ([1400, 1600, 1340, 1700], [350, 350, 350, 350], 0, 2, [1466, 1659, 1269, 1645], [323, 327, 328, 337]),
+    ([2000, 1500], [90, 350], 0, 2, [2002, 1467], [89, 316]),
+    ([1400, 1600, 1340, 1700], [350, 350, 350, 350], 2, 4, [1370, 1555, 1473, 1646], [330, 329, 354, 330]),
+    ([2000, 1500], [90, 350], 1, 2, [1986, 1732], [90, 336]),
+]
+
+
+class CountingTransport(httpx.AsyncBaseTransport):
+    # the app behind the paths of the requests it answered, failing the first requests with fail_status
+
+    def __init__(self, fail_status=None, failures=0):
+        self.app = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        self.paths = []
+        self.fail_status = fail_status
+        self.failures = failures
+
+    async def handle_async_request(self, request):
+        self.paths.append(request.url.path)
+        if self.failures:
+            self.failures -= 1
+            return httpx.Response(self.fail_status, headers={"Retry-After": "0"})
+        return await self.app.handle_async_request(request)
+
+
+def check_game(result, expected_ratings, expected_rds):
+    assert np.max(np.abs(np.array(result["ratings_list"]) - expected_ratings)) < 1
+    assert np.max(np.abs(np.array(result["rds_list"]) - expected_rds)) < 1
+
+
+def test_update_mmr_coalesces():
+    transport = CountingTransport()
+
+    async def run():
+        async with MmrClient(transport=transport, batch_delay=0.05) as client:
+            return await asyncio.gather(*[client.update_mmr(*game[:4]) for game in GAMES * 5])
+
+    results = asyncio.run(run())
+    assert transport.paths == ["/mmr/update/batch"]
+    for result, game in zip(results, GAMES * 5):
+        check_game(result, game[4], game[5])
+
+
+def test_update_mmr_batch_size():
+    transport = CountingTransport()
+
+    async def run():
+        async with MmrClient(transport=transport, batch_size=3, batch_delay=0.05) as client:
+            return await client.update_mmr_batch([game[:4] for game in GAMES])
+
+    results = asyncio.run(run())
+    assert transport.paths == ["/mmr/update/batch", "/mmr/update"]
+    for result, game in zip(results, GAMES):
+        check_game(result, game[4], game[5])
+
+
+def test_invalid_game_fails_alone():
+    invalid = ([1500] * 3, [350] * 3, 0, 2)
+
+    async def run():
+        async with MmrClient(transport=CountingTransport(), batch_delay=0.05) as client:
+            return await asyncio.gather(client.update_mmr(*GAMES[0][:4]), client.update_mmr(*invalid),
+                                        return_exceptions=True)
+
+    result, error = asyncio.run(run())
+    check_game(result, GAMES[0][4], GAMES[0][5])
+    assert isinstance(error, httpx.HTTPStatusError)
+
+
+def test_retries():
+    transport = CountingTransport(fail_status=429, failures=2)
+
+    async def run():
+        async with MmrClient(transport=transport, batch_size=1, backoff=0.001) as client:
+            return await client.update_mmr(*GAMES[1][:4])
+
+    check_game(asyncio.run(run()), GAMES[1][4], GAMES[1][5])
+    assert transport.paths == ["/mmr/update"] * 3
+
+    transport = CountingTransport(fail_status=503, failures=5)
+    try:
+        asyncio.run(run())
+        assert False, "the service is still unavailable after the retries"
+    except httpx.HTTPStatusError as e:
+        assert e.response.status_code == 503
+    assert len(transport.paths) == 4
+
+
+def test_retry_delay():
+    client = MmrClient(backoff=0.1, max_backoff=1.0)
+    delays = [client.retry_delay(attempt) for attempt in range(6) for _ in range(20)]
+    assert all(0.05 <= delay <= 0.1 for delay in delays[:20])
+    assert all(0.5 <= delay <= 1.0 for delay in delays[-20:])
+    assert len(set(delays)) > 100
+    # Retry-After is a lower bound, the jittered backoff applies above it
+    assert all(client.retry_delay(attempt, httpx.Response(429, headers={"Retry-After": "2"})) >= 2.0
+               for attempt in range(6) for _ in range(20))
+    assert 0.5 <= client.retry_delay(5, httpx.Response(429, headers={"Retry-After": "0"})) <= 1.0
+
+
+def test_balance_teams():
+    async def run():
+        async with MmrClient(transport=CountingTransport(), max_concurrency=2) as client:
+            return await asyncio.gather(*[client.balance_teams([1900, 1500, 1400, 1400, 1400, 1400, 1300, 1100],
+                                                               [90] * 8, "4v4", "2+1+1+1+1+1+1")
+                                          for _ in range(4)])
+
+    for result in asyncio.run(run()):
+        assert result["teams"] in ([1, 1, 2, 2, 2, 2, 1, 1], [2, 2, 1, 1, 1, 1, 2, 2])
@@ -0,0 +1,47 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from common.executor import WorkerPool
+
+
+def test_backpressure():
+    pool = WorkerPool("thread", max_workers=1, max_pending=1, timeout=5)
+
+    async def run():
+        slow = asyncio.ensure_future(pool.run(time.sleep, 0.2))
+        await asyncio.sleep(0.05)
+        with pytest.raises(HTTPException) as rejected:
+            await pool.run(time.sleep, 0)
+        await slow
+        return rejected.value.status_code
+
+    assert asyncio.run(run()) == 429
+    assert pool.pending == 0
+    pool.shutdown()
+
+
+def test_timeout():
+    pool = WorkerPool("thread", max_workers=1, max_pending=2, timeout=0.05)
+
+    async def run():
+        with pytest.raises(HTTPException) as timed_out:
+            await pool.run(time.sleep, 0.2)
+        return timed_out.value.status_code
+
+    assert asyncio.run(run()) == 503
+    # the timed out job keeps its slot until it actually finishes
+    assert pool.pending == 1
+    time.sleep(0.3)
+    assert pool.pending == 0
+    pool.shutdown()
+
+
+def test_start():
+    for kind in ("process", "thread"):
+        pool = WorkerPool(kind, max_workers=2)
+        assert pool.start() == 2
+        pool.shutdown()
+    assert WorkerPool("inline").start() == 0
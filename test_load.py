@@ -0,0 +1,55 @@
+import json
+import threading
+import time
+
+from benchmarks.load import make_schedule, main, parse_mix
+from benchmarks.profiler import SamplingProfiler, collapse, write_collapsed
+
+
+def test_schedule():
+    schedule = make_schedule(rate=200, duration=2, seed=1)
+    assert schedule == make_schedule(rate=200, duration=2, seed=1)
+    assert 300 < len(schedule) < 500
+    offsets = [offset for offset, _, _, _ in schedule]
+    assert offsets == sorted(offsets) and offsets[-1] < 2
+    for _, scenario, path, body in schedule:
+        assert path == ("/mmr/update" if scenario.startswith("mmr_update") else "/team/balance")
+        if path == "/team/balance":
+            assert sum(int(size) for size in body["team_constraints"].split("+")) == len(body["ratings_list"])
+    mix = parse_mix("mmr_update[1v1]=3,team_balance[4v4]=1")
+    assert mix == {"mmr_update[1v1]": 3.0, "team_balance[4v4]": 1.0}
+    assert {scenario for _, scenario, _, _ in make_schedule(100, 1, mix)} == set(mix)
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_profiler(tmp_path):
+    with SamplingProfiler(interval=0.001) as profiler:
+        thread = threading.Thread(target=busy, args=(0.1,), name="busy")
+        thread.start()
+        thread.join()
+    counts = collapse(profiler.samples)
+    busy_stacks = [stack for stack in counts if stack.startswith("busy;")]
+    frame = "busy (test_load.py:{})".format(busy.__code__.co_firstlineno)
+    assert busy_stacks and all(stack.endswith(frame) for stack in busy_stacks)
+    path = str(tmp_path / "stacks.txt")
+    write_collapsed(counts, path)
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == len(counts) and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+
+def test_load(tmp_path):
+    report, stacks = str(tmp_path / "load.json"), str(tmp_path / "stacks.txt")
+    assert main(["--rate", "40", "--duration", "0.5", "--save", report, "--profile", stacks, "--slow", "0"]) == 0
+    with open(report) as f:
+        summary = json.load(f)["report"]
+    assert summary["all"]["errors"] == 0 and summary["all"]["requests"] > 0
+    assert summary["all"]["p50"] <= summary["all"]["p95"] <= summary["all"]["p99"]
+    assert summary["all"]["cpu_per_request"] > 0
+    with open(stacks) as f:
+        assert f.read()
@@ -1,7 +1,7 @@
 import numpy as np
 from fastapi.testclient import TestClient
 
-from main import app
+from main import app, RATING_OPTIONS
 
 client = TestClient(app)
 
@@ -81,3 +81,129 @@ def test_ffa():
         [1370, 1555, 1473, 1646],
         [330, 329, 354, 330]
     )
+
+
+def test_batch():
+    games = [
+        ([1400, 1600, 1340, 1700], [350, 350, 350, 350], 0, 2, [1466, 1659, 1269, 1645], [323, 327, 328, 337]),
+        ([2000, 1500], [90, 350], 0, 2, [2002, 1467], [89, 316]),
+        ([1400, 1600, 1340, 1700], [350, 350, 350, 350], 2, 4, [1370, 1555, 1473, 1646], [330, 329, 354, 330]),
+        ([2000, 1500], [90, 350], 1, 2, [1986, 1732], [90, 336]),
+    ]
+    response = client.post(
+        "/mmr/update/batch",
+        json={"games": [
+            {"ratings_list": mmr0, "rds_list": rd0, "winning_team": winning_team, "number_of_teams": number_of_teams}
+            for mmr0, rd0, winning_team, number_of_teams, _, _ in games]},
+    )
+    assert response.status_code == 200
+
+    results = response.json()["games"]
+    assert len(results) == len(games)
+    for result, (_, _, _, _, mmr1, rd1) in zip(results, games):
+        assert np.max(np.abs(np.array(result["ratings_list"]) - mmr1)) < 1
+        assert np.max(np.abs(np.array(result["rds_list"]) - rd1)) < 1
+
+
+def test_laplace_integrator(monkeypatch):
+    # the fast rating options stay within the expectations of the tests above
+    monkeypatch.setitem(RATING_OPTIONS, "integrator", "laplace")
+    monkeypatch.setitem(RATING_OPTIONS, "tol", 1e-6)
+    test_2x2()
+    test_1x1()
+    test_4x4()
+    test_ffa()
+    test_batch()
+
+
+def test_balance():
+    response = client.post(
+        "/team/balance",
+        json={
+            "ratings_list": [1900, 1500, 1400, 1400, 1400, 1400, 1300, 1100],
+            "rds_list": [90] * 8,
+            "gamemode": "4v4",
+            "team_constraints": "2+1+1+1+1+1+1"
+        },
+    )
+    assert response.status_code == 200
+    teams = response.json()["teams"]
+    assert teams == [1, 1, 2, 2, 2, 2, 1, 1] or teams == [2, 2, 1, 1, 1, 1, 2, 2]
+
+
+def test_balance_top():
+    response = client.post(
+        "/team/balance/top",
+        json={
+            "ratings_list": [1900, 1500, 1400, 1400, 1400, 1400, 1300, 1100],
+            "rds_list": [90] * 8,
+            "gamemode": "4v4",
+            "team_constraints": "2+1+1+1+1+1+1",
+            "k": 3
+        },
+    )
+    assert response.status_code == 200
+    result = response.json()
+    assert result["exact"] and len(result["games"]) == 3
+    assert result["games"][0]["teams"] == [1, 1, 2, 2, 2, 2, 1, 1]
+    fairness = [game["fairness"] for game in result["games"]]
+    assert fairness == sorted(fairness)
+    response = client.post("/team/balance/top", json={"ratings_list": [1500] * 16, "rds_list": [90] * 16,
+                                                      "gamemode": "4v4v4v4"})
+    assert response.status_code == 400
+
+
+def test_balance_pool():
+    ratings = np.random.default_rng(0).normal(1500, 300, 24).tolist()
+    response = client.post("/team/balance/pool", json={"ratings_list": ratings, "rds_list": [90] * 24,
+                                                       "gamemode": "2v2"})
+    assert response.status_code == 200
+    result = response.json()
+    assert len(result["lobbies"]) == 6
+    assert sorted(p for lobby in result["lobbies"] for p in lobby["players"]) == list(range(24))
+    assert np.isclose(result["max_fairness"], max(lobby["fairness"] for lobby in result["lobbies"]))
+    response = client.post("/team/balance/pool", json={"ratings_list": ratings[:10], "rds_list": [90] * 10,
+                                                       "gamemode": "2v2"})
+    assert response.status_code == 400
+
+
+def test_predict():
+    games = [{"ratings_list": [1500, 1500], "rds_list": [90, 90], "number_of_teams": 2},
+             {"ratings_list": [1900, 1500, 1400, 1100], "rds_list": [90] * 4, "number_of_teams": 4},
+             {"ratings_list": [1800, 1200], "rds_list": [90, 350], "number_of_teams": 2}]
+    response = client.post("/mmr/predict", json={"games": games})
+    assert response.status_code == 200
+    odds = response.json()["odds"]
+    assert [len(game_odds) for game_odds in odds] == [2, 4, 2]
+    assert np.allclose(odds[0], [0.5, 0.5]) and odds[2][0] > 0.5 and np.argmax(odds[1]) == 0
+    response = client.post("/mmr/predict", json={"games": [{"ratings_list": [1500] * 3, "rds_list": [90] * 3,
+                                                            "number_of_teams": 2}]})
+    assert response.status_code == 400
+
+
+def test_balance_invalid_constraints():
+    for constraints in ("2+2+2", "2+1+1", "3+3+3"):
+        response = client.post("/team/balance", json={"ratings_list": [1500] * 6, "rds_list": [90] * 6,
+                                                       "gamemode": "3v3", "team_constraints": constraints})
+        assert response.status_code == 400
+    response = client.post("/team/balance/top", json={"ratings_list": [1500] * 6, "rds_list": [90] * 6,
+                                                      "gamemode": "3v3", "team_constraints": "2+2+2"})
+    assert response.status_code == 400
+
+
+def test_balance_invalid_search():
+    body = {"ratings_list": [1500] * 16, "rds_list": [90] * 16, "gamemode": "4v4v4v4"}
+    for search in ("bogus", "exhaustive"):
+        response = client.post("/team/balance", json=dict(body, search=search))
+        assert response.status_code == 400
+    response = client.post("/team/balance", json=dict(body, search="branch_and_bound", time_budget=0.05))
+    assert response.status_code == 200
+
+
+def test_batch_invalid_games():
+    valid = {"ratings_list": [1500, 1500], "rds_list": [90, 90], "winning_team": 0, "number_of_teams": 2}
+    for invalid in (dict(valid, winning_team=7), dict(valid, rds_list=[90]),
+                    dict(valid, ratings_list=[1500] * 3, rds_list=[90] * 3)):
+        response = client.post("/mmr/update/batch", json={"games": [valid, invalid]})
+        assert response.status_code == 400
+        assert response.json()["detail"].startswith("Game 1:")
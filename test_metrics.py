@@ -0,0 +1,55 @@
+from fastapi.testclient import TestClient
+
+from common import metrics
+from main import app
+
+client = TestClient(app)
+
+
+def test_registry_render():
+    registry = metrics.Registry(buckets=(0.1, 1.0))
+    registry.inc("mmr_games_total", 2, game_mode="2v2", teams=2)
+    registry.set("mmr_pool_pending", 3, pool="rating_pool")
+    registry.observe("mmr_stage_seconds", 0.5, stage="find_map")
+    text = registry.render()
+    assert '# TYPE mmr_games_total counter\nmmr_games_total{game_mode="2v2",teams="2"} 2' in text
+    assert 'mmr_pool_pending{pool="rating_pool"} 3' in text
+    assert 'mmr_stage_seconds_bucket{stage="find_map",le="0.1"} 0' in text
+    assert 'mmr_stage_seconds_bucket{stage="find_map",le="1.0"} 1' in text
+    assert 'mmr_stage_seconds_bucket{stage="find_map",le="+Inf"} 1' in text
+    assert 'mmr_stage_seconds_count{stage="find_map"} 1' in text
+
+
+def test_collecting():
+    # nothing is collected outside of call_collecting
+    with metrics.timer("stage"):
+        metrics.count("games")
+
+    def work(n):
+        with metrics.timer("stage"):
+            metrics.count("games", n)
+        metrics.gauge("balance_superset_games", 10)
+        return n
+
+    result, stats = metrics.call_collecting(work, 0.0, 3)
+    assert result == 3
+    assert stats["counts"] == {"games": 3} and stats["gauges"] == {"balance_superset_games": 10}
+    assert stats["stages"]["stage"] >= 0 and stats["queue_wait"] > 0
+
+
+def test_metrics_endpoint():
+    client.post("/mmr/update", json={"ratings_list": [1500, 1500, 1500, 1500], "rds_list": [350] * 4,
+                                     "winning_team": 0, "number_of_teams": 2})
+    client.post("/team/balance", json={"ratings_list": [1500, 1400, 1300, 1200], "rds_list": [90] * 4,
+                                       "gamemode": "2v2"})
+    client.post("/team/balance", json={"ratings_list": [1500, 1400, 1300, 1200], "rds_list": [90] * 4,
+                                       "gamemode": "2V2 "})
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'mmr_stage_seconds_count{game_mode="2v2",stage="find_map",teams="2"}' in response.text
+    assert 'mmr_optimizer_iterations_total{game_mode="2v2",teams="2"}' in response.text
+    assert 'mmr_balance_superset_games{game_mode="2v2",teams="2"} 3' in response.text
+    assert 'mmr_queue_wait_seconds_count{pool="rating_pool"}' in response.text
+    # every spelling of a game mode shares its series
+    assert 'game_mode="2V2 "' not in response.text
+    assert 'mmr_http_request_seconds_count{method="POST",path="/mmr/update",status="200"}' in response.text
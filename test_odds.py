@@ -0,0 +1,28 @@
+import numpy as np
+
+from common import odds
+from common.constants import C_SD, BETA
+from teambalance.balance import Balance
+
+
+def test_win_probabilities():
+    rng = np.random.default_rng(0)
+    ratings = rng.normal(1500, 300, (5, 7, 12))
+    rds = rng.uniform(60, 350, (5, 7, 12))
+    probabilities = odds.win_probabilities(ratings, rds, 4)
+    assert probabilities.shape == (5, 7, 4)
+    assert np.allclose(np.sum(probabilities, axis=-1), 1)
+    # same odds as the balancer's, game by game
+    b = Balance()
+    for game_ratings, game_rds, game_odds in zip(ratings[0], rds[0], probabilities[0]):
+        assert np.allclose(b._game_odds(game_ratings, game_rds, 4, 3), game_odds)
+    fairness = odds.fairness(probabilities)
+    assert fairness.shape == (5, 7) and np.all((fairness >= 0) & (fairness <= 1))
+
+
+def test_extreme_ratings():
+    probabilities = odds.win_probabilities(np.array([[1e9, 1500], [0, 1500], [-10, 0]]), np.full((3, 2), 90.), 2)
+    assert np.all(np.isfinite(probabilities))
+    assert np.allclose(probabilities[0], [1, 0]) and np.allclose(probabilities[2], [0.5, 0.5])
+    scale = odds.game_scale(np.full(4, 90.), BETA)
+    assert np.isclose(scale, C_SD * np.sqrt(4 * 90 ** 2 + 4 * BETA ** 2))
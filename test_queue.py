@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+from common import odds
+from matchmaking.queue import acceptable_fairness, fairness_matrix, match_queue, pair_fairness
+
+
+def random_queue(num_players, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.normal(1500, 300, num_players), rng.uniform(40, 300, num_players), rng.uniform(0, 120, num_players)
+
+
+def best_matching(num_players, fairness, acceptable):
+    # most acceptable pairs, then lowest total fairness, over every matching: the first player left is either
+    # unmatched or paired with any other player left
+    def best(players):
+        if len(players) < 2:
+            return 0, 0.0
+        a, rest = players[0], players[1:]
+        candidates = [best(rest)]
+        for b in rest:
+            if fairness[a, b] <= max(acceptable[a], acceptable[b]):
+                num_pairs, total = best(tuple(p for p in rest if p != b))
+                candidates.append((num_pairs + 1, total + fairness[a, b]))
+        return max(candidates, key=lambda candidate: (candidate[0], -candidate[1]))
+
+    return best(tuple(range(num_players)))
+
+
+def test_fairness_matrix():
+    ratings, rds, _ = random_queue(300)
+    fairness = fairness_matrix(ratings, rds, block_size=64)
+    assert np.allclose(fairness, fairness.T) and np.allclose(np.diag(fairness), 0)
+    assert np.allclose(fairness, fairness_matrix(ratings, rds))
+    # same fairness as the balancer's for every 1v1 game
+    games = np.stack([np.repeat(ratings, 300), np.tile(ratings, 300)], axis=-1)
+    game_rds = np.stack([np.repeat(rds, 300), np.tile(rds, 300)], axis=-1)
+    assert np.allclose(fairness.ravel(), odds.fairness(odds.win_probabilities(games, game_rds, 2)))
+    assert np.allclose(fairness[3, 7], pair_fairness(ratings[3], rds[3], ratings[7], rds[7]))
+
+
+@pytest.mark.parametrize("mode, num_players", [("full", 65), ("banded", 501), ("auto", 501)])
+def test_match_queue(mode, num_players):
+    ratings, rds, wait_times = random_queue(num_players)
+    matches = match_queue(ratings, rds, wait_times, mode=mode)
+    # every player is either in one pair or left in the queue
+    assert np.array_equal(np.sort(np.concatenate([matches.pairs.ravel(), matches.unmatched])),
+                          np.arange(num_players))
+    assert np.all(matches.pairs[:, 0] < matches.pairs[:, 1]) and np.all(np.diff(matches.pairs[:, 0]) > 0)
+    a, b = matches.pairs.T
+    assert np.allclose(matches.fairness, pair_fairness(ratings[a], rds[a], ratings[b], rds[b]))
+    acceptable = acceptable_fairness(wait_times)
+    assert np.all(matches.fairness <= np.maximum(acceptable[a], acceptable[b]))
+    assert len(matches.pairs) >= num_players * 245 // 501
+
+
+def test_match_queue_small():
+    for seed in range(30):
+        ratings, rds, wait_times = random_queue(6, seed)
+        fairness, acceptable = fairness_matrix(ratings, rds), acceptable_fairness(wait_times)
+        num_pairs, total = best_matching(6, fairness, acceptable)
+        matches = match_queue(ratings, rds, wait_times, mode="banded")
+        # a heuristic, but close to the best matching
+        assert len(matches.pairs) >= num_pairs - 1
+        if len(matches.pairs) == num_pairs:
+            assert np.sum(matches.fairness) <= total + 0.2
+
+
+def test_match_queue_full_is_best():
+    rng = np.random.default_rng(1)
+    for seed in range(400):
+        num_players = int(rng.integers(4, 11))
+        ratings, rds, wait_times = random_queue(num_players, seed)
+        # tighter acceptable fairness than the default, so that some players are left in the queue
+        max_fairness = rng.uniform(0.02, 0.3)
+        fairness, acceptable = fairness_matrix(ratings, rds), acceptable_fairness(wait_times, max_fairness)
+        num_pairs, total = best_matching(num_players, fairness, acceptable)
+        matches = match_queue(ratings, rds, wait_times, mode="full", max_fairness=max_fairness)
+        assert len(matches.pairs) == num_pairs
+        assert np.isclose(np.sum(matches.fairness), total, rtol=0, atol=1e-6)
+
+
+def test_match_queue_wait_times():
+    ratings, rds = np.array([1000., 1500, 2000, 2010]), np.full(4, 60.)
+    matches = match_queue(ratings, rds)
+    assert np.array_equal(matches.pairs, [[2, 3]]) and np.array_equal(matches.unmatched, [0, 1])
+    # after waiting long enough, the wider gap becomes acceptable
+    gap = pair_fairness(1000, 60, 1500, 60)
+    matches = match_queue(ratings, rds, wait_times=[0, (gap - 0.2) / 0.005 + 1, 0, 0])
+    assert np.array_equal(matches.pairs, [[0, 1], [2, 3]]) and len(matches.unmatched) == 0
+    assert len(match_queue([1500.], [60.]).pairs) == 0 and len(match_queue([], []).unmatched) == 0
+
+
+def test_match_queue_errors():
+    with pytest.raises(ValueError):
+        match_queue([1500., 1600], [60.], mode="banded")
+    with pytest.raises(ValueError):
+        match_queue([1500., 1600], [60., 60], mode="exact")
@@ -0,0 +1,68 @@
+import json
+
+import numpy as np
+
+from mmr.bayesian_rating_w3c import clamp_inputs, update_after_game
+from mmr.replay import PlayerTable, rate_matches, read_matches, replay
+
+games = [(["a", "b"], 0), (["c", "d", "e", "f"], 1), (["a", "c"], 1), (["b", "d"], 0), (["e", "a", "b", "f"], 0),
+         (["c", "b"], 1)]
+
+
+def write_logs(tmp_path):
+    with open(tmp_path / "matches.csv", "w") as f:
+        f.write("players,winning_team,number_of_teams\n")
+        for players, winning_team in games:
+            f.write("{},{},2\n".format(" ".join(players), winning_team))
+    with open(tmp_path / "matches.jsonl", "w") as f:
+        for players, winning_team in games:
+            f.write(json.dumps({"players": players, "winning_team": winning_team, "number_of_teams": 2}) + "\n")
+    players = [p for game_players, _ in games for p in game_players]
+    np.savez(tmp_path / "matches.npz", players=np.array(players),
+             offsets=np.cumsum([0] + [len(game_players) for game_players, _ in games]),
+             winning_team=np.array([w for _, w in games]), number_of_teams=np.full(len(games), 2))
+
+
+def test_replay_matches_game_by_game(tmp_path):
+    write_logs(tmp_path)
+    state = {}
+    for players, winning_team in games:
+        result = update_after_game([state.get(p, (1500, 350))[0] for p in players],
+                                   [state.get(p, (1500, 350))[1] for p in players], winning_team, 2)
+        for p, rating, rd in zip(players, result.ratings_list, result.rds_list):
+            state[p] = (rating, rd)
+    for extension in ("csv", "jsonl", "npz"):
+        table = replay(str(tmp_path / ("matches." + extension)), chunk_size=4)
+        rows = table.indices(sorted(state))
+        assert np.allclose(table.ratings[rows], [state[p][0] for p in sorted(state)], atol=0.001)
+        assert np.allclose(table.rds[rows], [state[p][1] for p in sorted(state)], atol=0.001)
+        assert table.games[rows].tolist() == [3, 4, 3, 2, 2, 2]
+
+
+def test_checkpoints(tmp_path):
+    write_logs(tmp_path)
+    table = replay(str(tmp_path / "matches.csv"), checkpoint_dir=str(tmp_path / "checkpoints"), checkpoint_every=3)
+    assert sorted(p.name for p in (tmp_path / "checkpoints").iterdir()) == ["ratings-000000003.npz",
+                                                                           "ratings-000000006.npz"]
+    # resuming from the first checkpoint with the rest of the games gives the same ratings
+    resumed = PlayerTable.load(str(tmp_path / "checkpoints" / "ratings-000000003.npz"))
+    rest = list(read_matches(str(tmp_path / "matches.csv"), chunk_size=3))[1]
+    rate_matches(resumed, rest)
+    rows = table.indices(resumed.ids)
+    assert np.allclose(resumed.ratings[:len(resumed)], table.ratings[rows])
+
+
+def test_replay_clamps_with_rd_min(tmp_path):
+    # deviations start under RD_MIN but above rd_min, the service running with rd_min leaves them as they are
+    write_logs(tmp_path)
+    state = {}
+    for players, winning_team in games:
+        ratings_list, rds_list = clamp_inputs([state.get(p, (1500, 70))[0] for p in players],
+                                              [state.get(p, (1500, 70))[1] for p in players], rd_min=60)
+        result = update_after_game(ratings_list, rds_list, winning_team, 2, rd_min=60)
+        for p, rating, rd in zip(players, result.ratings_list, result.rds_list):
+            state[p] = (rating, rd)
+    table = replay(str(tmp_path / "matches.csv"), PlayerTable(initial_rd=70), rd_min=60)
+    rows = table.indices(sorted(state))
+    assert np.allclose(table.ratings[rows], [state[p][0] for p in sorted(state)], atol=0.001)
+    assert np.allclose(table.rds[rows], [state[p][1] for p in sorted(state)], atol=0.001)
@@ -0,0 +1,79 @@
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+from teambalance import shared
+from teambalance.balance import Balance
+
+GAME_MODES = ["1v1", "2v2", "3v3v3v3", "4v4", "4v4v4v4"]
+RATINGS = np.array([1500, 1300, 1100, 1510, 1320, 1070, 1530, 1360, 1010, 1550, 1400, 950])
+RDS = np.array([90] * 12)
+
+
+def find_in_attached(path):
+    # runs in a spawned process, which only has the published state
+    b = Balance()
+    shared.attach(path).load_into(b)
+    teams = b.find_best_game(RATINGS, RDS, "3v3v3v3", "2+1+1+1+1+1+1+1+1+1+1")
+    return teams, b.constraints_cache_info()["misses"]
+
+
+def test_publish_and_attach(tmp_path):
+    built = Balance()
+    state = shared.publish(built, GAME_MODES, path=str(tmp_path / "state.bin"))
+    # 4v4v4v4 is searched by branch and bound and has no state
+    assert state.game_modes() == ["1v1", "2v2", "3v3v3v3", "4v4"]
+    attached = shared.attach(state.path)
+    for kind, game_mode, team_constraints, array in attached.arrays:
+        if kind == "constrained_games":
+            expected = built.constrained_games(game_mode, team_constraints)
+        else:
+            expected = {"superset": built.superset, "potential_games": built.potential_games,
+                        "team_masks": built.team_masks}[kind][game_mode]
+        assert array.dtype == expected.dtype and np.array_equal(array, expected)
+        assert not array.flags.writeable
+        with pytest.raises(ValueError):
+            array[...] = 0
+    state.unlink()
+    assert not os.path.exists(state.path)
+
+
+def test_load_into(tmp_path):
+    state = shared.publish(Balance(), ["3v3v3v3"], path=str(tmp_path / "state.bin"))
+    b = Balance()
+    assert state.load_into(b) == ["3v3v3v3"]
+    for constraints in ["1+1+1+1+1+1+1+1+1+1+1+1", "3+2+1+1+1+1+1+1+1"]:
+        assert b.find_best_game(RATINGS, RDS, "3v3v3v3", constraints) == \
+            Balance().find_best_game(RATINGS, RDS, "3v3v3v3", constraints)
+    assert b.constraints_cache_info()["misses"] == 0
+    assert b.warm_up("3v3v3v3") > 0 and b.constraints_cache_info()["misses"] == 0
+
+
+def test_attach_from_another_process(tmp_path):
+    state = shared.publish(Balance(), ["3v3v3v3"], path=str(tmp_path / "state.bin"))
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        teams, misses = pool.apply(find_in_attached, (state.path,))
+    assert teams == Balance().find_best_game(RATINGS, RDS, "3v3v3v3", "2+1+1+1+1+1+1+1+1+1+1")
+    assert misses == 0
+
+
+def test_remove_stale(tmp_path):
+    running = tmp_path / "mmr-balance-{}-live.bin".format(os.getpid())
+    process = multiprocessing.get_context("spawn").Process(target=len, args=("",))
+    process.start()
+    process.join()
+    stale = tmp_path / "mmr-balance-{}-dead.bin".format(process.pid)
+    other = tmp_path / "other.bin"
+    for path in (running, stale, other):
+        path.write_bytes(b"")
+    assert shared.remove_stale(str(tmp_path)) == [str(stale)]
+    assert running.exists() and other.exists() and not stale.exists()
+
+
+def test_warmup_game_modes(monkeypatch):
+    monkeypatch.setenv("WARMUP_GAME_MODES", " 2v2, 4v4 ,,")
+    assert shared.warmup_game_modes() == ["2v2", "4v4"]
+    monkeypatch.delenv("WARMUP_GAME_MODES")
+    assert shared.warmup_game_modes() == shared.DEFAULT_WARMUP_GAME_MODES.split(",")
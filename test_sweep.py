@@ -0,0 +1,42 @@
+import numpy as np
+
+from common.constants import C_SD
+from mmr.bayesian_rating_w3c import update_after_game
+from mmr.sweep import score, share_matches, sweep
+
+games = [([0, 1], 0), ([2, 3], 1), ([0, 2], 1), ([1, 3], 0), ([0, 3], 0), ([2, 1], 1)]
+
+
+def write_log(path):
+    np.savez(path, players=np.array([p for players, _ in games for p in players]),
+             offsets=np.arange(0, 2 * len(games) + 1, 2), winning_team=np.array([w for _, w in games]),
+             number_of_teams=np.full(len(games), 2))
+
+
+def test_score(tmp_path):
+    write_log(str(tmp_path / "matches.npz"))
+    num_players = share_matches(str(tmp_path / "matches.npz"), str(tmp_path))
+    result = score(str(tmp_path), num_players, beta=150, rd_min=100, chunk_size=4, burn_in=1)
+    # scored game by game from the pre-game ratings
+    state = {}
+    log_loss, brier = 0, 0
+    for g, (players, winning_team) in enumerate(games):
+        ratings, rds = zip(*[state.get(p, (1500, 350)) for p in players])
+        strengths = np.exp(np.array(ratings) / (C_SD * np.sqrt(np.sum(np.power(rds, 2)) + 2 * 150 ** 2)))
+        probabilities = strengths / np.sum(strengths)
+        if g >= 1:
+            log_loss -= np.log(probabilities[winning_team])
+            brier += np.sum((probabilities - (np.arange(2) == winning_team)) ** 2)
+        update = update_after_game(list(ratings), list(rds), winning_team, 2, beta=150, rd_min=100)
+        for p, rating, rd in zip(players, update.ratings_list, update.rds_list):
+            state[p] = (rating, rd)
+    assert result.games == 5
+    assert np.isclose(result.log_loss, log_loss / 5, atol=1e-6)
+    assert np.isclose(result.brier, brier / 5, atol=1e-6)
+
+
+def test_sweep_ranks_by_log_loss(tmp_path):
+    write_log(str(tmp_path / "matches.npz"))
+    results = sweep(str(tmp_path / "matches.npz"), [100, 215], [80], workers=2)
+    assert sorted(r.beta for r in results) == [100, 215]
+    assert results[0].log_loss <= results[1].log_loss
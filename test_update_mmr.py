@@ -0,0 +1,57 @@
+import numpy as np
+
+from mmr.update_mmr import update_after_game, update_after_games, update_ratings, update_ratings_newton, \
+    f_likelihood, f_geomean_Delta
+
+ratings_list = [1400, 1600, 1340, 1700, 1200, 1900, 1400, 1900]
+rds_list = [61, 100, 100, 67, 65, 62, 63, 70]
+
+
+def test_worked_examples():
+    # examples at the bottom of mmr/update_mmr.py, computed with a rating deviation floor of 60.25
+    expected = {
+        1: ([1415.7225732694192, 1636.0959458063471, 1382.8216574272815, 1715.4833290016602,
+             1178.6338056978416, 1887.82309412202, 1382.9306817853123, 1884.091271066116],
+            [60.25, 96.41497356911383, 96.41497356911383, 64.59803229130625,
+             65.65567881533067, 62.625416716161574, 63.63550408255127, 70.70611564727919]),
+        0: ([1396.617583099109, 1591.2331410257361, 1329.5200791016296, 1695.7345677532749,
+             1205.629044386524, 1902.8675444492105, 1404.2116071777652, 1904.5643846675193],
+            [60.25, 96.40482020086672, 96.40482020086672, 64.5912295345807,
+             65.65045914771653, 62.62043795628347, 63.63044502009449, 70.70049446677166]),
+    }
+    for T1_won, (ratings, rds) in expected.items():
+        # the default SLSQP path reproduces the ratings, replays of past seasons depend on it
+        result = update_after_game(ratings_list, rds_list, T1_won)
+        assert np.allclose(result.ratings_list, ratings, atol=0.01)
+        assert np.allclose(result.rds_list, rds, atol=0.02)
+        # the vectorized engine is opt-in, its ratings move by the SLSQP tolerance
+        result = update_after_game(ratings_list, rds_list, T1_won, solver="vectorized")
+        assert np.allclose(result.ratings_list, ratings, atol=1)
+        assert np.allclose(result.rds_list, rds, atol=0.02)
+
+
+def test_vectorized_matches_scipy():
+    rng = np.random.default_rng(0)
+    for T_G in (1, 2, 4):
+        ratings_G = rng.normal(1500, 300, (10, 2 * T_G)).clip(200)
+        rds_G = rng.uniform(60, 350, (10, 2 * T_G))
+        T1_won = rng.integers(0, 2, 10)
+        ratings_G_u, rds_G_u = update_after_games(ratings_G, rds_G, T1_won)
+        for g in range(10):
+            expected = update_after_game(ratings_G[g].tolist(), rds_G[g].tolist(), int(T1_won[g]), solver="scipy")
+            # the xi loop stops within 0.001 of the team deviation
+            assert np.allclose(rds_G_u[g], expected.rds_list, rtol=0.005)
+            # same team rating difference as SLSQP, at a likelihood at least as good
+            delta_u = f_geomean_Delta(np.array(expected.ratings_list), ratings_G[g], rds_G[g], 0)
+            assert abs(f_geomean_Delta(ratings_G_u[g], ratings_G[g], rds_G[g], delta_u)) < 1e-3
+            assert f_likelihood(ratings_G_u[g], ratings_G[g], rds_G[g]) <= \
+                f_likelihood(np.array(expected.ratings_list), ratings_G[g], rds_G[g]) + 1e-6
+
+
+def test_ratings_newton_matches_slsqp():
+    ratings_G = np.array(ratings_list, dtype=float)
+    rds_G = np.array(rds_list, dtype=float)
+    expected = update_ratings(ratings_G, rds_G, 10.0)
+    result = update_ratings_newton(ratings_G[None], rds_G[None], np.array([10.0]))[0]
+    assert abs(f_geomean_Delta(result, ratings_G, rds_G, 10.0)) < 1e-9
+    assert np.allclose(result, expected, atol=1)
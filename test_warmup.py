@@ -0,0 +1,34 @@
+import time
+
+import numpy as np
+from fastapi.testclient import TestClient
+
+import main
+from teambalance.balance import Balance
+
+
+def test_balance_warm_up():
+    balance = Balance()
+    assert balance.warm_up("2v2") == 3
+    assert balance.constraints_cache_info()["size"] == 3
+    balance.find_best_game(np.array([1500, 1400, 1300, 1200]), np.array([90] * 4), "2v2", "2+1+1")
+    assert balance.constraints_cache_info()["hits"] == 1
+    # branch and bound game modes have nothing to build
+    assert balance.warm_up("4v4v4v4") == 0 and "4v4v4v4" not in balance.superset
+
+
+def test_ready(monkeypatch):
+    monkeypatch.setattr(main, "WARMUP_GAME_MODES", ["1v1", "3v3v3v3"])
+    monkeypatch.setattr(main, "readiness", {"ready": False, "game_modes": {}})
+    with TestClient(main.app) as client:
+        deadline = time.time() + 30
+        response = client.get("/ready")
+        while response.status_code == 503 and time.time() < deadline:
+            time.sleep(0.05)
+            response = client.get("/ready")
+        assert response.status_code == 200
+        assert sorted(response.json()["game_modes"]) == ["1v1", "3v3v3v3"]
+        # the workers of the pools are up before the service reports ready
+        for pool in (main.rating_pool, main.balance_pool):
+            assert pool.kind == "inline" or pool._executor is not None
+    assert "3v3v3v3" in main.balance.superset
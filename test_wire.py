@@ -0,0 +1,75 @@
+import struct
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from common import wire
+from main import app
+
+client = TestClient(app)
+HEADERS = {"Content-Type": wire.WIRE_CONTENT_TYPE}
+
+
+def test_round_trip():
+    ratings, rds = [1400.5, 1600, 1340, 1700], [350, 90, 120.25, 80]
+    decoded = wire.decode_update_request(wire.encode_update_request(ratings, rds, 1, 2))
+    assert decoded[0].tolist() == ratings and decoded[1].tolist() == rds and decoded[2:] == (1, 2)
+
+    games = [(ratings, rds, 0, 2), (ratings[:2], rds[:2], 1, 2)]
+    decoded = wire.decode_batch_request(wire.encode_batch_request(games))
+    assert [(r.tolist(), d.tolist(), w, t) for r, d, w, t in decoded] == [
+        (ratings, rds, 0, 2), (ratings[:2], rds[:2], 1, 2)]
+
+    decoded = wire.decode_balance_request(wire.encode_balance_request(ratings, rds, "2v2", "2+1+1", time_budget=0.5))
+    assert decoded[0].tolist() == ratings and decoded[2:] == ("2v2", "2+1+1", None, 0.5)
+
+
+@pytest.mark.parametrize("body", [b"", b"\x02\x00\x00\x00", wire.encode_update_request([1500], [90], 0, 2) + b"\x00"])
+def test_malformed(body):
+    with pytest.raises((ValueError, struct.error)):
+        wire.decode_update_request(body)
+    response = client.post("/mmr/update", data=body, headers=HEADERS)
+    assert response.status_code == 400
+
+
+def test_update_matches_json():
+    ratings, rds = [1400, 1600, 1340, 1700], [350, 350, 350, 350]
+    expected = client.post("/mmr/update", json={"ratings_list": ratings, "rds_list": rds, "winning_team": 0,
+                                                "number_of_teams": 2}).json()
+    response = client.post("/mmr/update", data=wire.encode_update_request(ratings, rds, 0, 2), headers=HEADERS)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == wire.WIRE_CONTENT_TYPE
+    new_ratings, new_rds = wire.decode_update_response(response.content)
+    np.testing.assert_allclose(new_ratings, expected["ratings_list"])
+    np.testing.assert_allclose(new_rds, expected["rds_list"])
+
+
+def test_batch_matches_json():
+    games = [([1400, 1600], [90, 350], 0, 2), ([1500, 1500, 1500], [80, 100, 120], 2, 3)]
+    expected = client.post("/mmr/update/batch", json={"games": [
+        {"ratings_list": r, "rds_list": d, "winning_team": w, "number_of_teams": t} for r, d, w, t in games]}).json()
+    response = client.post("/mmr/update/batch", data=wire.encode_batch_request(games), headers=HEADERS)
+    assert response.status_code == 200
+    for (new_ratings, new_rds), game in zip(wire.decode_batch_response(response.content), expected["games"]):
+        np.testing.assert_allclose(new_ratings, game["ratings_list"])
+        np.testing.assert_allclose(new_rds, game["rds_list"])
+
+
+def test_balance_matches_json():
+    ratings, rds = [1500, 1400, 1300, 1200, 1700, 1100], [90] * 6
+    expected = client.post("/team/balance", json={"ratings_list": ratings, "rds_list": rds, "gamemode": "3v3",
+                                                  "team_constraints": "2+1+1+1+1"}).json()
+    body = wire.encode_balance_request(ratings, rds, "3v3", "2+1+1+1+1")
+    teams, exact = wire.decode_balance_response(client.post("/team/balance", data=body, headers=HEADERS).content)
+    assert teams.tolist() == expected["teams"] and exact == expected["exact"]
+
+
+def test_predict_matches_json():
+    games = [([1400, 1600], [90, 350], 2), ([1500, 1400, 1300, 1200], [80, 100, 120, 90], 2)]
+    expected = client.post("/mmr/predict", json={"games": [
+        {"ratings_list": r, "rds_list": d, "number_of_teams": t} for r, d, t in games]}).json()
+    response = client.post("/mmr/predict", data=wire.encode_predict_request(games), headers=HEADERS)
+    assert response.status_code == 200
+    for game_odds, expected_odds in zip(wire.decode_predict_response(response.content), expected["odds"]):
+        np.testing.assert_allclose(game_odds, expected_odds)